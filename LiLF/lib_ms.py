@@ -1,12 +1,14 @@
 #!/usr/bin/python
 
-import os, sys, shutil
+import os, sys, re, time, shutil, json, ast, operator
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from casacore import tables
 import numpy as np
 import pyregion
 from pyregion.parser_helper import Shape
-from LiLF import lib_util
+from LiLF import lib_util, lib_multiproc
 
 from astropy.coordinates import get_sun, SkyCoord, EarthLocation, AltAz
 from astropy.time import Time
@@ -18,6 +20,211 @@ from LiLF.lib_log import logger
 from astropy.utils import iers
 iers.conf.auto_download = False  
 
+def getTelescopeCoords(telescope):
+    """
+    Return the EarthLocation of a telescope
+    """
+    if telescope == 'LOFAR':
+        return EarthLocation(lat=52.90889*u.deg, lon=6.86889*u.deg, height=0*u.m)
+    elif telescope == 'GMRT':
+        return EarthLocation(lat=19.0948*u.deg, lon=74.0493*u.deg, height=0*u.m)
+    else:
+        raise('Unknown Telescope.')
+
+def setSkyPositions(mss):
+    """
+    Set elev, sun_dist and ha of a list of MS objects
+    The coordinate transformations are done at once for all MSs of the same telescope.
+    """
+    for telescope in set([ms.getTelescope() for ms in mss]):
+        telescope_mss = [ms for ms in mss if ms.getTelescope() == telescope]
+        telescope_coords = getTelescopeCoords(telescope)
+        time = Time( np.array([np.mean(ms.getTimeRange()) for ms in telescope_mss])/86400, format='mjd')
+        time.delta_ut1_utc = 0. # no need to download precise table for leap seconds
+        coord_sun = get_sun(time)
+        coord_sun = SkyCoord(ra=coord_sun.ra,dec=coord_sun.dec) # fix transformation issue
+        ra, dec = np.array([ms.getPhaseCentre() for ms in telescope_mss]).T
+        coord = SkyCoord(ra*u.deg, dec*u.deg)
+        elev = coord.transform_to(AltAz(obstime=time,location=telescope_coords)).alt
+        sun_dist = coord.separation(coord_sun)
+        lst = time.sidereal_time('mean', telescope_coords.lon)
+        ha = lst - coord.ra # hour angle
+        for i, ms in enumerate(telescope_mss):
+            ms.elev, ms.sun_dist, ms.ha = elev[i], sun_dist[i], ha[i]
+
+def _chunkRows(t, columns, chunkBytes=2**28):
+    """
+    Return the number of rows to read/write at once for the given columns of table t, so that the chunk
+    takes about chunkBytes and is a multiple of the tile height of tiled columns (each tile is accessed once)
+    """
+    rowBytes, tileRows = 0, 1
+    for col in set(columns):
+        rowBytes += np.asarray(t.getcell(col, 0)).nbytes
+        for hypercube in t.getdminfo(col)['SPEC'].get('HYPERCUBES', {}).values():
+            tileRows = int(np.lcm(tileRows, int(hypercube['TileShape'][-1])))
+    return max(tileRows, chunkBytes // max(1, rowBytes) // tileRows * tileRows)
+
+def circPhaseDiff(data):
+    """
+    Return the circular phase difference of visibilities in circular basis (RR, RL, LR, LL):
+    0.5*exp(i*(phase(RR)-phase(LL))) in RR and LL, 0 in RL and LR. Used to solve for Faraday rotation.
+    """
+    phdiff = np.zeros_like(data)
+    phdiff[...,0] = 0.5*np.exp(1j*(np.angle(data[...,0]) - np.angle(data[...,3])))
+    phdiff[...,3] = phdiff[...,0]
+    return phdiff
+
+def copyColumn(t, incol, outcol, chunkBytes=2**26):
+    """
+    Copy the values of a column into another (existing) column of table t.
+    Rows are copied in chunks aligned with the storage tiles (see: '_chunkRows()'), so tiles are accessed
+    in storage order and once. While a chunk is written, the kernel is asked to read ahead the storage
+    files of the next chunk of incol, so that reading overlaps writing (casacore keeps the GIL, so this
+    cannot be done with a reader thread).
+    Return a dict with the bytes copied and the time spent.
+    """
+    start = time.time()
+    nrows = t.nrows()
+    step = _chunkRows(t, [incol, outcol], chunkBytes)
+
+    # storage files of incol, the rows are assumed to be spread uniformly in them
+    prefetch = []
+    if hasattr(os, 'posix_fadvise') and t.getdminfo(incol)['TYPE'] != 'VirtualTaQLColumn':
+        prefix = 'table.f%i' % t.getdminfo(incol)['SEQNR']
+        for f in os.listdir(t.name()):
+            if f == prefix or f.startswith(prefix + '_'):
+                fd = os.open(t.name() + '/' + f, os.O_RDONLY)
+                prefetch.append((fd, os.fstat(fd).st_size))
+
+    nbytes = 0
+    try:
+        for startrow in range(0, nrows, step):
+            for fd, size in prefetch:
+                os.posix_fadvise(fd, int(size * (startrow + step) / nrows), int(size * step / nrows) + 1,
+                                 os.POSIX_FADV_WILLNEED)
+            data = t.getcol(incol, startrow, step)
+            t.putcol(outcol, data, startrow, step)
+            nbytes += data.nbytes
+    finally:
+        for fd, size in prefetch:
+            os.close(fd)
+
+    return {'bytes': nbytes, 'time': time.time() - start}
+
+def _dp3WrittenColumns(command):
+    """
+    Return the columns that a DP3 command writes in its input MS (msout=. or empty, as for DP3), looking in the parset
+    and on the command line
+    """
+    args = command.split()[1:]
+    parms = {}
+    for arg in args:
+        if '=' not in arg and os.path.isfile(arg): # parset
+            with open(arg) as f:
+                for line in f:
+                    line = line.split('#')[0]
+                    if '=' in line:
+                        key, value = line.split('=', 1)
+                        parms[key.strip()] = value.strip()
+    for arg in args:
+        if '=' in arg:
+            key, value = arg.split('=', 1)
+            parms[key.strip()] = value.strip()
+    msout = parms.get('msout', '').strip('"\'')
+    if msout not in ['', '.', parms.get('msin', '').strip('"\'')]:
+        return []
+    return [parms.get('msout.datacolumn', 'DATA'), 'FLAG']
+
+# grammar of the string expressions of MS.updateColumns(): column names, numbers, lists of numbers (arrays),
+# + - * / ** and these numpy functions, e.g. 'DATA - MODEL_DATA' or 'np.where(FLAG, 0, MODEL_DATA)'
+_expr_operators = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv,
+                   ast.Pow: operator.pow, ast.USub: operator.neg, ast.UAdd: operator.pos}
+_expr_functions = ['array', 'where', 'abs', 'conj', 'real', 'imag', 'angle', 'exp', 'sqrt', 'logical_or', 'logical_and']
+
+
+def _parseExpression(expr, colnames):
+    """
+    Parse a column expression, raise ValueError if it is not in the grammar (nothing is ever evaluated as python)
+    Return the expression tree and the columns it reads
+    """
+    tree = ast.parse(expr.strip(), mode='eval')
+    names = []
+    nodes = list(ast.walk(tree))
+    if len([n for n in nodes if isinstance(n, ast.Name) and n.id == 'np']) != \
+            len([n for n in nodes if isinstance(n, ast.Attribute)]):
+        raise ValueError('Only np.%s() can be called in "%s"' % ('/'.join(_expr_functions), expr))
+    for node in nodes:
+        if isinstance(node, ast.Name):
+            if node.id == 'np': continue
+            if node.id not in colnames:
+                raise ValueError('Unknown column %s in "%s"' % (node.id, expr))
+            names.append(node.id)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Attribute) or len(node.keywords) > 0:
+                raise ValueError('Only np.%s() can be called in "%s"' % ('/'.join(_expr_functions), expr))
+        elif isinstance(node, ast.Attribute):
+            if not (isinstance(node.value, ast.Name) and node.value.id == 'np' and node.attr in _expr_functions):
+                raise ValueError('Only np.%s() can be called in "%s"' % ('/'.join(_expr_functions), expr))
+        elif isinstance(node, ast.Constant):
+            if type(node.value) not in [int, float, complex, bool]:
+                raise ValueError('Only numbers are allowed as constants in "%s"' % expr)
+        elif not isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.List, ast.Tuple, ast.Load)
+                                  + tuple(_expr_operators)):
+            raise ValueError('Not allowed in a column expression: %s in "%s"' % (type(node).__name__, expr))
+    return tree.body, names
+
+
+def _evalExpression(node, cols):
+    """
+    Evaluate a tree returned by _parseExpression() with the dict column -> array cols
+    """
+    if isinstance(node, ast.Name):
+        return cols[node.id]
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return np.array([_evalExpression(elt, cols) for elt in node.elts])
+    if isinstance(node, ast.UnaryOp):
+        return _expr_operators[type(node.op)](_evalExpression(node.operand, cols))
+    if isinstance(node, ast.BinOp):
+        return _expr_operators[type(node.op)](_evalExpression(node.left, cols), _evalExpression(node.right, cols))
+    if isinstance(node, ast.Call):
+        return getattr(np, node.func.attr)(*[_evalExpression(arg, cols) for arg in node.args])
+    raise ValueError('Not allowed in a column expression: %s' % type(node).__name__)
+
+
+# role of intermediate columns, their storage manager is set per role in the [columns] section of lilf.config
+# FR_MODEL_DATA has no role: it is set to fixed values with updateColumns() and must never be dysco
+column_roles = {'MODEL_DATA': 'model', 'SUBTRACTED_DATA': 'residual',
+                'SMOOTHED_DATA': 'smoothed'}
+_column_storage = None
+
+
+def getColumnStorage(col):
+    """
+    Return the storage of a new column from the policy of its role (see: lib_util.getParset()):
+    'auto' (as the column it is made from), 'tiled' (TiledColumnStMan) or 'dysco[:<data bits>,<weight bits>]'.
+    Columns without a role are always 'auto'.
+    """
+    global _column_storage
+    if col not in column_roles:
+        return 'auto'
+    if _column_storage is None:
+        _column_storage = dict(lib_util.getParset().items('columns'))
+        for role, storage in _column_storage.items():
+            if not re.match(r'^(auto|tiled|dysco(:\d+,\d+)?)$', storage):
+                raise ValueError('Storage of %s columns must be auto, tiled or dysco[:<data bits>,<weight bits>], not %s.'
+                                 % (role, storage))
+    return _column_storage.get(column_roles[col], 'auto')
+
+
+def _loadMS(pathMS, check_flags):
+    """
+    Return the MS object (without sky positions) and whether it is fully flagged, used by AllMSs
+    """
+    ms = MS(pathMS, skyPositions=False)
+    return ms, check_flags and ms.isAllFlagged()
+
 class AllMSs(object):
 
     def __init__(self, pathsMS, scheduler, check_flags=True, check_sun=False, min_sun_dist=10):
@@ -35,15 +242,25 @@ class AllMSs(object):
             logger.error('Cannot find MS files.')
             raise('Cannot find MS files.')
 
+        # read the MSs in parallel (casacore holds the GIL, so use processes), then compute the sky positions
+        # of all of them at once
+        pathsMS = sorted(pathsMS)
+        nproc = min(len(pathsMS), self.scheduler.max_processors)
+        if nproc > 1:
+            with ProcessPoolExecutor(max_workers=nproc, mp_context=multiprocessing.get_context('fork')) as pool:
+                loaded = list(pool.map(_loadMS, pathsMS, [check_flags]*len(pathsMS)))
+        else:
+            loaded = [_loadMS(pathMS, check_flags) for pathMS in pathsMS]
+        setSkyPositions([ms for ms, allFlagged in loaded if not allFlagged])
+
         self.mssListObj = []
-        for pathMS in sorted(pathsMS):
-            ms = MS(pathMS)
-            if check_flags and ms.isAllFlagged(): 
-                logger.warning('Skip fully flagged ms: %s' % pathMS)
+        for ms, allFlagged in loaded:
+            if allFlagged:
+                logger.warning('Skip fully flagged ms: %s' % ms.pathMS)
             elif check_sun and ms.sun_dist.deg < min_sun_dist:
-                logger.warning('Skip too close to sun (%.0f deg) ms: %s' % (ms.sun_dist.deg, pathMS))
+                logger.warning('Skip too close to sun (%.0f deg) ms: %s' % (ms.sun_dist.deg, ms.pathMS))
             else:
-                self.mssListObj.append(MS(pathMS))
+                self.mssListObj.append(ms)
 
         if len(self.mssListObj) == 0:
             raise('ALL MS files flagged.')
@@ -114,22 +331,29 @@ class AllMSs(object):
         return int(round(self.getBandwidth()/(size)))
 
 
-    def run(self, command, log, commandType='', maxThreads=None):
+    def run(self, command, log, commandType='', maxThreads=None, processors=None, memory=None):
         """
         Run command 'command' of type 'commandType', and use 'log' for logger,
         for each MS of AllMSs.
         The command and log file path can be customised for each MS using keywords (see: 'MS.concretiseString()').
         Beware: depending on the value of 'Scheduler.max_threads' (see: lib_util.py), the commands are run in parallel.
+        processors, memory: resources of each command (see: 'Scheduler.add()')
         """
         # add max num of threads given the total jobs to run
         # e.g. in a 64 processors machine running on 16 MSs, would result in numthreads=4
         if commandType == 'DP3': command += ' numthreads='+str(self.getNThreads())
 
+        # virtual columns cannot be written by DP3, and must keep their values if the referenced column is written
+        if commandType == 'DP3':
+            written = _dp3WrittenColumns(command)
+            for MSObject in self.mssListObj:
+                MSObject.prepareWrite(written)
+
         for MSObject in self.mssListObj:
             commandCurrent = MSObject.concretiseString(command)
             logCurrent     = MSObject.concretiseString(log)
 
-            self.scheduler.add(cmd = commandCurrent, log = logCurrent, commandType = commandType)
+            self.scheduler.add(cmd = commandCurrent, log = logCurrent, commandType = commandType, processors = processors, memory = memory, ms = MSObject.nameMS)
 
             # Provide debug output.
             #lib_util.printLineBold("commandCurrent:")
@@ -139,39 +363,89 @@ class AllMSs(object):
 
         self.scheduler.run(check = True, maxThreads = maxThreads)
 
-    def addcol(self, newcol, fromcol, usedysco='auto', log='$nameMS_addcol.log'):
+    def addcol(self, newcol, fromcol, usedysco='auto', log='$nameMS_addcol.log', virtual=False, maxThreads=None):
         """
-        # TODO: it might be that if col exists and is dysco, forcing no dysco will not work. Maybe force TiledColumnStMan in such cases?
-        Use DP3 to add a new data column using values from an existing column.
+        Add a new data column using values from an existing column, the MSs are done in parallel (see: 'copyColumn()').
         Parameters
         ----------
         newcol: string, name of new column
         fromcol: string, name of existing column
-        usedysco: bool or string, if bool: use dysco? if 'auto', use dysco if fromcol uses dysco.
-        log: string, logfile name
-        """
-        sm = '' # storagemanager
-        if usedysco == 'auto': # if col is dysco compressed in first MS, assume it is for all MSs
-            with tables.table(self.mssListStr[0], ack=False) as t:
-                if t.getdminfo(fromcol)['TYPE'] == 'DyscoStMan':
-                    sm = 'dysco'
-        elif usedysco:
-            sm = 'dysco'
-        self.run(f'DP3 msin=$pathMS msin.datacolumn={fromcol} msout=. msout.datacolumn={newcol} \
-                 msout.storagemanager={sm} steps=[]', log=log, commandType="DP3")
+        usedysco: bool or string, if bool: use dysco? if 'auto', the storage policy of newcol role or, without one,
+            dysco if fromcol uses dysco (see: 'MS.addColumnLike()').
+            Ignored if newcol already exists, then only the values are copied.
+        log: string, logfile name (unused, kept for compatibility)
+        virtual: bool, if True newcol is a virtual column referencing fromcol (see: 'MS.addVirtualColumn()'),
+            an existing newcol is replaced. Nothing is copied until newcol is written.
+        maxThreads: max number of MSs processed at the same time, default: the scheduler max_processors
+        """
+        if virtual:
+            for MSObject in self.mssListObj:
+                with tables.table(MSObject.pathMS, ack = False, readonly = False) as t:
+                    if newcol in t.colnames(): t.removecols(newcol)
+                    MSObject.addVirtualColumn(t, newcol, fromcol)
+            return
+
+        self.parallel(lambda ms: ms.copyColumn(fromcol, newcol, usedysco), maxThreads,
+                      'Copied %s -> %s' % (fromcol, newcol))
+
+    def parallel(self, function, maxThreads=None, message=None):
+        """
+        Call function(ms) for each MS object in forked processes (so function can be any python function)
+        function must return a dict with 'bytes' and 'time', which is used to log the throughput after message.
+        Return a dict pathMS -> output of function, an exception in function is raised again here.
+        maxThreads: max number of MSs processed at the same time, default: the scheduler max_processors
+        """
+        if maxThreads is None: maxThreads = self.scheduler.max_processors
+        maxThreads = max(1, min(maxThreads, len(self.mssListObj)))
+
+        def call(ms, outQueue=None):
+            try:
+                outQueue.put((ms.pathMS, function(ms)))
+            except Exception as e:
+                outQueue.put((ms.pathMS, e))
+
+        start = time.time()
+        mpm = lib_multiproc.multiprocManager(maxThreads, call)
+        for ms in self.mssListObj:
+            mpm.put([ms])
+        mpm.wait()
+        results = dict(mpm.get())
+        for ms in self.mssListObj:
+            if isinstance(results[ms.pathMS], Exception):
+                logger.error('%s: %s' % (ms.pathMS, results[ms.pathMS]))
+                raise results[ms.pathMS]
+        if message is not None:
+            mb = sum([r['bytes'] for r in results.values()])/1e6
+            logger.debug('%s: %.0f MB in %.1f s (%.0f MB/s, %.0f MB/s per MS)' % (message, mb, time.time()-start,
+                         mb/(time.time()-start), np.mean([r['bytes']/1e6/r['time'] for r in results.values()])))
+        return results
+
+    def updateColumns(self, updates, inputs=None, like=None, maxThreads=None, chunkBytes=2**28):
+        """
+        Update columns of all MSs in parallel with expressions evaluated in-process (see: 'MS.updateColumns()'),
+        e.g. MSs.updateColumns({'CORRECTED_DATA': 'DATA - MODEL_DATA'}) replaces
+        MSs.run('taql "update $pathMS set CORRECTED_DATA = DATA - MODEL_DATA"', ...)
+        maxThreads: max number of MSs processed at the same time, default: the scheduler max_processors
+        """
+        updated = ','.join([u[0] for u in (updates.items() if isinstance(updates, dict) else updates)])
+        return self.parallel(lambda ms: ms.updateColumns(updates, inputs, like, chunkBytes), maxThreads,
+                             'Updated %s' % updated)
+
+    def getColumnBytes(self):
+        """
+        Return a dict column -> bytes on disk summed over all MSs (see: 'MS.getColumnBytes()')
+        """
+        colbytes = {}
+        for ms in self.mssListObj:
+            with tables.table(ms.pathMS, ack = False) as t:
+                for col, nbytes in ms.getColumnBytes(t).items():
+                    colbytes[col] = colbytes.get(col, 0) + nbytes
+        return colbytes
 
     def print_HAcov(self, png=None):
         """
         some info on the MSs
         """
-        telescope = self.mssListObj[0].getTelescope()
-        if telescope == 'LOFAR':
-            telescope_coords = EarthLocation(lat=52.90889*u.deg, lon=6.86889*u.deg, height=0*u.m)
-        elif telescope == 'GMRT':
-            telescope_coords = EarthLocation(lat=19.0948*u.deg, lon=74.0493*u.deg, height=0*u.m)
-        else:
-            raise('Unknown Telescope.')
-        
         has = []; elevs = []
         for ms in self.mssListObj:
             time = np.mean(ms.getTimeRange())
@@ -192,14 +466,132 @@ class AllMSs(object):
             pl.savefig(png)
 
 
+class TempColumns(object):
+    """
+    Scratch columns of a set of MSs, each owned by a pipeline step (see: lib_util.Walker) and removed
+    from all MSs when that step completes (a step that raises keeps them), e.g.:
+        tmpcols = lib_ms.TempColumns(MSs)
+        with w.if_todo('cal_fr'):
+            tmpcols.add('CIRC_PHASEDIFF_DATA', 'CORRECTED_DATA', usedysco=False)
+            ...
+        # CIRC_PHASEDIFF_DATA is gone
+    Columns registered outside a step, or with keep=True, stay until release(). Those, and any other column
+    not owned by the running step, are removed (largest first) as soon as the disk of the MSs is fuller
+    than max_disk_usage, this is checked when a column is added and at the end of each step.
+    """
+    def __init__(self, MSs, max_disk_usage=0.95):
+        self.MSs = MSs
+        self.max_disk_usage = max_disk_usage
+        self.owners = {} # column -> owner step (None: kept until released)
+        lib_util.Walker.step_end_callbacks.append(self.stepEnd)
+
+    def add(self, col, fromcol, usedysco='auto', virtual=False, keep=False):
+        """
+        Add col as a copy of fromcol (see: 'AllMSs.addcol()') and register it (see: 'register()')
+        """
+        self.checkDisk()
+        self.MSs.addcol(col, fromcol, usedysco=usedysco, virtual=virtual)
+        self.register(col, keep=keep)
+
+    def register(self, col, keep=False):
+        """
+        Register a column created elsewhere (e.g. by updateColumns() or DP3) as temporary
+        keep: if True, the column is not removed at the end of the running step
+        """
+        owner = None if keep else lib_util.Walker.current_step
+        self.owners[col] = owner
+        logger.debug('Temporary column %s (%s)' % (col, 'until released' if owner is None else 'step: '+owner))
+
+    def release(self, cols=None):
+        """
+        Remove columns from all MSs, default: all the registered columns
+        Return the bytes freed.
+        """
+        if cols is None: cols = list(self.owners.keys())
+        if isinstance(cols, str): cols = [cols]
+        freed = 0
+        for ms in self.MSs.getListObj():
+            with tables.table(ms.pathMS, ack = False, readonly = False) as t:
+                colbytes = ms.getColumnBytes(t)
+                toRemove = [col for col in cols if col in colbytes]
+                # a virtual column referencing a removed one must become real first
+                for col, refcol in ms.getVirtualColumns(t).items():
+                    if refcol in toRemove and col not in toRemove:
+                        ms.materialiseColumn(t, col)
+                if len(toRemove) > 0:
+                    t.removecols(toRemove)
+                freed += sum([colbytes[col] for col in toRemove])
+        for col in cols:
+            self.owners.pop(col, None)
+        logger.info('Removed temporary columns %s (%.1f GB)' % (','.join(cols), freed/1e9))
+        return freed
+
+    def stepEnd(self, step):
+        """
+        Called by lib_util.Walker at the end of each completed step: remove the columns owned by it
+        """
+        cols = [col for col, owner in self.owners.items() if owner == step]
+        if len(cols) > 0:
+            self.release(cols)
+        self.checkDisk()
+
+    def checkDisk(self):
+        """
+        If the disk of the MSs is too full, remove the columns not owned by the running step, largest first
+        """
+        def usage():
+            return max([1 - shutil.disk_usage(ms.pathMS).free/shutil.disk_usage(ms.pathMS).total
+                        for ms in self.MSs.getListObj()])
+
+        if len(self.owners) == 0 or usage() < self.max_disk_usage:
+            return
+        colbytes = self.MSs.getColumnBytes()
+        removable = sorted([col for col, owner in self.owners.items() if owner != lib_util.Walker.current_step],
+                           key=lambda col: colbytes.get(col, 0), reverse=True)
+        for col in removable:
+            logger.warning('Disk usage above %i%%, removing temporary column %s.' % (100*self.max_disk_usage, col))
+            self.release(col)
+            if usage() < self.max_disk_usage:
+                return
+        logger.warning('Disk usage above %i%% and no temporary columns left to remove.' % (100*self.max_disk_usage))
+
+    def report(self):
+        """
+        Log the bytes held by each column summed over all MSs (skipping those with less than 1% of the total),
+        temporary columns are marked with their owner. Return the dict column -> bytes.
+        """
+        colbytes = self.MSs.getColumnBytes()
+        for col, nbytes in sorted(colbytes.items(), key=lambda x: x[1], reverse=True):
+            if nbytes < 0.01*sum(colbytes.values()) and col not in self.owners:
+                continue
+            if col in self.owners:
+                owner = ' (temporary: %s)' % ('until released' if self.owners[col] is None else self.owners[col])
+            else:
+                owner = ''
+            logger.info('%s: %.0f MB%s' % (col, nbytes/1e6, owner))
+        logger.info('Total: %.0f MB in %i MSs, temporary columns: %.0f MB' % (sum(colbytes.values())/1e6,
+                    len(self.MSs.getListObj()), sum([colbytes.get(col, 0) for col in self.owners])/1e6))
+        return colbytes
+
+
 class MS(object):
 
-    def __init__(self, pathMS):
+    # metadata cached by getMetadata(): group -> (subtables, main table columns it depends on, method computing it)
+    metadata_groups = {'subtables': (['FIELD', 'SPECTRAL_WINDOW', 'OBSERVATION'], [], '_readSubtables'),
+                       'flags': ([], ['FLAG'], '_readFlags'),
+                       'time': ([], ['TIME'], '_readTimeIndex'),
+                       'baselines': ([], ['TIME', 'UVW'], '_readBaselines'),
+                       'baselines_unflagged': ([], ['TIME', 'UVW', 'FLAG'], '_readBaselinesUnflagged')}
+    metadata_file = 'LiLF_metadata.npz' # sidecar in the MS directory, only arrays and json (never pickle)
+
+    def __init__(self, pathMS, skyPositions=True):
         """
         pathMS:        path of the MS, without '/' at the end!
         pathDirectory: path of the parent directory of the MS
         nameMS:        name of the MS, without parent directories and extension (which is assumed to be ".MS" always)
+        skyPositions:  if False elev, sun_dist and ha are not set (see: setSkyPositions(), used to do many MSs at once)
         """
+        self._metadata = None # group -> (key, values), loaded at first use
         self.setPathVariables(pathMS)
         # If the field name is not a recognised calibrator name, one of two scenarios is true:
         # 1. The field is not a calibrator field;
@@ -215,25 +607,8 @@ class MS(object):
                 #                nameFieldNew + "'...")
                 self.setNameField(nameFieldNew)
 
-        telescope = self.getTelescope()
-        if telescope == 'LOFAR':
-            telescope_coords = EarthLocation(lat=52.90889*u.deg, lon=6.86889*u.deg, height=0*u.m)
-        elif telescope == 'GMRT':
-            telescope_coords = EarthLocation(lat=19.0948*u.deg, lon=74.0493*u.deg, height=0*u.m)
-        else:
-            raise('Unknown Telescope.')
- 
-        time = np.mean(self.getTimeRange())
-        time = Time( time/86400, format='mjd')
-        time.delta_ut1_utc = 0. # no need to download precise table for leap seconds
-        coord_sun = get_sun(time)
-        coord_sun = SkyCoord(ra=coord_sun.ra,dec=coord_sun.dec) # fix transformation issue
-        ra, dec = self.getPhaseCentre()
-        coord = SkyCoord(ra*u.deg, dec*u.deg)
-        self.elev = coord.transform_to(AltAz(obstime=time,location=telescope_coords)).alt
-        self.sun_dist = coord.separation(coord_sun)
-        lst = time.sidereal_time('mean', telescope_coords.lon)
-        self.ha = lst - coord.ra # hour angle
+        if skyPositions:
+            setSkyPositions([self])
 
     def distBrightSource(self, name):
         """
@@ -268,6 +643,103 @@ class MS(object):
         self.nameMS        = self.pathMS[indexLastSlash + 1 : -3]
 
 
+    def getMetadata(self, group):
+        """
+        Return the dict of metadata "group" (see: MS.metadata_groups).
+        Values are computed once and cached in memory and in a sidecar file in the MS directory, together with
+        a key made of size and modification time of the files they come from (subtables or data managers
+        of the main table columns). They are recomputed only if those files changed.
+        """
+        subtables, columns, method = self.metadata_groups[group]
+        key = json.dumps(self._metadataKey(subtables, columns))
+        if self._metadata is None:
+            self._metadata = self._loadMetadata()
+        if group in self._metadata and self._metadata[group][0] == key:
+            return self._metadata[group][1]
+
+        values = getattr(self, method)()
+        self._metadata[group] = (key, values)
+        self._saveMetadata()
+        return values
+
+    def _metadataKey(self, subtables, columns):
+        """
+        Return the modification state of the given subtables and main table columns
+        """
+        key = []
+        for subtable in subtables:
+            path = self.pathMS + '/' + subtable
+            key += [(subtable, f, st.st_size, st.st_mtime_ns) for f, st in
+                    sorted((f, os.stat(path + '/' + f)) for f in os.listdir(path))]
+        if len(columns) > 0:
+            with tables.table(self.pathMS, ack = False) as t:
+                key.append(t.nrows())
+                files = sorted(os.listdir(self.pathMS))
+                for column in columns:
+                    prefix = 'table.f%i' % t.getdminfo(column)['SEQNR']
+                    key += [(column, f, os.stat(self.pathMS + '/' + f).st_size, os.stat(self.pathMS + '/' + f).st_mtime_ns)
+                            for f in files if f == prefix or f == prefix + 'i' or f.startswith(prefix + '_')]
+        return key
+
+    def _loadMetadata(self):
+        """
+        Read the sidecar, ignoring it if missing or unreadable. For each group the entry "group" is a json
+        string with the key, the plain values and the names of the arrays, stored in the entries "group.name"
+        """
+        metadata = {}
+        try:
+            with np.load(self.pathMS + '/' + self.metadata_file, allow_pickle=False) as f:
+                for group in self.metadata_groups:
+                    if group not in f.files: continue
+                    header = json.loads(str(f[group]))
+                    values = header['values']
+                    for name in header['arrays']:
+                        values[name] = f[group + '.' + name]
+                    metadata[group] = (header['key'], values)
+        except Exception:
+            return {}
+        return metadata
+
+    def _saveMetadata(self):
+        """
+        Write the sidecar atomically, nothing is done on read-only MSs
+        """
+        entries = {}
+        for group, (key, values) in self._metadata.items():
+            arrays = [name for name, value in values.items() if isinstance(value, np.ndarray)]
+            plain = {name: value.item() if isinstance(value, np.generic) else value
+                     for name, value in values.items() if name not in arrays}
+            entries[group] = np.array(json.dumps({'key': key, 'values': plain, 'arrays': arrays}))
+            for name in arrays:
+                entries[group + '.' + name] = values[name]
+        pathFile = self.pathMS + '/' + self.metadata_file
+        try:
+            with open('%s.%i' % (pathFile, os.getpid()), 'wb') as f:
+                np.savez(f, **entries)
+            os.replace('%s.%i' % (pathFile, os.getpid()), pathFile)
+        except OSError as e:
+            logger.debug('Cannot write metadata cache of %s: %s' % (self.pathMS, e))
+
+    def _readSubtables(self):
+        """
+        Read the metadata stored in the subtables
+        """
+        meta = {}
+        with tables.table(self.pathMS + "/SPECTRAL_WINDOW", ack = False) as t:
+            meta['freqs'] = t.getcol("CHAN_FREQ")[0]
+            meta['nchan'] = t.getcol("NUM_CHAN")
+            meta['chan_width'] = t.getcol("CHAN_WIDTH")[0]
+            meta['ref_freq'] = t.getcol("REF_FREQUENCY")[0]
+        with tables.table(self.pathMS + "/FIELD", ack = False) as t:
+            meta['phase_dir'] = t.getcol("PHASE_DIR")
+            meta['name_field'] = t.getcol("NAME")[0]
+        with tables.table(self.pathMS + "/OBSERVATION", ack = False) as t:
+            meta['telescope'] = t.getcell("TELESCOPE_NAME", 0)
+            # LOFAR only
+            meta['antenna_set'] = t.getcell("LOFAR_ANTENNA_SET", 0) if 'LOFAR_ANTENNA_SET' in t.colnames() else None
+            meta['obsid'] = t.getcell("LOFAR_OBSERVATION_ID", 0) if 'LOFAR_OBSERVATION_ID' in t.colnames() else None
+        return meta
+
     def move(self, pathMSNew, overwrite=False, keepOrig=False):
         """
         Move (or rename) the MS to another locus in the file system.
@@ -290,15 +762,15 @@ class MS(object):
         """
         pathFieldTable = self.pathMS + "/FIELD"
         tables.taql("update $pathFieldTable set NAME=$nameField")
+        if self._metadata is not None:
+            self._metadata.pop('subtables', None) # do not rely on the mtime resolution
 
 
     def getNameField(self):
         """
         Retrieve field name.
         """
-        pathFieldTable = self.pathMS + "/FIELD"
-        nameField      = (tables.taql("select NAME from $pathFieldTable")).getcol("NAME")[0]
-        return nameField
+        return self.getMetadata('subtables')['name_field']
 
 
     def getCalibratorDistancesSorted(self):
@@ -341,27 +813,238 @@ class MS(object):
         stringCurrent = stringOriginal.replace("$pathMS",        self.pathMS)
         stringCurrent = stringCurrent.replace( "$pathDirectory", self.pathDirectory)
         stringCurrent = stringCurrent.replace( "$nameMS",        self.nameMS)
-        stringCurrent = stringCurrent.replace( "$nameField",     self.getNameField())
+        if "$nameField" in stringCurrent:
+            stringCurrent = stringCurrent.replace( "$nameField", self.getNameField())
 
         return stringCurrent
 
 
+    def updateColumns(self, updates, inputs=None, like=None, chunkBytes=2**28):
+        """
+        Set columns to expressions of other columns, evaluated in-process with numpy on chunks of rows
+        aligned with the storage tiles (see: '_chunkRows()').
+        All updates are done in one pass: each input column is read once and each output column written once.
+        updates: dict (or list of pairs) column -> expression, evaluated in order, so later expressions see the
+            new values of previous ones. An expression is either a string where column names are arrays with
+            shape (rows, chans, pols) (e.g. 'DATA - MODEL_DATA', see: _parseExpression() for the grammar, it is
+            not evaluated as python), or a function getting the dict column -> array and returning the new values.
+            Values are broadcast to the column shape.
+        inputs: columns read by the functions (those used in the strings are found automatically)
+        like:   output columns that do not exist are created like this column, default: the first input
+        Return a dict with the rows, bytes read+written and time spent.
+        """
+        start = time.time()
+        updates = list(updates.items()) if isinstance(updates, dict) else list(updates)
+        nbytes = 0
+        with tables.table(self.pathMS, ack = False, readonly = False) as t:
+            colnames = t.colnames()
+            inputs = list(inputs or [])
+            parsed = []
+            for col, expr in updates:
+                if not callable(expr):
+                    expr, names = _parseExpression(expr, colnames + [u[0] for u in updates])
+                    inputs += [name for name in names if name in colnames]
+                parsed.append((col, expr))
+            inputs = list(dict.fromkeys(inputs))
+            outputs = list(dict.fromkeys([col for col, expr in updates]))
+
+            for col in outputs:
+                if col not in colnames:
+                    self.addColumnLike(t, col, like or inputs[0])
+            # virtual columns referencing the outputs take the current values, virtual outputs become real columns
+            # (without copying, they are completely written) and their current values are read from the virtual one
+            virtual = self.getVirtualColumns(t)
+            for col, refcol in virtual.items():
+                if refcol in outputs and col not in outputs:
+                    self.materialiseColumn(t, col)
+            read = {col: col for col in inputs}
+            for col in outputs:
+                if col in virtual:
+                    t.renamecol(col, col+'_VIRTUAL')
+                    self.addColumnLike(t, col, virtual[col])
+                    read[col] = col+'_VIRTUAL'
+            # shape and type of output cells, new columns with indirect storage take them from the column they are like
+            cells, sized = {}, {} # sized: column with the same cell size, to find the chunk rows
+            for col in outputs:
+                sized[col] = col
+                try:
+                    cells[col] = np.asarray(t.getcell(col, 0))
+                except RuntimeError:
+                    sized[col] = like or inputs[0]
+                    cells[col] = np.asarray(t.getcell(sized[col], 0))
+
+            nrows = t.nrows()
+            step = _chunkRows(t, [read[col] for col in inputs] + [sized[col] for col in outputs], chunkBytes)
+            for startrow in range(0, nrows, step):
+                nrow = min(step, nrows - startrow)
+                cols = {col: t.getcol(read[col], startrow, nrow) for col in inputs}
+                for col, expr in parsed:
+                    value = expr(cols) if callable(expr) else _evalExpression(expr, cols)
+                    cols[col] = np.broadcast_to(np.asarray(value, dtype=cells[col].dtype), (nrow,) + cells[col].shape)
+                for col in outputs:
+                    t.putcol(col, np.ascontiguousarray(cols[col]), startrow, nrow)
+                nbytes += sum([cols[col].nbytes for col in set(inputs + outputs)])
+            t.removecols([col+'_VIRTUAL' for col in outputs if col in virtual])
+
+        return {'rows': nrows, 'bytes': nbytes, 'time': time.time() - start}
+
+    def copyColumn(self, incol, outcol, usedysco='auto'):
+        """
+        Copy incol into outcol (see: 'copyColumn()'), creating outcol if needed
+        usedysco: for a new outcol, see: 'addColumnLike()'
+        """
+        with tables.table(self.pathMS, ack = False, readonly = False) as t:
+            if outcol in self.getVirtualColumns(t):
+                t.removecols(outcol)
+            if outcol not in t.colnames():
+                self.addColumnLike(t, outcol, incol, usedysco)
+            stats = copyColumn(t, incol, outcol)
+        logger.debug('%s: copied %s -> %s (%.0f MB/s)' % (self.nameMS, incol, outcol, stats['bytes']/1e6/stats['time']))
+        return stats
+
+    # as DP3 msout.storagemanager=dysco
+    dysco_spec = {'dataBitCount': 10, 'weightBitCount': 12, 'distribution': 'TruncatedGaussian',
+                  'distributionTruncation': 2.5, 'normalization': 'AF', 'studentTNu': 0.0}
+
+    @staticmethod
+    def addColumnLike(t, newcol, likecol, usedysco='auto', keywords=True):
+        """
+        Add to table t an (empty) column with the same description and storage manager of another column
+        usedysco: True (dysco), False (TiledColumnStMan if likecol is dysco), 'auto' (the storage policy of the role
+            of newcol, see: getColumnStorage(), if that is 'auto' the same storage manager of likecol)
+            or a storage: 'tiled', 'dysco' or 'dysco:<data bits>,<weight bits>'
+        keywords: copy also the column keywords of likecol (e.g. LOFAR_APPLIED_BEAM_MODE)
+        """
+        logger.debug('Adding column %s (like %s) to %s' % (newcol, likecol, t.name()))
+        virtual = MS.getVirtualColumns(t)
+        while likecol in virtual: likecol = virtual[likecol] # storage of the referenced column
+        coldmi = t.getdminfo(likecol)
+        coldesc = t.getcoldesc(likecol)
+        if not keywords: coldesc['keywords'] = {}
+        if usedysco == True:
+            storage = 'auto' if coldmi['TYPE'] == 'DyscoStMan' else 'dysco'
+        elif usedysco == False:
+            storage = 'tiled' if coldmi['TYPE'] == 'DyscoStMan' else 'auto'
+        elif usedysco == 'auto':
+            storage = getColumnStorage(newcol)
+        else:
+            storage = usedysco
+
+        if storage.startswith('dysco'):
+            spec = dict(MS.dysco_spec)
+            if ':' in storage:
+                spec['dataBitCount'], spec['weightBitCount'] = [int(bits) for bits in storage.split(':')[1].split(',')]
+            coldmi = {'TYPE': 'DyscoStMan', 'SPEC': spec}
+            coldesc['dataManagerType'], coldesc['dataManagerGroup'] = 'DyscoStMan', newcol
+            # dysco only stores direct (fixed shape) columns
+            if 'shape' not in coldesc: coldesc['shape'] = np.array(t.getcell(likecol, 0).shape)
+            coldesc['option'] = 5
+        elif storage == 'tiled' and coldmi['TYPE'] not in ['TiledColumnStMan', 'TiledShapeStMan']:
+            coldmi = {'TYPE': 'TiledColumnStMan', 'SPEC': {'DEFAULTTILESHAPE': np.array([4, 64, 128], dtype=np.int32)}}
+            coldesc['dataManagerType'], coldesc['dataManagerGroup'] = 'TiledColumnStMan', newcol
+        coldmi['NAME'] = newcol
+        t.addcols(tables.makecoldesc(newcol, coldesc), coldmi)
+
+    @staticmethod
+    def addVirtualColumn(t, newcol, refcol):
+        """
+        Add to table t a column that is a read-only reference to another column (a casacore virtual TaQL column):
+        it takes no space and reads the values of refcol. Before it or refcol is written it must become a real
+        column, this is done by updateColumns() and AllMSs.run() for DP3, otherwise call prepareWrite() or
+        materialiseWritten(). Programs run in other ways (e.g. wsclean and DDFacet predicts, see: lib_util.run_wsclean())
+        are not guarded: do not make them write a virtual column or the column it references.
+        """
+        logger.debug('Adding virtual column %s (= %s) to %s' % (newcol, refcol, t.name()))
+        t.addcols(tables.makecoldesc(newcol, t.getcoldesc(refcol)),
+                  {'TYPE': 'VirtualTaQLColumn', 'NAME': newcol, 'SPEC': {'TAQLCALCEXPR': refcol}})
+
+    @staticmethod
+    def getVirtualColumns(t):
+        """
+        Return a dict virtual column -> referenced column of table t
+        """
+        virtual = {}
+        for col in t.colnames():
+            dminfo = t.getdminfo(col)
+            if dminfo['TYPE'] == 'VirtualTaQLColumn':
+                virtual[col] = dminfo['SPEC']['TAQLCALCEXPR']
+        return virtual
+
+    @staticmethod
+    def materialiseColumn(t, col, copy=True):
+        """
+        Replace a virtual column of table t with a real column stored like the referenced one
+        copy: copy the values, not needed if the column is going to be completely overwritten
+        """
+        logger.debug('Materialising virtual column %s of %s' % (col, t.name()))
+        t.renamecol(col, col+'_VIRTUAL')
+        MS.addColumnLike(t, col, col+'_VIRTUAL')
+        if copy:
+            copyColumn(t, col+'_VIRTUAL', col)
+        t.removecols(col+'_VIRTUAL')
+
+    @staticmethod
+    def materialiseWritten(t, cols, overwritten=[]):
+        """
+        Before writing the columns cols of table t in-process: virtual columns among cols, or referencing
+        one of them, become real columns with the current values (see: prepareWrite() for a path).
+        overwritten: columns of cols that are going to be completely overwritten, their values are not copied
+        """
+        for col, refcol in MS.getVirtualColumns(t).items():
+            if col in cols or refcol in cols:
+                MS.materialiseColumn(t, col, copy=(col not in overwritten))
+
+    @staticmethod
+    def getColumnBytes(t):
+        """
+        Return a dict column -> bytes on disk of table t (files of its data manager),
+        columns sharing a data manager share its size equally, virtual columns take nothing
+        """
+        files = [f for f in os.listdir(t.name()) if os.path.isfile(t.name() + '/' + f)]
+        managers = {}
+        for col in t.colnames():
+            dminfo = t.getdminfo(col)
+            if dminfo['TYPE'] == 'VirtualTaQLColumn': continue
+            managers.setdefault(dminfo['SEQNR'], []).append(col)
+        colbytes = dict.fromkeys(t.colnames(), 0)
+        for seqnr, cols in managers.items():
+            prefix = 'table.f%i' % seqnr
+            nbytes = sum([os.path.getsize(t.name() + '/' + f) for f in files
+                          if f == prefix or f == prefix + 'i' or f.startswith(prefix + '_')])
+            for col in cols:
+                colbytes[col] = nbytes / len(cols)
+        return colbytes
+
+    def prepareWrite(self, cols):
+        """
+        Call before an external program writes the columns cols of this MS: virtual columns among cols,
+        or referencing one of them, become real columns with the current values. Missing columns with
+        a storage policy (see: getColumnStorage()) are created like DATA, so that the program fills them,
+        but without the keywords of DATA: the beam keywords would say that the beam is applied to a new model.
+        """
+        with tables.table(self.pathMS, ack = False) as t:
+            virtual = self.getVirtualColumns(t)
+            colnames = t.colnames()
+        toMaterialise = [col for col, refcol in virtual.items() if col in cols or refcol in cols]
+        toCreate = [col for col in cols if col not in colnames and getColumnStorage(col) != 'auto']
+        if len(toMaterialise) > 0 or len(toCreate) > 0:
+            with tables.table(self.pathMS, ack = False, readonly = False) as t:
+                self.materialiseWritten(t, cols)
+                for col in toCreate:
+                    self.addColumnLike(t, col, 'DATA', keywords=False)
+
     def getFreqs(self):
         """
         Get chan frequencies in Hz
         """
-        with tables.table(self.pathMS + "/SPECTRAL_WINDOW", ack = False) as t:
-            freqs = t.getcol("CHAN_FREQ")
-
-        return freqs[0]
+        return self.getMetadata('subtables')['freqs']
 
 
     def getNchan(self):
         """
         Find number of channels
         """
-        with tables.table(self.pathMS + "/SPECTRAL_WINDOW", ack = False) as t:
-            nchan = t.getcol("NUM_CHAN")
+        nchan = self.getMetadata('subtables')['nchan']
         assert (nchan[0] == nchan).all() # all SpWs have same channels?
 
         #logger.debug("%s: channel number: %i", self.pathMS, nchan[0])
@@ -372,36 +1055,54 @@ class MS(object):
         """
         Find bandwidth of a channel in Hz
         """
-        with tables.table(self.pathMS + "/SPECTRAL_WINDOW", ack = False) as t:
-            chan_w = t.getcol("CHAN_WIDTH")[0]
+        chan_w = self.getMetadata('subtables')['chan_width']
         assert all(x == chan_w[0] for x in chan_w) # all chans have same width
 
         #logger.debug("%s: channel width (MHz): %f", self.pathMS, chan_w[0] / 1.e6)
         return chan_w[0]
 
 
+    def getTimeIndex(self):
+        """
+        Return a dict with arrays: times (sorted unique timestamps), rowstart (first row of each timestamp),
+        nrows (rows of each timestamp) and the bool ordered (if the rows are sorted in time, then the rows
+        of times[i] are rowstart[i]:rowstart[i]+nrows[i]). Cached in the metadata (see: getMetadata()).
+        """
+        return self.getMetadata('time')
+
+    def _readTimeIndex(self):
+        """
+        Build the time index with one TaQL pass
+        """
+        with tables.table(self.pathMS, ack = False) as t:
+            with tables.taql('select TIME, gmin(rownumber()) as ROWSTART, gmax(rownumber()) as ROWEND, gcount() as NROWS '
+                             'from $t groupby TIME orderby TIME') as ti:
+                index = {'times': ti.getcol('TIME'), 'rowstart': ti.getcol('ROWSTART'), 'nrows': ti.getcol('NROWS')}
+                rowend = ti.getcol('ROWEND')
+        index['ordered'] = bool(np.all(rowend - index['rowstart'] + 1 == index['nrows']) and
+                                np.all(index['rowstart'][1:] == rowend[:-1] + 1))
+        return index
+
     def getTimeRange(self):
         """
         Return the time interval of this observation
         """
-        with tables.table(self.pathMS, ack = False) as t:
-            return ( t.getcol("TIME")[0], t.getcol("TIME")[-1] )
+        times = self.getTimeIndex()['times']
+        return ( times[0], times[-1] )
 
 
     def getNtime(self):
         """
         Returns the number of time slots in this MS
         """
-        with tables.table(self.pathMS, ack = False) as t:
-            return len(np.unique(t.getcol("TIME")))
+        return len(self.getTimeIndex()['times'])
 
 
     def getTimeInt(self):
         """
         Get time interval in seconds
         """
-        with tables.table(self.pathMS, ack = False) as t:
-            nTimes = len(set(t.getcol("TIME")))
+        nTimes = self.getNtime()
         t_init, t_end = self.getTimeRange()
         deltaT = (t_end - t_init) / nTimes
 
@@ -415,8 +1116,7 @@ class MS(object):
         """
         field_no = 0
         ant_no   = 0
-        with tables.table(self.pathMS + "/FIELD", ack = False) as field_table:
-            direction = field_table.getcol("PHASE_DIR")
+        direction = self.getMetadata('subtables')['phase_dir']
         RA        = direction[ant_no, field_no, 0]
         Dec       = direction[ant_no, field_no, 1]
 
@@ -430,8 +1130,7 @@ class MS(object):
         """
         Return telescope name such as "LOFAR" or "GMRT"
         """
-        with tables.table(self.pathMS+'/OBSERVATION', ack = False) as t:
-            return t.getcell("TELESCOPE_NAME",0)
+        return self.getMetadata('subtables')['telescope']
 
     def getAntennaSet(self):
         """
@@ -440,15 +1139,13 @@ class MS(object):
         if self.getTelescope() != 'LOFAR':
             raise("Only LOFAR has Antenna Sets.")
 
-        with tables.table(self.pathMS+'/OBSERVATION', ack = False) as t:
-            return t.getcell("LOFAR_ANTENNA_SET",0)
+        return self.getMetadata('subtables')['antenna_set']
 
     def getObsID(self):
         """
         Return LOFAR observation ID
         """
-        with tables.table(self.pathMS+'/OBSERVATION', ack = False) as t:
-            return int(t.getcell("LOFAR_OBSERVATION_ID",0))
+        return int(self.getMetadata('subtables')['obsid'])
 
     def getFWHM(self, freq='mid'):
         """
@@ -465,19 +1162,21 @@ class MS(object):
         else:
             raise "Wrong freq value for beam size, use: min|mid|max."
 
-        if self.getTelescope() == 'LOFAR':
+        telescope = self.getTelescope()
+        if telescope == 'LOFAR':
 
             # Following numbers are based at 60 MHz (old.astron.nl/radio-observatory/astronomers/lofar-imaging-capabilities-sensitivity/lofar-imaging-capabilities/lofa)
             scale = 60e6/beamfreq 
 
-            if 'OUTER' in self.getAntennaSet():
+            antennaSet = self.getAntennaSet()
+            if 'OUTER' in antennaSet:
                 return 3.88*scale
-            elif 'SPARSE' in self.getAntennaSet():
+            elif 'SPARSE' in antennaSet:
                 return 4.85*scale
-            elif 'INNER' in self.getAntennaSet():
+            elif 'INNER' in antennaSet:
                 return 9.77*scale
                 
-        elif self.getTelescope() == 'GMRT':
+        elif telescope == 'GMRT':
             # equation from http://gmrt.ncra.tifr.res.in/gmrt_hpage/Users/doc/manual/Manual_2013/manual_20Sep2013.pdf    
             return (85.2/60) * (325.e6 / beamfreq)
 
@@ -518,19 +1217,50 @@ class MS(object):
         lib_util.check_rm(outfile)
         regions.write(outfile)
 
-    def getMaxBL(self, check_flags=True):
+    def getBaselines(self, check_flags=True):
         """
-        Return the max BL length in meters
+        Return a dict with arrays: ant1, ant2 and uvmax, the max uv distance in meters of each baseline
+        (nan if the baseline is fully flagged). Cached in the metadata (see: getMetadata()).
+        check_flags: if True ignore completely flagged rows
         """
         if check_flags:
-            with tables.table(self.pathMS, ack = False).query('not all(FLAG)') as t:
-                col = t.getcol('UVW')
-        else:
-            with tables.table(self.pathMS, ack = False) as t:
-                col = t.getcol('UVW')
+            return self.getMetadata('baselines_unflagged')
+        return self.getMetadata('baselines')
+
+    baselines_ntimes = 32 # timestamps read by _readBaselines()
+
+    def _readBaselines(self, check_flags=False):
+        """
+        Summarise UVW per baseline on baselines_ntimes timestamps spread over the observation (first and last
+        included), only their rows are read. The uv distance changes slowly with time: for an 8 h observation
+        the max over these samples is within 0.1% of the max over all timestamps.
+        """
+        index = self.getTimeIndex()
+        samples = np.unique(np.round(np.linspace(0, len(index['times']) - 1, self.baselines_ntimes)).astype(int))
+        # gmax() of only negative values gives the smallest positive double, fully flagged baselines are found by gall()
+        select = 'gmax(sqrt(sumsqr(UVW[0:2]))) as UVMAX, False as FLAGGED'
+        if check_flags: select = 'gmax(iif(all(FLAG), 0., sqrt(sumsqr(UVW[0:2])))) as UVMAX, gall(all(FLAG)) as FLAGGED'
+        with tables.table(self.pathMS, ack = False) as t:
+            if index['ordered']:
+                ts = t.selectrows(np.concatenate([np.arange(index['rowstart'][i], index['rowstart'][i] + index['nrows'][i])
+                                                  for i in samples]))
+            else:
+                times = index['times'][samples]
+                ts = tables.taql('select from $t where TIME in $times')
+            with tables.taql('select ANTENNA1, ANTENNA2, %s from $ts groupby ANTENNA1, ANTENNA2' % select) as b:
+                baselines = {'ant1': b.getcol('ANTENNA1'), 'ant2': b.getcol('ANTENNA2'), 'uvmax': b.getcol('UVMAX')}
+                baselines['uvmax'][b.getcol('FLAGGED')] = np.nan
+            ts.close()
+        return baselines
+
+    def _readBaselinesUnflagged(self):
+        return self._readBaselines(check_flags=True)
 
-        maxdist = np.nanmax( np.sqrt(col[:,0] ** 2 + col[:,1] ** 2) )
-        return maxdist
+    def getMaxBL(self, check_flags=True):
+        """
+        Return the max BL length in meters
+        """
+        return np.nanmax( self.getBaselines(check_flags)['uvmax'] )
 
     def getResolution(self, check_flags=True):
         """
@@ -539,8 +1269,7 @@ class MS(object):
         """
         c = 299792458. # in metres per second
 
-        with tables.table(self.pathMS+'/SPECTRAL_WINDOW', ack = False) as t:
-            wavelength = c / t.getcol('REF_FREQUENCY')[0]             # in metres
+        wavelength = c / self.getMetadata('subtables')['ref_freq']             # in metres
         #print 'Wavelength:', wavelength,'m (Freq: '+str(t.getcol('REF_FREQUENCY')[0]/1.e6)+' MHz)'
         
         maxdist = self.getMaxBL(check_flags)
@@ -548,16 +1277,34 @@ class MS(object):
         #return int(round(wavelength / maxdist * (180 / np.pi) * 3600)) # in arcseconds
         return float('%.1f'%(wavelength / maxdist * (180 / np.pi) * 3600)) # in arcsec
 
-    def isAllFlagged(self):
+    def isAllFlagged(self, cache=True, chunkSize=2**24):
         """
         Is the dataset fully flagged?
+        The FLAG column is read in chunks of about chunkSize samples, stopping at the first unflagged one.
+        cache: if True use the result cached in the metadata, as long as FLAG is not modified (see: getMetadata())
         """
-        try:
-            with tables.table(self.pathMS, ack = False) as t:
-                return np.all(t.getcol('FLAG'))
-        except MemoryError: # can happen e.g. for full MS in timesplit (with IS and/or HBA)
-            logger.warning('Caugt MemoryError in checking for fully flagged MS! This can happen when working with large '
-                           'measurement sets. You might want to manually inspect the flags. Trying to proceed...')
+        if cache:
+            return self.getMetadata('flags')['all_flagged']
+        return self._readFlags(chunkSize)['all_flagged']
+
+    def _readFlags(self, chunkSize=2**24):
+        """
+        Scan the FLAG column with constant memory
+        """
+        with tables.table(self.pathMS, ack = False) as t:
+            nrows = t.nrows()
+            if nrows == 0:
+                return {'all_flagged': True}
+            rowSize = np.prod(t.getcell('FLAG', 0).shape)
+            # start small, usually some data are unflagged already at the beginning
+            step, maxStep = max(1, 2**16 // rowSize), max(1, chunkSize // rowSize)
+            startrow = 0
+            while startrow < nrows:
+                if not np.all(t.getcol('FLAG', startrow, step)):
+                    return {'all_flagged': False}
+                startrow += step
+                step = min(2*step, maxStep)
+        return {'all_flagged': True}
 
 #    def delBeamInfo(self, col=None):
 #        """
@@ -34,6 +34,7 @@
 import sys
 import logging
 import multiprocessing
+from functools import reduce
 
 
 class multiprocManager(object):
@@ -109,3 +110,22 @@ class multiprocManager(object):
 
         # wait for all jobs to finish
         self.inQueue.join()
+
+
+def poolRun(func, args, procs=1, merge=None):
+    """
+    Call func(*arg) for each arg in args in a pool of procs forked processes (so func can be any python function).
+    Return the list of results or, if merge is given, the results merged with merge(result1, result2) as they come.
+    """
+    with multiprocessing.get_context('fork').Pool(max(1, min(procs, len(args)))) as pool:
+        results = pool.imap(_call, [(func,) + tuple(arg) for arg in args])
+        if merge is None:
+            return list(results)
+        return reduce(merge, results)
+
+
+def _call(job):
+    """
+    Return job[0](*job[1:]), for Pool.imap()
+    """
+    return job[0](*job[1:])
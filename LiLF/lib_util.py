@@ -1,11 +1,10 @@
-import os, sys, re, time, pickle, random, shutil, glob
+import os, sys, re, time, pickle, random, shutil, glob, json, signal, hashlib
 import socket
 
 from casacore import tables
 import numpy as np
 import multiprocessing, subprocess
-from threading import Thread
-from queue import Queue
+from threading import Thread, Condition, Lock
 import pyregion
 import gc
 
@@ -40,6 +39,7 @@ def getParset(parsetFile='../lilf.config'):
     if not config.has_section('flag'): config.add_section('flag')
     if not config.has_section('model'): config.add_section('model')
     if not config.has_section('PiLL'): config.add_section('PiLL')
+    if not config.has_section('columns'): config.add_section('columns')
 
     ### LOFAR ###
 
@@ -112,6 +112,11 @@ def getParset(parsetFile='../lilf.config'):
     add_default('model', 'fits_model', '')
     add_default('model', 'apparent', 'False')
     add_default('model', 'userReg', '')
+    # columns: storage of new intermediate columns by role (see: lib_ms.getColumnStorage())
+    # auto (as the column they are made from), tiled, dysco or dysco:<data bits>,<weight bits>
+    add_default('columns', 'model', 'auto')
+    add_default('columns', 'residual', 'auto')
+    add_default('columns', 'smoothed', 'auto')
 
     return config
 
@@ -308,11 +313,24 @@ def run_losoto(s, c, h5s, parsets, plots_dir=None) -> object:
         check_rm('plots')
 
 
+def run_blsmooth(s, logfile, MSs_files, options=''):
+    """
+    s : scheduler
+    logfile : log file name
+    MSs_files : string of MS paths, all smoothed by a single BLsmooth job
+    options : BLsmooth options, e.g. "-r -i DATA -o SMOOTHED_DATA"
+    The job uses all the processors of the node, do not set -n in the options.
+    """
+    s.add('BLsmooth.py -n %i %s %s' % (s.max_processors, options, MSs_files), log=logfile, commandType='python', processors='max')
+    s.run(check=True)
+
+
 def run_wsclean(s, logfile, MSs_files, do_predict=False, **kwargs):
     """
     s : scheduler
     args : parameters for wsclean, "_" are replaced with "-", any parms=None is ignored.
            To pass a parameter with no values use e.g. " no_update_model_required='' "
+    wsclean writes MODEL_DATA, which must not be a virtual column or referenced by one (see: lib_ms.MS.addVirtualColumn())
     """
     
     wsc_parms = []
@@ -379,6 +397,7 @@ def run_DDF(s, logfile, **kwargs):
     s : scheduler
     args : parameters for ddfacet, "_" are replaced with "-", any parms=None is ignored.
            To pass a parameter with no values use e.g. " no_update_model_required='' "
+    The Predict_ColName column must not be a virtual column or referenced by one (see: lib_ms.MS.addVirtualColumn())
     """
     
     ddf_parms = []
@@ -480,37 +499,96 @@ class Walker():
     with w.if_todo("stepname"):
         Do whatever...
 
+    A step can also declare what it depends on, then it is re-done if any of those changed since it was completed:
+    with w.if_todo("stepname", inputs=['mss/TC00.MS:DATA', 'cal.h5'], outputs=['img/wide-MFS-image.fits'], params={'niter':1000}):
+        Do whatever...
+
     Adopted from https://stackoverflow.com/questions/12594148/skipping-execution-of-with-block
     """
+    current_step = None # step being executed, used by the Scheduler to label its accounting
+    step_end_callbacks = [] # functions called with the step name when an executed step completes (e.g. lib_ms.TempColumns)
+
     def __init__(self, filename):
         open(filename, 'a').close() # create the file if doesn't exists
         self.filename = os.path.abspath(filename)
         self.__skip__ = False
         self.__step__ = None
+        self.__deps__ = None # (inputs, params) of the current step
+        self.__trace__ = None # (frame, frame trace, global trace) to restore after a skip
+        # each line is "stepname" or "stepname<tab>hash of the inputs", the last line of a step wins
+        self.done = {}
+        with open(self.filename, "r") as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                self.done[fields[0]] = fields[1] if len(fields) > 1 else None
 
-    def if_todo(self, stepname):
+    def fingerprint(self, item):
+        """
+        Cheap fingerprint of a file, directory or MS column ("path.MS:COLUMN"):
+        size and modification time of the files (only the top level of directories,
+        for a column only the files of its data manager). Content is never read.
+        """
+        path, col = item, None
+        if ':' in item and not os.path.exists(item):
+            path, col = item.rsplit(':', 1)
+        if not os.path.exists(path):
+            return [item, 'missing']
+        if os.path.isfile(path):
+            return [item, os.path.getsize(path), os.path.getmtime(path)]
+
+        files = sorted(os.listdir(path))
+        if col is not None:
+            with tables.table(path, ack = False) as t:
+                seqnr = t.getdminfo(col)['SEQNR']
+            files = [f for f in files if re.match(r'table\.f%i(i|_TSM\d+)?$' % seqnr, f)]
+        stats = [os.stat(os.path.join(path, f)) for f in files]
+        return [item] + [[f, st.st_size, st.st_mtime] for f, st in zip(files, stats)]
+
+    def hash(self, inputs, params):
+        """
+        Return a hash of the fingerprints of the inputs and of the parameters
+        """
+        fingerprints = [self.fingerprint(item) for f in inputs for item in (sorted(glob.glob(f)) or [f])]
+        return hashlib.md5(json.dumps([fingerprints, params], sort_keys=True, default=str).encode()).hexdigest()
+
+    def if_todo(self, stepname, inputs = None, outputs = None, params = None):
         """
         This is basically a way to get a context manager to accept an argument. Will return "self" as context manager
         if called as context manager.
+        inputs:  list of files, directories or MS columns ("path.MS:COLUMN") read by the step, glob patterns are expanded
+        outputs: list of files or directories created by the step, the step is re-done if any is missing
+        params:  dict (or other json-serialisable object) of the parameters of the step
+        If any of them is given, a completed step is skipped only if inputs and params are the same as
+        when it was completed (steps completed before this check was available are always skipped).
         """
-        self.__skip__ = False
         self.__step__ = stepname
-        with open(self.filename, "r") as f:
-            for stepname_done in f:
-                if stepname == stepname_done.rstrip():
-                    self.__skip__ = True
+        self.__deps__ = None
+        self.__skip__ = stepname in self.done
+        if inputs is None and outputs is None and params is None:
+            return self
+
+        self.__deps__ = (inputs or [], params)
+        if self.__skip__ and any([len(glob.glob(f)) == 0 for f in outputs or []]):
+            logger.info('Outputs of {} are missing, re-doing it.'.format(stepname))
+            self.__skip__ = False
+        elif self.__skip__ and self.done[stepname] is not None and self.done[stepname] != self.hash(*self.__deps__):
+            logger.info('Inputs or parameters of {} changed, re-doing it.'.format(stepname))
+            self.__skip__ = False
         return self
 
     def __enter__(self):
         """
         Skips body of with-statement if __skip__.
-        This uses some kind of dirty hack that might only work in CPython.
+        This uses some kind of dirty hack that might only work in CPython: a trace function is set only
+        for the calling frame and only until the body is skipped, then the previous tracing is restored.
         """
         if self.__skip__:
-            sys.settrace(lambda *args, **keys: None)
             frame = sys._getframe(1)
+            self.__trace__ = (frame, frame.f_trace, sys.gettrace())
+            sys.settrace(lambda *args, **keys: None)
             frame.f_trace = self.trace
         else:
+            Walker.current_step = self.__step__
             logger.log(20, '>> start >> {}'.format(self.__step__))
 
 
@@ -521,9 +599,26 @@ class Walker():
         """
         Catch "Skip" errors, if not skipped, write to file after exited without exceptions.
         """
+        ended_step = Walker.current_step
+        Walker.current_step = None
+        if self.__trace__ is not None:
+            frame, frame_trace, global_trace = self.__trace__
+            frame.f_trace = frame_trace
+            sys.settrace(global_trace)
+            self.__trace__ = None
+        # a failed step keeps its state (e.g. temporary columns) for inspection
+        if ended_step is not None and type is None:
+            for callback in Walker.step_end_callbacks:
+                try:
+                    callback(ended_step)
+                except Exception as e:
+                    logger.warning('End of step {}: {}'.format(ended_step, e))
         if type is None:
+            # hash the inputs as left by the step, which may have modified them
+            stephash = None if self.__deps__ is None else self.hash(*self.__deps__)
             with open(self.filename, "a") as f:
-                f.write(self.__step__ + '\n')
+                f.write(self.__step__ + ('\n' if stephash is None else '\t' + stephash + '\n'))
+            self.done[self.__step__] = stephash
             logger.info('<< done << {}'.format(self.__step__))
             return  # No exception
         if issubclass(type, Skip):
@@ -531,13 +626,23 @@ class Walker():
             return True  # Suppress special SkipWithBlock exception
 
 class Scheduler():
-    def __init__(self, qsub = None, maxThreads = None, max_processors = None, log_dir = 'logs', dry = False):
+    # default resources (processors, memory in GB) of a command given its commandType
+    # processors=None means all the processors of the node
+    default_resources = {'dp3': (1, 2.), 'wsclean': (None, 0.), 'ddfacet': (None, 0.), 'ddf': (None, 0.),
+                         'singularity': (None, 0.), 'casa': (1, 2.), 'python': (1, 1.), 'general': (1, 0.5)}
+
+    def __init__(self, qsub = None, maxThreads = None, max_processors = None, max_memory = None, log_dir = 'logs', dry = False,
+                 failfast = False, backend = None):
         """
         qsub:           if true call a shell script which call qsub and then wait
                         for the process to finish before returning
         maxThreads:    max number of parallel processes
         dry:            don't schedule job
         max_processors: max number of processors in a node (ignored if qsub=False)
+        max_memory:     max memory (GB) usable in a node, if None use the total RAM of the node
+        failfast:       default of Scheduler.run(failfast=...)
+        backend:        object submitting the commands to a queue system (e.g. SlurmBackend()),
+                        if None run them on this node (default on Hamburg with qsub: SlurmBackend())
         """
         self.cluster = self.get_cluster()
         self.log_dir = log_dir
@@ -572,11 +677,26 @@ class Scheduler():
         else:
             self.max_processors = max_processors
 
+        if (max_memory == None):
+            self.max_memory = self.get_node_memory()
+        else:
+            self.max_memory = max_memory
+
         self.dry = dry
+        self.failfast = failfast
+        self.backend = backend
+        if (self.backend == None and self.qsub and self.cluster == "Hamburg"):
+            self.backend = SlurmBackend()
         logger.info("Scheduler initialised for cluster " + self.cluster + " (maxThreads: " + str(self.maxThreads) + ", qsub (multinode): " +
-                     str(self.qsub) + ", max_processors: " + str(self.max_processors) + ").")
+                     str(self.qsub) + ", max_processors: " + str(self.max_processors) + ", max_memory: %.0f GB)." % self.max_memory)
 
-        self.action_list = []
+        # append-only accounting of the resources used by each command, one json per line
+        self.ledger = self.log_dir + '/scheduler-ledger.jsonl'
+        self.ledger_lock = Lock()
+
+        self.log_checker = LogChecker()
+
+        self.action_list = [] # list of dicts with keys: cmd, processors, memory, commandType, log, ms, step
         self.log_list    = []  # list of 2-tuples of the type: (log filename, type of action)
 
 
@@ -602,7 +722,53 @@ class Scheduler():
             return "Unknown"
 
 
-    def add(self, cmd = '', log = '', logAppend = True, commandType = '', processors = None):
+    def get_node_memory(self):
+        """
+        Return the total RAM of the node in GB
+        """
+        try:
+            with open('/proc/meminfo') as f:
+                for line in f:
+                    if line.startswith('MemTotal:'):
+                        return int(line.split()[1])/1024.**2 # kB -> GB
+        except IOError:
+            pass
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')/1024.**3
+
+
+    def get_resources(self, cmd, commandType = '', processors = None, memory = None):
+        """
+        Return the (processors, memory) a command needs, capped to the node budget.
+        Not declared processors are read from the command line (DP3 numthreads=, wsclean -j, DDF --Parallel-NCPU)
+        or taken from the commandType default; not declared memory (GB) is the commandType default.
+        """
+        default_processors, default_memory = self.default_resources.get(commandType.lower(), (1, 0.))
+
+        if (processors == None):
+            if commandType == 'DP3':
+                found = re.findall(r'numthreads=(\d+)', cmd)
+            elif commandType == 'wsclean':
+                found = re.findall(r'-j\s+(\d+)', cmd)
+            elif commandType.lower() == 'ddfacet' or commandType.lower() == 'ddf':
+                found = re.findall(r'--Parallel-NCPU[=\s]+(\d+)', cmd)
+            else:
+                found = []
+            if len(found) > 0:
+                processors = int(found[-1])
+            elif default_processors is None:
+                processors = self.max_processors
+            else:
+                processors = default_processors
+        elif processors == 'max':
+            processors = self.max_processors
+
+        if (memory == None):
+            memory = default_memory
+
+        return min(max(int(processors), 1), self.max_processors), min(float(memory), self.max_memory)
+
+
+    def add(self, cmd = '', log = '', logAppend = True, commandType = '', processors = None, memory = None, ms = ''):
         """
         Add a command to the scheduler list
         cmd:         the command to run
@@ -610,6 +776,9 @@ class Scheduler():
         logAppend:  if True append, otherwise replace
         commandType: can be a list of known command types as "BBS", "DP3", ...
         processors:  number of processors to use, can be "max" to automatically use max number of processors per node
+                     if None it is guessed from the command and the commandType (see: get_resources())
+        memory:      memory (GB) used by the command, if None use the default of the commandType
+        ms:          name of the MS the command works on, used in the accounting ledger
         """
 
         if (log != ''):
@@ -632,78 +801,199 @@ class Scheduler():
         elif commandType == 'python':
             logger.debug('Running python: %s' % cmd)
 
-        if (processors != None and processors == 'max'):
-            processors = self.max_processors
-
-        if self.qsub:
-            # if number of processors not specified, try to find automatically
-            if (processors == None):
-                processors = 1 # default use single CPU
-                if ("DP3" == cmd[ : 4]):
-                    processors = 1
-                if ("wsclean" == cmd[ : 7]):
-                    processors = self.max_processors
-            if (processors > self.max_processors):
-                processors = self.max_processors
-
-            self.action_list.append([str(processors), '\'' + cmd + '\''])
-        else:
-            self.action_list.append(cmd)
+        processors, memory = self.get_resources(cmd, commandType, processors, memory)
+        self.action_list.append({'cmd': cmd, 'processors': processors, 'memory': memory, 'commandType': commandType,
+                                 'log': log, 'ms': ms, 'step': Walker.current_step})
 
         if (log != ""):
             self.log_list.append((log, commandType))
 
 
-    def run(self, check = False, maxThreads = None):
+    def run(self, check = False, maxThreads = None, failfast = None):
         """
         If 'check' is True, a check is done on every log in 'self.log_list'.
         If max_thread != None, then it overrides the global values, useful for special commands that need a lower number of threads.
+        Commands are started in order as long as their processors and memory fit in what is left
+        of the node budget (max_processors, max_memory); a command that does not fit lets the following
+        smaller ones start first. With a backend (e.g. SlurmBackend) the commands are instead submitted
+        to the queue system, which handles the budget.
+        If 'failfast' is True (default: Scheduler.failfast), logs and exit status of the running commands are
+        watched: at the first failure no more commands are started, the running ones are terminated
+        and a RuntimeError naming the failed command is raised.
         """
 
-        def worker(queue):
-            for cmd in iter(queue.get, None):
-                if self.qsub and self.cluster == "Hamburg":
-                    cmd = 'salloc --job-name LBApipe --time=24:00:00 --nodes=1 --tasks-per-node='+cmd[0]+\
-                            ' /usr/bin/srun --ntasks=1 --nodes=1 --preserve-env \''+cmd[1]+'\''
-                gc.collect()
-                subprocess.call(cmd, shell = True)
-
         # limit threads only when qsub doesn't do it
         if (maxThreads == None):
             maxThreads_run = self.maxThreads
         else:
             maxThreads_run = min(maxThreads, self.maxThreads)
 
-        q       = Queue()
-        threads = [Thread(target = worker, args=(q,)) for _ in range(maxThreads_run)]
+        if (failfast == None):
+            failfast = self.failfast
 
-        for i, t in enumerate(threads): # start workers
-            t.daemon = True
-            t.start()
+        actions = [] if self.dry else self.action_list # don't schedule if dry run
+        if self.backend is None:
+            pending, failed = self.run_local(actions, maxThreads_run, failfast)
+        else:
+            pending, failed = self.backend.run(self, actions, maxThreads_run, failfast)
 
-        for action in self.action_list:
-            if (self.dry):
-                continue # don't schedule if dry run
-            q.put_nowait(action)
-        for _ in threads:
-            q.put(None) # signal no more commands
-        for t in threads:
-            t.join()
+        log_list = self.log_list
+
+        # reset list of commands
+        self.action_list = []
+        self.log_list    = []
+
+        if len(failed) > 0:
+            action, reason = failed[0]
+            logger.error('Command failed (%s), %i not started: %s' % (reason, len(pending), action['cmd']))
+            raise RuntimeError('Command failed (%s): %s' % (reason, action['cmd']))
 
         # check outcomes on logs
         if (check):
-            for log, commandType in self.log_list:
+            for log, commandType in dict.fromkeys(log_list): # check each log only once
                 self.check_run(log, commandType)
 
-        # reset list of commands
-        self.action_list = []
-        self.log_list    = []
+
+    def run_local(self, actions, maxThreads_run, failfast):
+        """
+        Run the commands on this node, see run()
+        Return the list of commands not started and the list of failures as (action, reason)
+        """
+        poll = 2 if failfast else None # seconds between log checks
+        live_checker = LogChecker()
+
+        cond = Condition()
+        free = {'processors': self.max_processors, 'memory': self.max_memory, 'threads': maxThreads_run}
+        running = []
+        failed = [] # list of (action, reason)
+
+        def fits(action):
+            if free['threads'] == 0: return False
+            if self.qsub: return True
+            # a command that alone would exceed the budget is anyway run when nothing else is running
+            if free['threads'] == maxThreads_run: return True
+            return action['processors'] <= free['processors'] and action['memory'] <= free['memory']
+
+        def watch():
+            # look for failures in what the running commands wrote since the last look
+            for action in running:
+                if action['log'] == '' or not live_checker.known(action['commandType']): continue
+                failures = live_checker.check(action['log'], action['commandType'], live=True)
+                if len(failures) > 0:
+                    failed.append((action, '%s: %s' % (failures[0]['reason'], failures[0]['line'])))
+                    return
+
+        def worker(action):
+            gc.collect()
+            usage = {'returncode': 0}
+            try:
+                usage = self.execute(action['cmd'], new_session = failfast, on_start = lambda p: action.update(process = p))
+                self.account(action, usage)
+            finally:
+                with cond:
+                    if failfast and usage['returncode'] != 0 and len(failed) == 0:
+                        failed.append((action, 'exit status %i' % usage['returncode']))
+                    elif failfast and len(failed) == 0 and os.path.exists(action['log']) and live_checker.known(action['commandType']):
+                        # what was written after the last watch(), required lines are left to check_run()
+                        failures = [f for f in live_checker.check(action['log'], action['commandType']) if f['line'] is not None]
+                        if len(failures) > 0:
+                            failed.append((action, '%s: %s' % (failures[0]['reason'], failures[0]['line'])))
+                    running.remove(action)
+                    free['processors'] += action['processors']
+                    free['memory'] += action['memory']
+                    free['threads'] += 1
+                    cond.notify_all()
+
+        pending = list(actions)
+        threads = []
+        with cond:
+            while len(pending) > 0 and len(failed) == 0:
+                action = next((a for a in pending if fits(a)), None)
+                if action is None:
+                    cond.wait(poll)
+                    if failfast: watch()
+                    continue
+                pending.remove(action)
+                free['processors'] -= action['processors']
+                free['memory'] -= action['memory']
+                free['threads'] -= 1
+                if failfast and action['log'] != '' and os.path.exists(action['log']):
+                    live_checker.offsets[action['log']] = os.path.getsize(action['log']) # ignore older content of appended logs
+                running.append(action)
+                t = Thread(target = worker, args=(action,))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+            while failfast and len(running) > 0 and len(failed) == 0:
+                cond.wait(poll)
+                watch()
+
+            if len(failed) > 0:
+                for action in running:
+                    if 'process' not in action: continue
+                    logger.warning('Terminating: %s' % action['cmd'])
+                    try:
+                        os.killpg(action['process'].pid, signal.SIGTERM)
+                    except (ProcessLookupError, PermissionError):
+                        pass
+        for t in threads:
+            t.join()
+
+        return pending, failed
+
+
+    def execute(self, cmd, new_session = False, on_start = None):
+        """
+        Run a shell command and wait for it.
+        new_session: run the command in its own process group, so that it can be terminated with all its children
+        on_start:    function called with the Popen object once the command started
+        Return a dict with the exit code and the resources used by the command and its children:
+        wall/user/system time (s), peak RSS (MB) and bytes read/written from storage.
+        """
+        start = time.time()
+        p = subprocess.Popen(cmd, shell = True, start_new_session = new_session)
+        if on_start is not None: on_start(p)
+        # wait without reaping, so that /proc still has the I/O counters of the finished process
+        os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+        io = {}
+        try:
+            with open('/proc/%i/io' % p.pid) as f:
+                for line in f:
+                    key, val = line.split(':')
+                    io[key] = int(val)
+        except (IOError, ValueError):
+            pass
+        _, status, rusage = os.wait4(p.pid, 0)
+        p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+        return {'returncode': p.returncode, 'wall': time.time() - start,
+                'utime': rusage.ru_utime, 'stime': rusage.ru_stime, 'maxrss': rusage.ru_maxrss/1024., # kB -> MB
+                'read_bytes': io.get('read_bytes', rusage.ru_inblock*512),
+                'write_bytes': io.get('write_bytes', rusage.ru_oublock*512)}
+
+
+    def account(self, action, usage):
+        """
+        Append the resources used by a command to the ledger
+        """
+        record = {'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - usage['wall'])),
+                  'step': action['step'], 'ms': action['ms'], 'commandType': action['commandType'],
+                  'processors': action['processors'], 'memory': action['memory'], 'log': action['log'],
+                  'cmd': action['cmd']}
+        record.update(usage)
+        with self.ledger_lock:
+            try:
+                with open(self.ledger, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            except IOError:
+                logger.warning('Cannot write accounting ledger: ' + self.ledger)
 
 
     def check_run(self, log = "", commandType = ""):
         """
         Produce a warning if a command didn't close the log properly i.e. it crashed
-        NOTE: grep, -L inverse match, -l return only filename
+        Only the part of the log written since the last check is read (see: LogChecker)
         # TODO add commandType=DDFacet consistently to pipelines, check for keywords
         """
 
@@ -711,59 +1001,238 @@ class Scheduler():
             logger.warning("No log file found to check results: " + log)
             return 1
 
-        if (commandType == "DP3"):
-            out = subprocess.check_output('grep -L "Finishing processing" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "Segmentation fault\|Killed" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            # TODO: This needs to be uncommented once the malloc_consolidate stuff is fixed
-            # out += subprocess.check_output('grep -l "Aborted (core dumped)" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -i -l "Exception" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "**** uncaught exception ****" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            # this interferes with the missingantennabehaviour=error option...
-            # out += subprocess.check_output('grep -l "error" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "misspelled" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-
-        elif (commandType == "CASA"):
-            out = subprocess.check_output('grep -l "[a-z]Error" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "An error occurred running" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "\*\*\* Error \*\*\*" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-
-        elif (commandType == "wsclean"):
-            out = subprocess.check_output('grep -l "exception occur" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "Segmentation fault\|Killed" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "Aborted" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            # out += subprocess.check_output('grep -L "Cleaning up temporary files..." '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-
-        elif (commandType.lower() == "ddfacet" or commandType.lower() == 'ddf'):
-            out = subprocess.check_output('grep -l "Traceback (most recent call last):" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "exception occur" ' + log + ' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "raise Exception" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "Segmentation fault\|Killed" ' + log + ' ; exit 0', shell=True,
-                                           stderr=subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "Aborted" ' + log + ' ; exit 0', shell=True, stderr=subprocess.STDOUT)
-
-        elif (commandType == "python"):
-            out = subprocess.check_output('grep -l "Traceback (most recent call last):" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "Segmentation fault\|Killed" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -i -l \'(?=^((?!error000).)*$).*Error.*\' '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -i -l "Critical" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "ERROR" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -l "raise Exception" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-
-        elif (commandType == "singularity"):
-            out = subprocess.check_output('grep -l "Traceback (most recent call last):" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -i -l \'(?=^((?!error000).)*$).*Error.*\' '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-            out += subprocess.check_output('grep -i -l "Critical" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-
-        elif (commandType == "general"):
-            out = subprocess.check_output('grep -l -i "error" '+log+' ; exit 0', shell = True, stderr = subprocess.STDOUT)
-
-        else:
+        if not self.log_checker.known(commandType):
             logger.warning("Unknown command type for log checking: '" + commandType + "'")
             return 1
 
-        if out != b'':
-            out = out.split(b'\n')[0].decode()
-            logger.error(commandType+' run problem on:\n'+out)
-            raise RuntimeError(commandType+' run problem on:\n'+out)
+        failures = self.log_checker.check(log, commandType)
+        if len(failures) > 0:
+            reasons = '\n'.join(['%s (line %i): %s' % (f['reason'], f['lineno'], f['line']) if f['line'] is not None else f['reason'] for f in failures])
+            logger.error(commandType+' run problem on:\n'+log+'\n'+reasons)
+            raise RuntimeError(commandType+' run problem on:\n'+log+'\n'+reasons)
 
         return 0
+
+
+class LogChecker():
+    """
+    Single-pass validation of the logs of the commands run by the Scheduler.
+    For each commandType there is a set of precompiled patterns: a log fails if any line matches
+    a "bad" pattern or if a "required" pattern (e.g. the DP3 closing line) never appears.
+    The reading offset of each log is kept, so appended logs are read only from where
+    the previous check stopped.
+    """
+    # commandType: list of (reason, regexp, flags, required)
+    patterns = {
+        'DP3': [('Not finished', r'Finishing processing', 0, True),
+                ('Segmentation fault or killed', r'Segmentation fault|Killed', 0, False),
+                # TODO: This needs to be uncommented once the malloc_consolidate stuff is fixed
+                # ('Aborted', r'Aborted \(core dumped\)', 0, False),
+                ('Exception', r'Exception', re.IGNORECASE, False),
+                ('Uncaught exception', r'\*\*\*\* uncaught exception \*\*\*\*', 0, False),
+                # this interferes with the missingantennabehaviour=error option...
+                # ('Error', r'error', 0, False),
+                ('Misspelled parameter', r'misspelled', 0, False)],
+        'CASA': [('Error', r'[a-z]Error', 0, False),
+                 ('Error occurred', r'An error occurred running', 0, False),
+                 ('Error', r'\*\*\* Error \*\*\*', 0, False)],
+        'wsclean': [('Exception', r'exception occur', 0, False),
+                    ('Segmentation fault or killed', r'Segmentation fault|Killed', 0, False),
+                    ('Aborted', r'Aborted', 0, False)],
+                    # ('Not finished', r'Cleaning up temporary files...', 0, True)],
+        'DDFacet': [('Traceback', r'Traceback \(most recent call last\):', 0, False),
+                    ('Exception', r'exception occur', 0, False),
+                    ('Exception', r'raise Exception', 0, False),
+                    ('Segmentation fault or killed', r'Segmentation fault|Killed', 0, False),
+                    ('Aborted', r'Aborted', 0, False)],
+        'python': [('Traceback', r'Traceback \(most recent call last\):', 0, False),
+                   ('Segmentation fault or killed', r'Segmentation fault|Killed', 0, False),
+                   ('Critical', r'Critical', re.IGNORECASE, False),
+                   ('Error', r'ERROR', 0, False),
+                   ('Exception', r'raise Exception', 0, False)],
+        'singularity': [('Traceback', r'Traceback \(most recent call last\):', 0, False),
+                        ('Critical', r'Critical', re.IGNORECASE, False)],
+        'general': [('Error', r'error', re.IGNORECASE, False)]
+    }
+    aliases = {'ddfacet': 'DDFacet', 'ddf': 'DDFacet'}
+
+    def __init__(self, blocksize = 2**20):
+        """
+        blocksize: approximate bytes read at once from a log
+        """
+        self.blocksize = blocksize
+        self.offsets = {} # log -> bytes already checked
+        self.compiled = {}
+        for commandType, patterns in self.patterns.items():
+            self.compiled[commandType] = [(reason, re.compile(regexp, flags), required) for reason, regexp, flags, required in patterns]
+
+    def known(self, commandType):
+        return self.aliases.get(commandType.lower(), commandType) in self.compiled
+
+    def check(self, log, commandType, live = False):
+        """
+        Read the part of 'log' written since the last check and validate it.
+        live: the command is still writing the log, required patterns are not checked
+              and an incomplete last line is left for the next check.
+        Return a list of failures, each a dict with keys: log, reason, line (None for missing required lines)
+        and lineno (counted from where the check started).
+        """
+        patterns = self.compiled[self.aliases.get(commandType.lower(), commandType)]
+        if live and not os.path.exists(log): return [] # the command did not start writing yet
+        offset = self.offsets.get(log, 0)
+        if os.path.getsize(log) < offset: offset = 0 # log was overwritten
+
+        failures = []
+        found = set()
+        lineno = 0
+        with open(log, 'rb') as f:
+            f.seek(offset)
+            while True:
+                lines = f.readlines(self.blocksize)
+                if len(lines) == 0: break
+                if live and not lines[-1].endswith(b'\n'):
+                    f.seek(-len(lines.pop()), os.SEEK_CUR)
+                    if len(lines) == 0: break
+                for line in lines:
+                    lineno += 1
+                    line = line.decode(errors='replace')
+                    for reason, regexp, required in patterns:
+                        if regexp.search(line) is None: continue
+                        if required: found.add(reason)
+                        else: failures.append({'log': log, 'reason': reason, 'line': line.strip(), 'lineno': lineno})
+            self.offsets[log] = f.tell()
+
+        for reason, regexp, required in patterns:
+            if required and not live and reason not in found:
+                failures.append({'log': log, 'reason': reason, 'line': None, 'lineno': None})
+
+        return failures
+
+
+class SlurmBackend():
+    """
+    Scheduler backend that submits all the commands of a Scheduler.run() as one SLURM job array.
+    With pack > 1 each array task runs several commands at the same time on its node.
+    Completion is followed with one squeue call per poll for the whole array; each command
+    writes its exit status and, with the shell builtin 'times', the cpu times of its children in files,
+    read back for the ledger.
+    The queue commands can be replaced, e.g. to test locally with scripts/slurm_standin.py:
+    SlurmBackend(sbatch='slurm_standin.py sbatch', squeue='slurm_standin.py squeue', scancel='slurm_standin.py scancel')
+    """
+
+    def __init__(self, pack = 1, poll = 10, job_name = 'LBApipe', time_limit = '24:00:00', sbatch_options = '',
+                 sbatch = 'sbatch', squeue = 'squeue', scancel = 'scancel'):
+        """
+        pack:           number of commands run by each array task
+        poll:           seconds between two checks of the job status
+        job_name:       name of the job array
+        time_limit:     time limit of each array task
+        sbatch_options: other options given to sbatch (e.g. '--partition=xxx')
+        sbatch, squeue, scancel: commands used to talk to SLURM
+        """
+        self.pack = pack
+        self.poll = poll
+        self.job_name = job_name
+        self.time_limit = time_limit
+        self.sbatch_options = sbatch_options
+        self.sbatch = sbatch
+        self.squeue = squeue
+        self.scancel = scancel
+        self.nsubmit = 0
+
+    def write_scripts(self, work_dir, groups):
+        """
+        Write one script per command and one per array task, return the job array script
+        """
+        for t, group in enumerate(groups):
+            with open('%s/task_%i.sh' % (work_dir, t), 'w') as f:
+                f.write('#!/bin/bash\n')
+                for i, action in group:
+                    with open('%s/cmd_%i.sh' % (work_dir, i), 'w') as fc:
+                        fc.write('#!/bin/bash\n')
+                        fc.write('start=$(date +%s.%N)\n')
+                        fc.write('( %s )\n' % action['cmd'])
+                        fc.write('rc=$?\n')
+                        # 'times' must run in this shell: in a $(...) subshell it has no children and gives 0
+                        fc.write('times > %s/cmd_%i.times\n' % (work_dir, i))
+                        fc.write('echo $rc $start $(date +%%s.%%N) > %s/cmd_%i.exit.tmp\n' % (work_dir, i))
+                        fc.write('mv %s/cmd_%i.exit.tmp %s/cmd_%i.exit\n' % (work_dir, i, work_dir, i))
+                    f.write('bash %s/cmd_%i.sh &\n' % (work_dir, i))
+                f.write('wait\n')
+
+        script = work_dir + '/array.sh'
+        with open(script, 'w') as f:
+            f.write('#!/bin/bash\n')
+            f.write('bash %s/task_${SLURM_ARRAY_TASK_ID}.sh\n' % work_dir)
+        return script
+
+    def read_exit(self, work_dir, i):
+        """
+        Return the usage of command i, or None if it is not finished
+        """
+        try:
+            with open('%s/cmd_%i.exit' % (work_dir, i)) as f:
+                fields = f.read().split()
+        except IOError:
+            return None
+        # second line of 'times': user and system time of the children, None if not available
+        try:
+            with open('%s/cmd_%i.times' % (work_dir, i)) as f:
+                cputimes = [int(m)*60 + float(s) for m, s in re.findall(r'(\d+)m([\d.]+)s', f.read().splitlines()[1])]
+        except (IOError, IndexError):
+            cputimes = []
+        return {'returncode': int(fields[0]), 'wall': float(fields[2]) - float(fields[1]),
+                'utime': cputimes[0] if len(cputimes) > 1 else None, 'stime': cputimes[1] if len(cputimes) > 1 else None,
+                'maxrss': None, 'read_bytes': None, 'write_bytes': None}
+
+    def run(self, scheduler, actions, maxThreads, failfast):
+        """
+        Submit the commands and wait for them, see Scheduler.run()
+        Return the list of commands not run and the list of failures as (action, reason)
+        """
+        if len(actions) == 0: return [], []
+
+        self.nsubmit += 1
+        work_dir = os.path.abspath('%s/slurm/%s_%03i' % (scheduler.log_dir, time.strftime('%Y%m%d-%H%M%S'), self.nsubmit))
+        os.makedirs(work_dir)
+
+        indexed = list(enumerate(actions))
+        groups = [indexed[i:i+self.pack] for i in range(0, len(indexed), self.pack)]
+        processors = min(max(sum(a['processors'] for i, a in g) for g in groups), scheduler.max_processors)
+        memory = min(max(sum(a['memory'] for i, a in g) for g in groups), scheduler.max_memory)
+        script = self.write_scripts(work_dir, groups)
+
+        cmd = '%s --parsable --job-name=%s --time=%s --nodes=1 --ntasks=1 --cpus-per-task=%i --array=0-%i%%%i --output=%s/task_%%a.out %s' \
+              % (self.sbatch, self.job_name, self.time_limit, processors, len(groups)-1, maxThreads, work_dir, self.sbatch_options)
+        if memory > 0: cmd += ' --mem=%iM' % int(np.ceil(memory*1024))
+        logger.debug('Submitting %i commands in %i array tasks: %s' % (len(actions), len(groups), cmd))
+        jobid = subprocess.check_output(cmd + ' ' + script, shell = True).decode().strip().split(';')[0]
+
+        usages = {}
+        failed = []
+        while True:
+            time.sleep(self.poll)
+            queued = subprocess.check_output('%s --noheader --format=%%i --jobs=%s ; exit 0' % (self.squeue, jobid),
+                                             shell = True, stderr = subprocess.STDOUT).decode()
+            for i, action in indexed:
+                if i in usages: continue
+                usage = self.read_exit(work_dir, i)
+                if usage is None: continue
+                usages[i] = usage
+                scheduler.account(action, usage)
+                if failfast and usage['returncode'] != 0 and len(failed) == 0:
+                    failed.append((action, 'exit status %i' % usage['returncode']))
+            if len(failed) > 0:
+                logger.warning('Cancelling job array %s' % jobid)
+                subprocess.call('%s %s' % (self.scancel, jobid), shell = True)
+                break
+            if len(usages) == len(actions): break
+            # the array left the queue but some commands did not report (e.g. killed by SLURM)
+            if jobid not in queued:
+                missing = [action for i, action in indexed if i not in usages]
+                logger.warning('Job array %s ended without exit status for %i commands' % (jobid, len(missing)))
+                if failfast: failed.append((missing[0], 'no exit status, job array %s ended' % jobid))
+                break
+
+        pending = [action for i, action in indexed if i not in usages]
+        return pending, failed
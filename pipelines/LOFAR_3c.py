@@ -103,8 +103,7 @@ with w.if_todo('setup'):
     
             # Move CORRECTED_DATA -> DATA
             logger.info('Move CORRECTED_DATA -> DATA...')
-            MSs.run('taql "update $pathMS set DATA = CORRECTED_DATA"',
-                    log='$nameMS_taql.log', commandType='general')
+            MSs.updateColumns({'DATA': 'CORRECTED_DATA'})
 
             # bkp
             logger.info('Making backup...')
@@ -168,7 +167,7 @@ with w.if_todo('predict'):
     
     # Smooth DATA -> DATA
     logger.info('BL-based smoothing...')
-    MSs.run('BLsmooth.py -r -s 0.8 -i DATA -o DATA $pathMS', log='$nameMS_smooth1.log', commandType='python')
+    lib_util.run_blsmooth(s, 'smooth1.log', MSs.getStrWsclean(), '-r -s 0.8 -i DATA -o DATA')
 ### DONE
 
 ###############################################################
@@ -253,8 +252,7 @@ for c in range(100):
 
             # subtract everything
             logger.info('Subtract model: CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA...')
-            MSs.run('taql "update $pathMS set CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA"',
-                    log='$nameMS_taql.log', commandType='general')
+            MSs.updateColumns({'CORRECTED_DATA': 'CORRECTED_DATA - MODEL_DATA'})
         # DONE
 
         # load skymodel
@@ -312,8 +310,7 @@ for c in range(100):
 
                 # add the source to peel back
                 logger.info('Peel - add model: CORRECTED_DATA = CORRECTED_DATA + MODEL_DATA...')
-                MSs.run('taql "update $pathMS set CORRECTED_DATA = CORRECTED_DATA + MODEL_DATA"',
-                        log='$nameMS_taql.log', commandType='general')
+                MSs.updateColumns({'CORRECTED_DATA': 'CORRECTED_DATA + MODEL_DATA'})
 
                 # phaseshift + avg
                 logger.info('Peel - Phaseshift+avg...')
@@ -364,8 +361,7 @@ for c in range(100):
 
                 # subtract
                 logger.info('Subtract model: CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA...')
-                MSs.run('taql "update $pathMS set CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA"',
-                    log='$nameMS_taql.log', commandType='general')
+                MSs.updateColumns({'CORRECTED_DATA': 'CORRECTED_DATA - MODEL_DATA'})
             # DONE
 
         with w.if_todo('reprepare dataset'):
@@ -382,8 +378,7 @@ for c in range(100):
 
             # prepare new data
             logger.info('Subtract model: DATA = CORRECTED_DATA + MODEL_DATA...')
-            MSs.run('taql "update $pathMS set DATA = CORRECTED_DATA + MODEL_DATA"',
-                    log='$nameMS_taql.log', commandType='general')
+            MSs.updateColumns({'DATA': 'CORRECTED_DATA + MODEL_DATA'})
         # DONE
 
     #################################################
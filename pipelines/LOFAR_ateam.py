@@ -145,7 +145,7 @@ else:
 # BL Smooth DATA -> DATA
 if lofar_system == 'hba':
     logger.info('BL-based smoothing...')
-    MSs.run('BLsmooth.py -r -s 0.7 -i DATA -o DATA $pathMS', log='$nameMS_smooth.log', commandType='python')
+    lib_util.run_blsmooth(s, 'smooth.log', MSs.getStrWsclean(), '-r -s 0.7 -i DATA -o DATA')
 
 for c in range(100):
 
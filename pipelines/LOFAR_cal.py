@@ -47,6 +47,7 @@ with w.if_todo('copy'):
 ### DONE
 
 MSs = lib_ms.AllMSs( glob.glob('*MS'), s, check_flags = False )
+tmpcols = lib_ms.TempColumns(MSs) # scratch columns, removed at the end of the step that registers them
 calname = MSs.getListObj()[0].getNameField()
 for MS in MSs.getListObj():
     os.system('cp -r %s %s' % (skymodel, MS.pathMS))
@@ -56,9 +57,12 @@ if min(MSs.getFreqs()) < 35.e6:
     logger.debug('Include iono 3rd order.')
 else: iono3rd = False
 
+# steps declare as inputs the parsets and models they use and as params the config values, a completed step
+# is re-done if they change (the cal-*.h5 are rewritten by 'compressing_h5', so they are inputs only after it)
+
 ######################################################
 # flag bad stations, flags will propagate
-with w.if_todo('flag'):
+with w.if_todo('flag', inputs=[parset_dir+'/DP3-flag.parset'], params={'stations': bl2flag}):
     logger.info("Flagging...")
     MSs.run("DP3 " + parset_dir + "/DP3-flag.parset msin=$pathMS ant.baseline=\"" + bl2flag+"\"", log="$nameMS_flag.log", commandType="DP3")
 
@@ -68,7 +72,7 @@ with w.if_todo('flag'):
 
 ### DONE
 
-with w.if_todo('predict'):
+with w.if_todo('predict', inputs=[skymodel, parset_dir+'/DP3-predict.parset']):
     # predict to save time ms:MODEL_DATA
 
     logger.info('Add model of %s from %s to MODEL_DATA...' % (calname, os.path.basename(skymodel)))
@@ -80,11 +84,12 @@ with w.if_todo('predict'):
 ###################################################
 # 1: find PA
 
-with w.if_todo('cal_pa'):
+with w.if_todo('cal_pa', inputs=[parset_dir+'/DP3-soldd.parset', parset_dir+'/DP3-cor.parset', parset_dir+'/losoto-plot-ph.parset',
+                                 parset_dir+'/losoto-plot-rot.parset', parset_dir+'/losoto-plot-amp.parset', parset_dir+'/losoto-pa.parset']):
     # Smooth data DATA -> SMOOTHED_DATA (BL-based smoothing)
     logger.info('BL-smooth...')
-    MSs.run(f'BLsmooth.py -r -c 1 -n 8 -f {1e-2 if MSs.isLBA else .2e-3} -i DATA -o SMOOTHED_DATA $pathMS', log='$nameMS_smooth1.log',
-            commandType='python', maxThreads=8)
+    lib_util.run_blsmooth(s, 'smooth1.log', MSs.getStrWsclean(), f'-r -c 1 -f {1e-2 if MSs.isLBA else .2e-3} -i DATA -o SMOOTHED_DATA')
+    tmpcols.register('SMOOTHED_DATA')
 
     # Solve cal_SB.MS:SMOOTHED_DATA (only solve)
     logger.info('Calibrating PA...')
@@ -103,7 +108,8 @@ with w.if_todo('cal_pa'):
 
 ########################################################
 # 2: find FR
-with w.if_todo('cal_fr'):
+with w.if_todo('cal_fr', inputs=[parset_dir+'/DP3-beam.parset', parset_dir+'/DP3-soldd.parset', parset_dir+'/DP3-cor.parset',
+                                 parset_dir+'/losoto-fr.parset']):
     # Beam correction CORRECTED_DATA -> CORRECTED_DATA
     logger.info('Beam correction...')
     MSs.run("DP3 " + parset_dir + '/DP3-beam.parset msin=$pathMS corrbeam.updateweights=True', log='$nameMS_beam.log',
@@ -111,25 +117,18 @@ with w.if_todo('cal_fr'):
 
     # Smooth data CORRECTED_DATA -> CIRC_PHASEDIFF_DATA (BL-based smoothing)
     logger.info('BL-smooth...')
-    MSs.addcol('CIRC_PHASEDIFF_DATA', 'CORRECTED_DATA', usedysco=False) # need this to make sure no dysco, if we have dyso we cannot set values to zero
-    MSs.run(f'BLsmooth.py -r -c 1 -n 8 -f {1e-2 if MSs.isLBA else .2e-3} -i CIRC_PHASEDIFF_DATA -o CIRC_PHASEDIFF_DATA $pathMS', log='$nameMS_smooth2.log',
-            commandType='python', maxThreads=8)
+    tmpcols.add('CIRC_PHASEDIFF_DATA', 'CORRECTED_DATA', usedysco=False) # need this to make sure no dysco, if we have dyso we cannot set values to zero
+    lib_util.run_blsmooth(s, 'smooth2.log', MSs.getStrWsclean(), f'-r -c 1 -f {1e-2 if MSs.isLBA else .2e-3} -i CIRC_PHASEDIFF_DATA -o CIRC_PHASEDIFF_DATA')
 
     logger.info('Converting to circular...')
     MSs.run('mslin2circ.py -s -i $pathMS:CIRC_PHASEDIFF_DATA -o $pathMS:CIRC_PHASEDIFF_DATA', log='$nameMS_lincirc.log',
             commandType='python', maxThreads=2)
     # Get circular phase diff CIRC_PHASEDIFF_DATA -> CIRC_PHASEDIFF_DATA
-    logger.info('Get circular phase difference...')
-    MSs.run('taql "UPDATE $pathMS SET\
-     CIRC_PHASEDIFF_DATA[,0]=0.5*EXP(1.0i*(PHASE(CIRC_PHASEDIFF_DATA[,0])-PHASE(CIRC_PHASEDIFF_DATA[,3]))), \
-     CIRC_PHASEDIFF_DATA[,3]=CIRC_PHASEDIFF_DATA[,0], \
-     CIRC_PHASEDIFF_DATA[,1]=0+0i, \
-     CIRC_PHASEDIFF_DATA[,2]=0+0i"',log='$nameMS_taql_phdiff.log', commandType='general')
-
-    logger.info('Creating FR_MODEL_DATA...') # take from MODEL_DATA but overwrite
-    MSs.addcol('FR_MODEL_DATA', 'MODEL_DATA', usedysco=False) # need this to make sure no dysco, if we have dyso we cannot set values to zero
-    MSs.run('taql "UPDATE $pathMS SET FR_MODEL_DATA[,0]=0.5+0i, FR_MODEL_DATA[,1]=0.0+0i, FR_MODEL_DATA[,2]=0.0+0i, \
-     FR_MODEL_DATA[,3]=0.5+0i"', log='$nameMS_taql_frmodel.log', commandType='general')
+    # and create FR_MODEL_DATA (like CIRC_PHASEDIFF_DATA, so no dysco) in the same pass
+    logger.info('Get circular phase difference and create FR_MODEL_DATA...')
+    MSs.updateColumns([('CIRC_PHASEDIFF_DATA', lambda cols: lib_ms.circPhaseDiff(cols['CIRC_PHASEDIFF_DATA'])),
+                       ('FR_MODEL_DATA', 'np.array([0.5+0j, 0, 0, 0.5])')], inputs=['CIRC_PHASEDIFF_DATA'])
+    tmpcols.register('FR_MODEL_DATA')
 
     # Solve cal_SB.MS:CIRC_PHASEDIFF_DATA against FR_MODEL_DATA (only solve)
     logger.info('Calibrating FR...')
@@ -138,9 +137,6 @@ with w.if_todo('cal_fr'):
      sol.coreconstraint=2e3 sol.smoothnessconstraint=5e6 sol.smoothnessreffrequency=54e6', log='$nameMS_solFR.log', commandType="DP3")
     lib_util.run_losoto(s, 'fr', [ms + '/fr.h5' for ms in MSs.getListStr()], [parset_dir + '/losoto-fr.parset'])
 
-    # remove columns
-    MSs.run('taql "ALTER TABLE $pathMS DELETE COLUMN CIRC_PHASEDIFF_DATA, FR_MODEL_DATA"', log='$nameMS_taql_delcol.log', commandType='general')
-
     # Correct FR CORRECTED_DATA -> CORRECTED_DATA
     logger.info('Faraday rotation correction...')
     MSs.run(
@@ -152,11 +148,12 @@ with w.if_todo('cal_fr'):
 ######################################################
 # 4: find BP
 
-with w.if_todo('cal_bp'):
+with w.if_todo('cal_bp', inputs=[parset_dir+'/DP3-soldd.parset', parset_dir+'/losoto-flag.parset', parset_dir+'/losoto-plot-amp.parset',
+                                 parset_dir+'/losoto-plot-ph.parset', parset_dir+'/losoto-bp.parset']):
     # Smooth data CORRECTED_DATA -> SMOOTHED_DATA (BL-based smoothing)
     logger.info('BL-smooth...')
-    MSs.run(f'BLsmooth.py -r -c 1 -n 8 -f {1e-2 if MSs.isLBA else .2e-3} -i CORRECTED_DATA -o SMOOTHED_DATA $pathMS', log='$nameMS_smooth3.log',
-            commandType ='python', maxThreads=8)
+    lib_util.run_blsmooth(s, 'smooth3.log', MSs.getStrWsclean(), f'-r -c 1 -f {1e-2 if MSs.isLBA else .2e-3} -i CORRECTED_DATA -o SMOOTHED_DATA')
+    tmpcols.register('SMOOTHED_DATA')
 
     # Solve cal_SB.MS:SMOOTHED_DATA (only solve)
     logger.info('Calibrating BP...')
@@ -171,7 +168,7 @@ with w.if_todo('cal_bp'):
 ####################################################
 # Re-do correcitons in right order
 
-with w.if_todo('apply_all'):
+with w.if_todo('apply_all', inputs=[parset_dir+'/DP3-cor.parset', parset_dir+'/DP3-beam.parset']):
     # Pol align correction DATA -> CORRECTED_DATA
     logger.info('Polalign correction...')
     MSs.run('DP3 '+parset_dir+'/DP3-cor.parset msin=$pathMS msin.datacolumn=DATA cor.parmdb=cal-pa.h5 cor.correction=polalign', log='$nameMS_corPA2.log', commandType="DP3")
@@ -199,11 +196,12 @@ with w.if_todo('apply_all'):
 #################################################
 # 4: find iono
 
-with w.if_todo('cal_iono'):
+with w.if_todo('cal_iono', inputs=[parset_dir+'/DP3-soldd.parset', parset_dir+'/losoto-plot-scalarph.parset',
+                                   parset_dir+'/losoto-iono3rd.parset', parset_dir+'/losoto-iono-hba.parset', parset_dir+'/losoto-iono.parset']):
     # Smooth data CORRECTED_DATA -> SMOOTHED_DATA (BL-based smoothing)
     logger.info('BL-smooth...')
-    MSs.run(f'BLsmooth.py -r -c 1 -n 8 -f {1e-2 if MSs.isLBA else .2e-3} -i CORRECTED_DATA -o SMOOTHED_DATA $pathMS', log='$nameMS_smooth4.log',
-            commandType ='python', maxThreads=8)
+    lib_util.run_blsmooth(s, 'smooth4.log', MSs.getStrWsclean(), f'-r -c 1 -f {1e-2 if MSs.isLBA else .2e-3} -i CORRECTED_DATA -o SMOOTHED_DATA')
+    tmpcols.register('SMOOTHED_DATA')
 
     # Solve cal_SB.MS:SMOOTHED_DATA (only solve)
     logger.info('Calibrating IONO...')
@@ -257,7 +255,8 @@ if imaging:
     ####################################################
     # 5: find leak
 
-    with w.if_todo('cal_leak'):
+    with w.if_todo('cal_leak', inputs=['cal-iono.h5', parset_dir+'/DP3-cor.parset', parset_dir+'/DP3-soldd.parset',
+                                       parset_dir+'/losoto-flag-leak.parset', parset_dir+'/losoto-plot-fullj.parset']):
 
         # Correct all CORRECTED_DATA (PA, beam, FR, BP corrected) -> CORRECTED_DATA
         logger.info('IONO correction...')
@@ -266,8 +265,8 @@ if imaging:
 
         # Smooth data CORRECTED_DATA -> SMOOTHED_DATA (BL-based smoothing)
         logger.info('BL-smooth...')
-        MSs.run('BLsmooth.py -r -c 1 -n 8 -i CORRECTED_DATA -o SMOOTHED_DATA $pathMS', log='$nameMS_smooth4.log',
-                commandType ='python', maxThreads=8)
+        lib_util.run_blsmooth(s, 'smooth4.log', MSs.getStrWsclean(), '-r -c 1 -i CORRECTED_DATA -o SMOOTHED_DATA')
+        tmpcols.register('SMOOTHED_DATA')
         
         # Solve cal_SB.MS:SMOOTHED_DATA (only solve)
         logger.info('Calibrating LEAK...')
@@ -312,4 +311,5 @@ if imaging:
 
     ### DONE
 
+tmpcols.report()
 logger.info("Done.")
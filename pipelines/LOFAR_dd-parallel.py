@@ -284,11 +284,11 @@ for c in range(maxniter):
         
         # Empty dataset from faint sources
         logger.info('Set SUBTRACTED_DATA = DATA - MODEL_DATA...')
-        MSs.run('taql "update $pathMS set SUBTRACTED_DATA = DATA - MODEL_DATA"', log='$nameMS_taql-c'+str(c)+'.log', commandType='general')
+        MSs.updateColumns({'SUBTRACTED_DATA': 'DATA - MODEL_DATA'})
         
         # Smoothing - ms:SUBTRACTED_DATA -> ms:SMOOTHED_DATA
         logger.info('BL-based smoothing...')
-        MSs.run('BLsmooth.py -c 8 -r -i SUBTRACTED_DATA -o SMOOTHED_DATA $pathMS', log='$nameMS_smooth-c'+str(c)+'.log', commandType='python')    
+        lib_util.run_blsmooth(s, 'smooth-c'+str(c)+'.log', MSs.getStrWsclean(), '-c 8 -r -i SUBTRACTED_DATA -o SMOOTHED_DATA')    
     
         # Calibration - ms:SMOOTHED_DATA
         logger.info('Gain calibration...')
@@ -332,7 +332,7 @@ for c in range(maxniter):
 
             # Copy DATA -> SUBTRACTED_DATA
             logger.info('Set SUBTRACTED_DATA = DATA...')
-            MSs.run('taql "update $pathMS set SUBTRACTED_DATA = DATA"', log='$nameMS_taql-c'+str(c)+'.log', commandType='general')
+            MSs.updateColumns({'SUBTRACTED_DATA': 'DATA'})
         
             for i, d in enumerate(directions):
                 
@@ -352,13 +352,13 @@ for c in range(maxniter):
                         log='$nameMS_corrupt1-c'+str(c)+'-'+d.name+'.log', commandType='DP3')
          
                 logger.info('Patch '+d.name+': subtract...')
-                MSs.run('taql "update $pathMS set SUBTRACTED_DATA = SUBTRACTED_DATA - MODEL_DATA"', log='$nameMS_taql-c'+str(c)+'-'+d.name+'.log', commandType='general')
+                MSs.updateColumns({'SUBTRACTED_DATA': 'SUBTRACTED_DATA - MODEL_DATA'})
     
 
         ### DONE
         
         ### TESTTESTTEST: empty image
-        #MSs.run('taql "update $pathMS set CORRECTED_DATA = SUBTRACTED_DATA"', log='$nameMS_taql-c'+str(c)+'.log', commandType='general')
+        #MSs.updateColumns({'CORRECTED_DATA': 'SUBTRACTED_DATA'})
         #clean('empty-c'+str(c), MSs, size=(fwhm*2,fwhm*2), res='normal')
         ###
 
@@ -391,7 +391,7 @@ for c in range(maxniter):
                         log='$nameMS_corrupt2-c'+str(c)+'-'+d.name+'.log', commandType='DP3')
         
                 logger.info('Patch '+d.name+': add...')
-                MSs.run('taql "update $pathMS set CORRECTED_DATA = SUBTRACTED_DATA + MODEL_DATA"', log='$nameMS_taql-c'+str(c)+'-'+d.name+'.log', commandType='general')
+                MSs.updateColumns({'CORRECTED_DATA': 'SUBTRACTED_DATA + MODEL_DATA'})
         
                 # correct G - ms:CORRECTED_DATA -> ms:CORRECTED_DATA
                 logger.info('Patch '+d.name+': correct...')
@@ -425,7 +425,7 @@ for c in range(maxniter):
                     MSs.run('DP3 '+parset_dir+'/DP3-predict.parset msin=$pathMS pre.sourcedb=img/ddcalM-'+d.name+'-high-sources.skydb pre.sources='+d.name, \
                             log='$nameMS_pre1-c'+str(c)+'-'+d.name+'.log', commandType='DP3')
                     logger.info('Patch '+d.name+': subtract high-res...')
-                    MSs.run('taql "update $pathMS set CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA"', log='$nameMS_taql-c'+str(c)+'-'+d.name+'.log', commandType='general')
+                    MSs.updateColumns({'CORRECTED_DATA': 'CORRECTED_DATA - MODEL_DATA'})
                     logger.info('Patch '+d.name+': imaging low-res...')
                     clean(d.name+'-low', lib_ms.AllMSs( glob.glob('mss-dir/*MS'), s ), size=d.size_facet, res='low', apply_beam = c==maxniter )
     
@@ -151,9 +151,14 @@ if imgsizepix % 2 != 0: imgsizepix += 1  # prevent odd img sizes
 #beamReg = 'ddcal/beam.reg'
 
 logger.info('Add columns...')
-MSs.run('addcol2ms.py -m $pathMS -c CORRECTED_DATA,SUBTRACTED_DATA -i DATA', log='$nameMS_addcol.log', commandType='python')
+MSs.run('addcol2ms.py -m $pathMS -c CORRECTED_DATA,SUBTRACTED_DATA -i DATA --virtual', log='$nameMS_addcol.log', commandType='python')
 MSs.run('addcol2ms.py -m $pathMS -c FLAG_BKP -i FLAG', log='$nameMS_addcol.log', commandType='python')
 
+# steps declare as inputs the parsets, solutions and images they use and as params the config and derived values,
+# a completed step is re-done if they change. Not declared: MS columns and the per-direction solutions (modified
+# by later steps), files copied or rewritten at each run (ddcal/init, skymodels)
+userRegs = [userReg] if userReg != '' else []
+
 ##############################################################
 # setup initial model
 os.system('cp self/images/wideM-1* ddcal/init/')
@@ -281,7 +286,7 @@ for cmaj in range(maxIter):
         directions = pickle.load( open( picklefile, "rb" ) )
 
     if cmaj == 0:
-        with w.if_todo('c%02i-fullpredict' % cmaj):
+        with w.if_todo('c%02i-fullpredict' % cmaj, inputs=['self/images/wideM-1-[0-9]*-model.fits'], params={'ch_out': ch_out}):
             # wsclean predict
             logger.info('Predict full model...')
             if cmaj == 0:
@@ -294,12 +299,10 @@ for cmaj in range(maxIter):
         with w.if_todo('c%02i-fullsub' % cmaj):
             # subtract - ms:SUBTRACTED_DATA = DATA - MODEL_DATA
             logger.info('Set SUBTRACTED_DATA = DATA - MODEL_DATA...')
-            MSs.run('taql "update $pathMS set SUBTRACTED_DATA = DATA - MODEL_DATA"',
-                        log='$nameMS_taql.log', commandType='general')
-            # reset - ms:CORRECTED_DATA = DATA
+            MSs.updateColumns({'SUBTRACTED_DATA': 'DATA - MODEL_DATA'})
+            # reset - ms:CORRECTED_DATA = DATA (virtual, takes no space until written)
             logger.info('Set CORRECTED_DATA = DATA...')
-            MSs.run('taql "update $pathMS set CORRECTED_DATA = DATA"',
-                        log='$nameMS_taql.log', commandType='general')
+            MSs.addcol('CORRECTED_DATA', 'DATA', virtual=True)
         ### DONE
 
         ### TESTTESTTEST: empty image
@@ -324,8 +327,7 @@ for cmaj in range(maxIter):
     
                 # Add back the model previously subtracted for this dd-cal
                 logger.info('Set SUBTRACTED_DATA = SUBTRACTED_DATA + MODEL_DATA...')
-                MSs.run('taql "update $pathMS set SUBTRACTED_DATA = SUBTRACTED_DATA + MODEL_DATA"',
-                        log='$nameMS_taql.log', commandType='general')
+                MSs.updateColumns({'SUBTRACTED_DATA': 'SUBTRACTED_DATA + MODEL_DATA'})
     
             else:
 
@@ -376,8 +378,7 @@ for cmaj in range(maxIter):
 
                 # Remove corrupted data from CORRECTED_DATA
                 logger.info('Set SUBTRACTED_DATA = CORRECTED_DATA - MODEL_DATA...')
-                MSs.run('taql "update $pathMS set SUBTRACTED_DATA = CORRECTED_DATA - MODEL_DATA"',
-                        log='$nameMS_taql.log', commandType='general')
+                MSs.updateColumns({'SUBTRACTED_DATA': 'CORRECTED_DATA - MODEL_DATA'})
 
             ### TTESTTESTTEST: empty image but with the DD cal
             #if not os.path.exists('img/empty-butcal-%02i-%s-image.fits' % (dnum, logstring)):
@@ -385,7 +386,8 @@ for cmaj in range(maxIter):
     
         ### DONE
 
-        with w.if_todo('%s-shift' % logstring):
+        with w.if_todo('%s-shift' % logstring, inputs=[parset_dir+'/DP3-shiftavg.parset'],
+                       params={'position': [float(x) for x in d.position]}):
             logger.info('Phase shift and avg...')
 
             lib_util.check_rm('mss-dir')
@@ -416,7 +418,7 @@ for cmaj in range(maxIter):
 
         # Correct for beam in that direction
         if not d.peel_off:
-            with w.if_todo('%s-beamcorr' % logstring):
+            with w.if_todo('%s-beamcorr' % logstring, inputs=[parset_dir+'/DP3-beam.parset']):
                 logger.info('Correcting beam...')
                 # Convince DP3 that DATA is corrected for the beam in the phase centre
                 MSs_dir.run('DP3 '+parset_dir+'/DP3-beam.parset msin=$pathMS msin.datacolumn=DATA msout.datacolumn=DATA \
@@ -425,7 +427,7 @@ for cmaj in range(maxIter):
                         log='$nameMS_beam-'+logstring+'.log', commandType='DP3')
             ### DONE
 
-        with w.if_todo('%s-preimage' % logstring):
+        with w.if_todo('%s-preimage' % logstring, inputs=userRegs, params={'userReg': userReg}):
             logger.info('Pre-imaging...')
             clean('%s-pre' % logstring, MSs_dir, res='normal', size=[d.size,d.size])#, imagereg=d.get_region())
         ### DONE
@@ -463,12 +465,15 @@ for cmaj in range(maxIter):
                 d.add_h5parm('amp1', None )
                 d.add_h5parm('amp2', None )
    
-            with w.if_todo('%s-calibrate' % logstringcal):
+            calparsets = [parset_dir+'/DP3-solG.parset', parset_dir+'/DP3-correct.parset', parset_dir+'/losoto-plot1.parset']
+            if doamp: calparsets += [parset_dir+'/losoto-norm.parset', parset_dir+'/losoto-plot2.parset', parset_dir+'/losoto-plot3.parset']
+            with w.if_todo('%s-calibrate' % logstringcal, inputs=calparsets,
+                           params={'solint_ph': solint_ph, 'doamp': doamp, 'solint_amp1': solint_amp1 if doamp else None,
+                                   'solint_amp2': solint_amp2 if doamp else None}):
                 if cdd == 0:
                     logger.info('BL-based smoothing...')
                     # Smoothing - ms:DATA -> ms:SMOOTHED_DATA
-                    MSs_dir.run('BLsmooth.py -r -i DATA -o SMOOTHED_DATA $pathMS',
-                        log='$nameMS_smooth-'+logstringcal+'.log', commandType='python')
+                    lib_util.run_blsmooth(s, 'smooth-'+logstringcal+'.log', MSs_dir.getStrWsclean(), '-r -i DATA -o SMOOTHED_DATA')
 
                 # Calibration - ms:SMOOTHED_DATA
                 logger.info('Gain phase calibration (solint: %i)...' % solint_ph)
@@ -533,7 +538,7 @@ for cmaj in range(maxIter):
 
             ###########################################################################
             # Imaging
-            with w.if_todo('%s-image' % logstringcal):
+            with w.if_todo('%s-image' % logstringcal, inputs=userRegs, params={'userReg': userReg}):
 
                 logger.info('%s (cdd: %02i): imaging...' % (d.name, cdd))
                 clean('%s' % logstringcal, MSs_dir, res='normal', size=[d.size,d.size])#, imagereg=d.get_region())
@@ -614,7 +619,8 @@ for cmaj in range(maxIter):
             s.run()
 
         # remove the DD-cal from original dataset using new solutions
-        with w.if_todo('%s-subtract' % logstring):
+        with w.if_todo('%s-subtract' % logstring, inputs=[parset_dir+'/DP3-predict.parset', parset_dir+'/DP3-correct.parset',
+                                                          parset_dir+'/DP3-beam.parset', parset_dir+'/DP3-beam2.parset']):
 
             # Predict - ms:MODEL_DATA
             logger.info('Add best model to MODEL_DATA...')
@@ -623,8 +629,7 @@ for cmaj in range(maxIter):
 
             # Store FLAGS - just for sources to peel as they might be visible only for a fraction of the band
             if d.peel_off:
-                MSs.run('taql "update $pathMS set FLAG_BKP = FLAG"',
-                         log='$nameMS_taql.log', commandType='general')
+                MSs.updateColumns({'FLAG_BKP': 'FLAG'})
 
             # Corrput now model - ms:MODEL_DATA -> MODEL_DATA
             logger.info('Corrupt ph...')
@@ -655,23 +660,17 @@ for cmaj in range(maxIter):
                        log='$nameMS_beam-'+logstring+'.log', commandType='DP3')
 
             if d.peel_off:
-                # Set MODEL_DATA = 0 where data are flagged, then unflag everything
-                MSs.run('taql "update $pathMS set MODEL_DATA[FLAG] = 0"',
-                        log='$nameMS_taql.log', commandType='general')
-                # Restore of FLAGS
-                MSs.run('taql "update $pathMS set FLAG = FLAG_BKP"',
-                        log='$nameMS_taql.log', commandType='general')
+                # Set MODEL_DATA = 0 where data are flagged, then unflag everything (restore of FLAGS), in one pass
+                MSs.updateColumns([('MODEL_DATA', 'np.where(FLAG, 0, MODEL_DATA)'), ('FLAG', 'FLAG_BKP')])
 
             # Remove the ddcal again
             logger.info('Set SUBTRACTED_DATA = SUBTRACTED_DATA - MODEL_DATA')
-            MSs.run('taql "update $pathMS set SUBTRACTED_DATA = SUBTRACTED_DATA - MODEL_DATA"',
-                    log='$nameMS_taql.log', commandType='general')
+            MSs.updateColumns({'SUBTRACTED_DATA': 'SUBTRACTED_DATA - MODEL_DATA'})
 
             # if it's a source to peel, remove it from the data column used for imaging
             if d.peel_off:
                 logger.info('Source to peel: set CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA')
-                MSs.run('taql "update $pathMS set CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA"', \
-                        log='$nameMS_taql.log', commandType='general')
+                MSs.updateColumns({'CORRECTED_DATA': 'CORRECTED_DATA - MODEL_DATA'})
 
         ### DONE
 
@@ -750,7 +749,8 @@ for cmaj in range(maxIter):
     correct_for = 'phase000'
     if len(h5parms['amp1']) != 0: correct_for += '+amplitude000'
 
-    with w.if_todo('c%02i-interpsol' % cmaj):
+    with w.if_todo('c%02i-interpsol' % cmaj, inputs=[parset_dir+'/losoto-refph.parset', parset_dir+'/losoto-resetph.parset'],
+                   params={'h5parms': h5parms}):
         logger.info("Imaging - preparing solutions:")
 
         for typ, h5parm_list in h5parms.items():
@@ -806,7 +806,7 @@ for cmaj in range(maxIter):
         'SSD2_PolyFreqOrder': 2
     }
 
-    with w.if_todo('c%02i-imaging' % cmaj):
+    with w.if_todo('c%02i-imaging' % cmaj, inputs=[interp_h5parm], params={'correct_for': correct_for, 'imgsizepix': imgsizepix, 'ch_out': ch_out}):
         if cmaj == 0:
             # initial shallow clean to make a mask
             logger.info('Cleaning (shallow)...')
@@ -869,7 +869,7 @@ for cmaj in range(maxIter):
 ### Calibration finished - additional images with scientific value
 
 # TODO: the model to subtract should be done from a high-res image to remove only point sources
-with w.if_todo('output-lres'):
+with w.if_todo('output-lres', inputs=[interp_h5parm], params={'correct_for': correct_for}):
     logger.info('Cleaning low-res...')
     # now make a low res and source subtracted map for masking extended sources
     logger.info('Predicting DD-corrupted...')
@@ -883,8 +883,7 @@ with w.if_todo('output-lres'):
                      )
 
     logger.info('Set SUBTRACTED_DATA = CORRECTED_DATA - MODEL_DATA...')
-    MSs.run('taql "update $pathMS set SUBTRACTED_DATA = CORRECTED_DATA - MODEL_DATA"',
-        log='$nameMS_taql.log', commandType='general')
+    MSs.updateColumns({'SUBTRACTED_DATA': 'CORRECTED_DATA - MODEL_DATA'})
     imagenameL = 'img/wideDD-lres-c%02i' % (cmaj)
     logger.info('Cleaning (low res)...')
     lib_util.run_DDF(s, 'ddfacet-lres-c'+str(cmaj)+'.log', **{**ddf_parms_common, **ddf_parms_clean},
@@ -904,7 +903,7 @@ with w.if_todo('output-lres'):
     os.system('mv %s* ddcal/c%02i/images' % (imagenameL, cmaj))
 ### DONE
 
-with w.if_todo('output_stokesV'):
+with w.if_todo('output_stokesV', inputs=[interp_h5parm], params={'correct_for': correct_for}):
     logger.info('Cleaning Stokes V...')
     imagenameV = 'img/wideDD-V-c%02i' % (cmaj)
     lib_util.run_DDF(s, 'ddfacet-v-c' + str(cmaj) + '.log',
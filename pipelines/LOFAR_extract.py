@@ -271,10 +271,9 @@ for p in close_pointings:
     with w.if_todo('subtract_rest_'+p):
         # Remove corrupted data from CORRECTED_DATA
         logger.info('Add columns...')
-        MSs.run('addcol2ms.py -m $pathMS -c SUBTRACTED_DATA -i DATA', log='$nameMS_addcol.log', commandType='python')
+        MSs.run('addcol2ms.py -m $pathMS -c SUBTRACTED_DATA -i DATA --virtual', log='$nameMS_addcol.log', commandType='python')
         logger.info('Set SUBTRACTED_DATA = CORRECTED_DATA - MODEL_DATA...')
-        MSs.run('taql "update $pathMS set SUBTRACTED_DATA = CORRECTED_DATA - MODEL_DATA"',
-                log='$nameMS_subtract.log', commandType='general')
+        MSs.updateColumns({'SUBTRACTED_DATA': 'CORRECTED_DATA - MODEL_DATA'})
         ### DONE
 
     ## TTESTTESTTEST: empty image
@@ -329,7 +328,7 @@ with w.if_todo('image_init'):
 # Smoothing - ms:DATA -> ms:SMOOTHED_DATA
 with w.if_todo('smooth'):
     logger.info('BL-based smoothing...')
-    MSs_extract.run('BLsmooth.py -c 1 -n 8 -r -i DATA -o SMOOTHED_DATA $pathMS', log='$nameMS_smooth.log', commandType='python', maxThreads=1)
+    lib_util.run_blsmooth(s, 'smooth.log', MSs_extract.getStrWsclean(), '-c 1 -r -i DATA -o SMOOTHED_DATA')
     ### DONE
 
 # get initial noise and set iterators for timeint solutions
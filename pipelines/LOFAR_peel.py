@@ -120,10 +120,7 @@ def corrupt_subtract_testimage(MSs_object, suffix, sol_suffix=None, column_in='D
                       f'cor.invert=False', log=f'$nameMS_corrup_gain-{sol_suffix}.log', commandType='DP3')
 
         logger.info(f'SET SUBTRACTED_DATA = {column_in} - CORRUPTED_MODEL_DATA ({suffix})')
-        MSs_object.addcol('SUBTRACTED_DATA', column_in)
-        MSs_object.run(f'taql "UPDATE $pathMS SET SUBTRACTED_DATA = {column_in} - CORRUPTED_MODEL_DATA"',
-                      log='$nameMS_taql_subtract.log',
-                      commandType='general')
+        MSs_object.updateColumns({'SUBTRACTED_DATA': f'{column_in} - CORRUPTED_MODEL_DATA'}, like=column_in)
 
     with w.if_todo(f'correct-subtracted-{suffix}'):
         logger.info(f'Scalarphase correction... ({suffix})')
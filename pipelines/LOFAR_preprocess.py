@@ -110,12 +110,15 @@ with w.if_todo('rescale_flux'):
     else:
         rescale_factor = 1e-4
 
+    toRescale = []
     for MS in MSs.getListStr():
         with pt.table(MS+'/HISTORY', readonly=False, ack=False) as hist:
             if "Flux rescaled" not in hist.getcol('MESSAGE'):
-                s.add('taql "update %s set DATA = %f*DATA" && taql "insert into %s/HISTORY (TIME,MESSAGE) values (mjd(), \'Flux rescaled\')"' % (MS,rescale_factor,MS), \
-                        log='taql.log', commandType='general')
-    s.run(check=True)
+                toRescale.append(MS)
+    if len(toRescale) > 0:
+        lib_ms.AllMSs(toRescale, s, check_flags=False).updateColumns({'DATA': '%f*DATA' % rescale_factor})
+        for MS in toRescale:
+            pt.taql("insert into %s/HISTORY (TIME,MESSAGE) values (mjd(), 'Flux rescaled')" % MS)
 
 ######################################
 # Avg to 4 chan and 2 sec
@@ -90,7 +90,7 @@ with w.if_todo('init_model'):
 
 with w.if_todo('beam'):
     logger.info('Set CORRECTED_DATA = DATA...')
-    MSs.run('taql "update $pathMS set CORRECTED_DATA = DATA"', log='$nameMS_taql.log', commandType='general')
+    MSs.updateColumns({'CORRECTED_DATA': 'DATA'})
 
     # correct beam - group*_TC.MS:CORRECTED_DATA -> group*_TC.MS:CORRECTED_DATA
     logger.info('Correct beam')
@@ -101,8 +101,8 @@ with w.if_todo('beam'):
 with w.if_todo('calibrate'):
     # Smooth CORRECTED_DATA -> SMOOTHED_DATA
     logger.info('BL-based smoothing...')
-    MSs.run('BLsmooth.py -c 8 -n 8 -r -i CORRECTED_DATA -o SMOOTHED_DATA $pathMS', log='$nameMS_smooth.log', commandType='python')
-    MSs.run('BLsmooth.py -c 8 -n 8 -r -i MODEL_DATA -o MODEL_DATA $pathMS', log='$nameMS_smooth.log', commandType='python')
+    lib_util.run_blsmooth(s, 'smooth.log', MSs.getStrWsclean(), '-c 8 -r -i CORRECTED_DATA -o SMOOTHED_DATA')
+    lib_util.run_blsmooth(s, 'smooth-model.log', MSs.getStrWsclean(), '-c 8 -r -i MODEL_DATA -o MODEL_DATA')
 
     # solve amp+ph - ms:SMOOTHED_DATA
     logger.info('Solving amp+ph...')
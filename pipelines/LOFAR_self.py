@@ -38,6 +38,7 @@ with w.if_todo('cleaning'):
 ### DONE
 
 MSs = lib_ms.AllMSs( glob.glob('mss/TC*[0-9].MS'), s )
+tmpcols = lib_ms.TempColumns(MSs) # scratch columns, removed at the end of the step that registers them
 try:
     MSs.print_HAcov()
 except:
@@ -82,7 +83,12 @@ for MS in MSs.getListStr():
     logger.debug('Copy: ' + sourcedb + ' -> ' + MS)
     os.system('cp -r ' + sourcedb + ' ' + MS)
 
-with w.if_todo('init_model'):
+# steps declare as inputs the parsets, solutions and images they use and as params the config values,
+# a completed step is re-done if they change (MS columns are not declared: they are modified by later steps)
+userRegs = [userReg] if userReg != '' else []
+
+# re-done if the (original) sourcedb changes, e.g. after editing lilf.config
+with w.if_todo('init_model', inputs=[sourcedb, parset_dir+'/DP3-predict.parset'], params={'apparent': apparent}):
 
     # note: do not add MODEL_DATA or the beam is transported from DATA, while we want it without beam applied
     logger.info('Creating CORRECTED_DATA...')
@@ -108,10 +114,10 @@ for c in range(2):
     if c == 0:
         with w.if_todo('set_corrected_data'):
             logger.info('Set CORRECTED_DATA = DATA...')
-            MSs.run('taql "update $pathMS set CORRECTED_DATA = DATA"', log='$nameMS_taql-c'+str(c)+'.log', commandType='general')
+            MSs.updateColumns({'CORRECTED_DATA': 'DATA'})
         ### DONE
     else:
-        with w.if_todo('cor_g_c%02i' % c):
+        with w.if_todo('cor_g_c%02i' % c, inputs=[parset_dir+'/DP3-cor.parset', 'self/solutions/cal-g-c0.h5']):
             # initial correction for slow gain after first cycle
             # correct G - group*_TC.MS:CORRECTED_DATA -> group*_TC.MS:CORRECTED_DATA
             logger.info('Correcting G...')
@@ -119,9 +125,9 @@ for c in range(2):
                 'DP3 ' + parset_dir + '/DP3-cor.parset msin=$pathMS msin.datacolumn=CORRECTED_DATA cor.parmdb=self/solutions/cal-g-c0.h5 cor.correction=amplitudeSmooth', \
                 log='$nameMS_corG-c' + str(c) + '.log', commandType='DP3')
     if c == 0:
-        with w.if_todo('solve_fr_c%02i' % c):
+        with w.if_todo('solve_fr_c%02i' % c, inputs=[parset_dir+'/DP3-solFR.parset', parset_dir+'/losoto-fr.parset']):
             logger.info('Add column CIRC_PHASEDIFF_DATA...')
-            MSs.addcol('CIRC_PHASEDIFF_DATA', 'CORRECTED_DATA', usedysco=False)
+            tmpcols.add('CIRC_PHASEDIFF_DATA', 'CORRECTED_DATA', usedysco=False)
             # Probably we do not need smoothing since we have long time intervals and smoothnessconstraint?
             # logger.info('BL-smooth...')
             # MSs.run('BLsmooth.py -r -c 1 -n 8 -i CIRC_PHASEDIFF_DATA -o CIRC_PHASEDIFF_DATA $pathMS',
@@ -134,17 +140,11 @@ for c in range(2):
                     commandType='python', maxThreads=2)
 
             # Get circular phase diff CIRC_PHASEDIFF_DATA -> CIRC_PHASEDIFF_DATA
-            logger.info('Get circular phase difference...')
-            MSs.run('taql "UPDATE $pathMS SET\
-             CIRC_PHASEDIFF_DATA[,0]=0.5*EXP(1.0i*(PHASE(CIRC_PHASEDIFF_DATA[,0])-PHASE(CIRC_PHASEDIFF_DATA[,3]))), \
-             CIRC_PHASEDIFF_DATA[,3]=CIRC_PHASEDIFF_DATA[,0], \
-             CIRC_PHASEDIFF_DATA[,1]=0+0i, \
-             CIRC_PHASEDIFF_DATA[,2]=0+0i"', log='$nameMS_taql_phdiff.log', commandType='general')
-
-            logger.info('Creating FR_MODEL_DATA...')  # take from MODEL_DATA but overwrite
-            MSs.addcol('FR_MODEL_DATA', 'MODEL_DATA', usedysco=False)
-            MSs.run('taql "UPDATE $pathMS SET FR_MODEL_DATA[,0]=0.5+0i, FR_MODEL_DATA[,1]=0.0+0i, FR_MODEL_DATA[,2]=0.0+0i, \
-             FR_MODEL_DATA[,3]=0.5+0i"', log='$nameMS_taql_frmodel.log', commandType='general')
+            # and create FR_MODEL_DATA (like CIRC_PHASEDIFF_DATA, so no dysco) in the same pass
+            logger.info('Get circular phase difference and create FR_MODEL_DATA...')
+            MSs.updateColumns([('CIRC_PHASEDIFF_DATA', lambda cols: lib_ms.circPhaseDiff(cols['CIRC_PHASEDIFF_DATA'])),
+                               ('FR_MODEL_DATA', 'np.array([0.5+0j, 0, 0, 0.5])')], inputs=['CIRC_PHASEDIFF_DATA'])
+            tmpcols.register('FR_MODEL_DATA')
 
             # Solve cal_SB.MS:CIRC_PHASEDIFF_DATA against FR_MODEL_DATA (only solve)
             logger.info('Solving circ phase difference ...')
@@ -153,12 +153,9 @@ for c in range(2):
             lib_util.run_losoto(s, f'fr-c{c}', [ms + '/fr.h5' for ms in MSs.getListStr()], [parset_dir + '/losoto-fr.parset'])
             os.system('mv cal-fr-c' + str(c) + '.h5 self/solutions/')
             os.system('mv plots-fr-c' + str(c) + ' self/plots/')
-            # Delete cols again to not waste space
-            MSs.run('taql "ALTER TABLE $pathMS DELETE COLUMN CIRC_PHASEDIFF_DATA, FR_MODEL_DATA"',
-                    log='$nameMS_taql_delcol.log', commandType='general')
         ### DONE
 
-    with w.if_todo('cor_fr_c%02i' % c):
+    with w.if_todo('cor_fr_c%02i' % c, inputs=[parset_dir+'/DP3-cor.parset', 'self/solutions/cal-fr-c0.h5']):
         # Correct FR with results of cycle 0 - group*_TC.MS:CORRECTED_DATA -> group*_TC.MS:CORRECTED_DATA
         logger.info('Correcting FR...')
         MSs.run('DP3 ' + parset_dir + '/DP3-cor.parset msin=$pathMS msin.datacolumn=CORRECTED_DATA \
@@ -166,11 +163,12 @@ for c in range(2):
                 log='$nameMS_corFR-c' + str(c) + '.log', commandType='DP3')
     ### DONE
 
-    with w.if_todo('solve_tec1_c%02i' % c):
+    with w.if_todo('solve_tec1_c%02i' % c, inputs=[parset_dir+'/DP3-solTEC.parset', parset_dir+'/losoto-plot-tec.parset']):
         # Smooth CORRECTED_DATA -> SMOOTHED_DATA
         logger.info('BL-based smoothing...')
-        MSs.run('BLsmooth.py -c 8 -n 8 -r -i CORRECTED_DATA -o SMOOTHED_DATA $pathMS', log='$nameMS_smooth-c'+str(c)+'.log', commandType='python')
-        MSs.run('BLsmooth.py -c 8 -n 8 -r -i MODEL_DATA -o MODEL_DATA $pathMS', log='$nameMS_smooth-c'+str(c)+'.log', commandType='python')
+        lib_util.run_blsmooth(s, 'smooth-c'+str(c)+'.log', MSs.getStrWsclean(), '-c 8 -r -i CORRECTED_DATA -o SMOOTHED_DATA')
+        tmpcols.register('SMOOTHED_DATA')
+        lib_util.run_blsmooth(s, 'smooth-model-c'+str(c)+'.log', MSs.getStrWsclean(), '-c 8 -r -i MODEL_DATA -o MODEL_DATA')
 
         # solve TEC - ms:SMOOTHED_DATA
         logger.info('Solving TEC1...')
@@ -185,7 +183,7 @@ for c in range(2):
         os.system('mv plots-tec1-c'+str(c)+' self/plots/')
     ### DONE
 
-    with w.if_todo('cor_tec1_c%02i' % c):
+    with w.if_todo('cor_tec1_c%02i' % c, inputs=[parset_dir+'/DP3-cor.parset', 'self/solutions/cal-tec1-c'+str(c)+'.h5']):
         # correct TEC - group*_TC.MS:CORRECTED_DATA -> group*_TC.MS:CORRECTED_DATA
         logger.info('Correcting TEC1...')
         MSs.run('DP3 '+parset_dir+'/DP3-cor.parset msin=$pathMS msin.datacolumn=CORRECTED_DATA\
@@ -193,10 +191,11 @@ for c in range(2):
                 log='$nameMS_corTEC-c'+str(c)+'.log', commandType='DP3')
     ### DONE
 
-    with w.if_todo('solve_tec2_c%02i' % c):
+    with w.if_todo('solve_tec2_c%02i' % c, inputs=[parset_dir+'/DP3-solTEC.parset', parset_dir+'/losoto-plot-tec.parset']):
         # Smooth CORRECTED_DATA -> SMOOTHED_DATA
         logger.info('BL-based smoothing...')
-        MSs.run('BLsmooth.py -c 8 -n 8 -r -i CORRECTED_DATA -o SMOOTHED_DATA $pathMS', log='$nameMS_smooth-c'+str(c)+'.log', commandType='python')
+        lib_util.run_blsmooth(s, 'smooth-c'+str(c)+'.log', MSs.getStrWsclean(), '-c 8 -r -i CORRECTED_DATA -o SMOOTHED_DATA')
+        tmpcols.register('SMOOTHED_DATA')
 
         # solve TEC - ms:SMOOTHED_DATA
         logger.info('Solving TEC2...')
@@ -210,7 +209,7 @@ for c in range(2):
         os.system('mv plots-tec2-c'+str(c)+' self/plots/')
     ### DONE
 
-    with w.if_todo('cor_tec2_c%02i' % c):
+    with w.if_todo('cor_tec2_c%02i' % c, inputs=[parset_dir+'/DP3-cor.parset', 'self/solutions/cal-tec2-c'+str(c)+'.h5']):
         # correct TEC - group*_TC.MS:CORRECTED_DATA -> group*_TC.MS:CORRECTED_DATA
         logger.info('Correcting TEC2...')
         MSs.run('DP3 '+parset_dir+'/DP3-cor.parset msin=$pathMS msin.datacolumn=CORRECTED_DATA\
@@ -220,7 +219,8 @@ for c in range(2):
 
     # AMP DIE correction
     if c == 0:
-        with w.if_todo('solve_g_c%02i' % c):
+        with w.if_todo('solve_g_c%02i' % c, inputs=[parset_dir+'/DP3-solG.parset', parset_dir+'/losoto-plot-amp.parset',
+                                                   parset_dir+'/losoto-plot-ph.parset', parset_dir+'/losoto-amp.parset']):
             # DIE Calibration - ms:CORRECTED_DATA
             logger.info('Solving slow G...')
             MSs.run('DP3 '+parset_dir+'/DP3-solG.parset msin=$pathMS sol.h5parm=$pathMS/g.h5',
@@ -231,7 +231,7 @@ for c in range(2):
             os.system('mv cal-g-c'+str(c)+'.h5 self/solutions/')
         ### DONE
 
-        with w.if_todo('cor_g_c%02i' % c):
+        with w.if_todo('cor_g_c%02i' % c, inputs=[parset_dir+'/DP3-cor.parset', 'self/solutions/cal-g-c'+str(c)+'.h5']):
             # correct G - group*_TC.MS:CORRECTED_DATA -> group*_TC.MS:CORRECTED_DATA
             logger.info('Correcting G...')
             MSs.run('DP3 '+parset_dir+'/DP3-cor.parset msin=$pathMS msin.datacolumn=CORRECTED_DATA \
@@ -245,7 +245,8 @@ for c in range(2):
     imagename = 'img/wide-0'
     maskname = imagename + '-mask.fits'
     imagenameM = 'img/wideM-'+str(c)
-    with w.if_todo('imaging_c%02i' % c):
+    with w.if_todo('imaging_c%02i' % c, inputs=userRegs + ([maskname] if c > 0 else []),
+                   params={'userReg': userReg, 'imgsizepix': imgsizepix, 'cc_fit_order': cc_fit_order}):
         logger.info('Cleaning (cycle: '+str(c)+')...')
         if c == 0:
             # make temp mask for cycle 0, in cycle 1 use the maske made from cycle 0 image
@@ -280,7 +281,7 @@ for c in range(2):
         with w.if_todo('lowres_setdata_c%02i' % c):
             # Subtract model from all TCs - ms:CORRECTED_DATA - MODEL_DATA -> ms:CORRECTED_DATA (selfcal corrected, beam corrected, high-res model subtracted)
             logger.info('Subtracting high-res model (CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA)...')
-            MSs.run('taql "update $pathMS set CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA"', log='$nameMS_taql-c'+str(c)+'.log', commandType='general')
+            MSs.updateColumns({'CORRECTED_DATA': 'CORRECTED_DATA - MODEL_DATA'})
         ### DONE
     
         with w.if_todo('lowres_img_c%02i' % c):
@@ -309,7 +310,7 @@ for c in range(2):
         with w.if_todo('lowres_sub_c%02i' % c):
             # Subtract low-res model - CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA
             logger.info('Subtracting low-res model (CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA)...')
-            MSs.run('taql "update $pathMS set CORRECTED_DATA = CORRECTED_DATA - MODEL_DATA"', log='$nameMS_taql-c'+str(c)+'.log', commandType='general')
+            MSs.updateColumns({'CORRECTED_DATA': 'CORRECTED_DATA - MODEL_DATA'})
         ### DONE
 
         with w.if_todo('lowres_lsimg_c%02i' % c):
@@ -327,14 +328,15 @@ for c in range(2):
                                  auto_threshold=0.5, join_channels='', channels_out=MSs.getChout(4.e6))
         ### DONE
 
-        with w.if_todo('lowres_flag_c%02i' % c):
+        with w.if_todo('lowres_flag_c%02i' % c, inputs=[parset_dir+'/DP3-flag.parset', parset_dir+'/LBAdefaultwideband.lua']):
             # Flag on residuals (CORRECTED_DATA)
             logger.info('Flagging residuals...')
             MSs.run('DP3 '+parset_dir+'/DP3-flag.parset msin=$pathMS aoflagger.strategy='+parset_dir+'/LBAdefaultwideband.lua',
                     log='$nameMS_flag-c'+str(c)+'.log', commandType='DP3')
         ### DONE
 
-        with w.if_todo('lowres_corrupt_c%02i' % c):
+        with w.if_todo('lowres_corrupt_c%02i' % c, inputs=[parset_dir+'/DP3-cor.parset'] +
+                       ['self/solutions/cal-%s-c%i.h5' % (sol, c) for sol in ['tec1', 'tec2', 'fr', 'g']]):
             ##############################################
             # Prepare SUBTRACTED_DATA
     
@@ -360,10 +362,10 @@ for c in range(2):
         with w.if_todo('lowres_subtract_c%02i' % c):
             # Subtract low-res model - CORRECTED_DATA = DATA - MODEL_DATA
             logger.info('Subtracting low-res model (CORRECTED_DATA = DATA - MODEL_DATA)...')
-            MSs.run('taql "update $pathMS set CORRECTED_DATA = DATA - MODEL_DATA"', log='$nameMS_taql-c'+str(c)+'.log', commandType='general')
+            MSs.updateColumns({'CORRECTED_DATA': 'DATA - MODEL_DATA'})
         ### DONE
 
-        with w.if_todo('lowres_predict_c%02i' % c):
+        with w.if_todo('lowres_predict_c%02i' % c, inputs=['img/wideM-'+str(c)+'-[0-9]*-model.fits']):
             # Recreate MODEL_DATA for next calibration cycle
             logger.info('Predict model...')
             s.add('wsclean -predict -name img/wideM-'+str(c)+' -j '+str(s.max_processors)+' -channels-out '+str(MSs.getChout(4e6))+' '+MSs.getStrWsclean(), \
@@ -390,4 +392,5 @@ os.system('mv img/wide-lr-MFS-image.fits self/images')
 os.system('mv img/wide-largescale-MFS-image.fits self/images')
 os.system('mv logs self')
 
+tmpcols.report()
 logger.info("Done.")
@@ -34,7 +34,7 @@ lib_util.run_losoto(s, 'core', [MS+'/cal-core.h5' for MS in MSs.getListStr()], \
 logger.info('re-calibration...')
 # predict and corrupt each facet
 logger.info('Reset MODEL_DATA...')
-MSs.run('taql "update $pathMS set MODEL_DATA = 0"', log='$nameMS_taql-c'+str(c)+'.log', commandType='general')
+MSs.updateColumns({'MODEL_DATA': '0'})
 
 for i, d in enumerate(directions):
     # predict - ms:MODEL_DATA
@@ -48,7 +48,7 @@ for i, d in enumerate(directions):
         log='$nameMS_corrupt1-c'+str(c)+'-'+d.name+'.log', commandType='DP3')
 
     logger.info('Patch '+d.name+': subtract...')
-    MSs.run('taql "update $pathMS set MODEL_DATA = MODEL_DATA + MODEL_DATA_DIR"', log='$nameMS_taql-c'+str(c)+'-'+d.name+'.log', commandType='general')
+    MSs.updateColumns({'MODEL_DATA': 'MODEL_DATA + MODEL_DATA_DIR'})
 
 
 
@@ -135,11 +135,14 @@ with w.if_todo('flag'):
             log='$nameMS_DP3_flag.log', commandType='DP3')
 
     logger.info('Remove bad timestamps...')
-    MSs.run( 'flagonmindata.py -f 0.5 $pathMS', log='$nameMS_flagonmindata.log', commandType='python')
+    s.add(f'flagonmindata.py -f 0.5 -n {s.max_processors} {MSs.getStrWsclean()}', log='flagonmindata.log',
+          commandType='python', processors='max')
+    s.run(check=True)
 
     logger.info('Plot weights...')
-    MSs.run(f'reweight.py $pathMS -v -p -a {"CS001HBA0" if MSs.isHBA else "CS001LBA"}',
-            log='$nameMS_weights.log', commandType='python')
+    s.add(f'reweight.py {MSs.getStrWsclean()} -v -p -n {s.max_processors} -a {"CS001HBA0" if MSs.isHBA else "CS001LBA"}',
+          log='weights.log', commandType='python', processors='max')
+    s.run(check=True)
     lib_util.check_rm('plots-weights')
     os.system('mkdir plots-weights; mv *png plots-weights')
 ### DONE
@@ -153,13 +156,14 @@ with w.if_todo('timesplit'):
     for groupname in groupnames:
         ms = groupname+'/'+groupname+'.MS'
         if not os.path.exists(ms): continue
+        times = lib_ms.MS(ms, skyPositions=False).getTimeIndex()['times']
         t = pt.table(ms, ack=False)
         starttime = t[0]['TIME']
         endtime   = t[t.nrows()-1]['TIME']
         hours = (endtime-starttime)/3600.
         logger.debug(ms+' has length of '+str(hours)+' h.')
 
-        for timerange in np.array_split(sorted(set(t.getcol('TIME'))), round(hours)):
+        for timerange in np.array_split(times, round(hours)):
             logger.info('%02i - Splitting timerange %f %f' % (tc, timerange[0], timerange[-1]))
             t1 = t.query('TIME >= ' + str(timerange[0]) + ' && TIME <= ' + str(timerange[-1]), sortlist='TIME,ANTENNA1,ANTENNA2')
             splitms = groupname+'/TC%02i.MS' % tc
@@ -77,6 +77,6 @@ for msID in msIDs:
     
     # TODO: for now just use the un-splitted files
     logger.info('Set DATA = CORRECTED_DATA...')
-    MSs_tgts.run('taql "update $pathMS set DATA = CORRECTED_DATA"', log='$nameMS_taql1.log', commandType='general')
+    MSs_tgts.updateColumns({'DATA': 'CORRECTED_DATA'})
 
 logger.info("Done.")
@@ -173,7 +173,7 @@ image_small.makeMask(threshisl=5, atrous_do=True)
 
 # Move DIE-corrected data into CORRECTED_DATA_DIE
 logger.info('Set CORRECTED_DATA_DIE = CORRECTED_DATA...')
-MSs.run('taql "update $pathMS set CORRECTED_DATA_DIE = CORRECTED_DATA"', log='$nameMS_taql2.log', commandType='general')
+MSs.updateColumns({'CORRECTED_DATA_DIE': 'CORRECTED_DATA'})
 
 # TESTTESTTEST
 imgsizepix = int(1.5*MSs.getListObj()[0].getFWHM()/(2./3600))
@@ -294,7 +294,7 @@ for c in range(3):
 
     # Empty dataset from faint sources (TODO: better corrupt with DDE solutions when available before subtract)
     logger.info('Set SUBTRACTED_DATA = CORRECTED_DATA_DIE - MODEL_DATA...')
-    MSs.run('taql "update $pathMS set SUBTRACTED_DATA = CORRECTED_DATA_DIE - MODEL_DATA"', log='$nameMS_taql1-c'+str(c)+'.log', commandType='general')
+    MSs.updateColumns({'SUBTRACTED_DATA': 'CORRECTED_DATA_DIE - MODEL_DATA'})
 
     # TESTTESTTEST
     imgsizepix = int(1.5*MSs.getListObj()[0].getFWHM()/(2./3600))
@@ -322,7 +322,7 @@ for c in range(3):
     ###########################################################
     # Empty the dataset
     logger.info('Set SUBTRACTED_DATA = CORRECTED_DATA_DIE...')
-    MSs.run('taql "update $pathMS set SUBTRACTED_DATA = CORRECTED_DATA_DIE"', log='$nameMS_taql2-c'+str(c)+'.log', commandType='general')
+    MSs.updateColumns({'SUBTRACTED_DATA': 'CORRECTED_DATA_DIE'})
 
     logger.info('Subtraction...')
 
@@ -340,7 +340,7 @@ for c in range(3):
 
         # subtract - ms:SUBTRACTED_DATA = SUBTRACTED_DATA - MODEL_DATA
         logger.info('Patch '+d.name+': subtract...')
-        MSs.run('taql "update $pathMS set SUBTRACTED_DATA = SUBTRACTED_DATA - MODEL_DATA"', log='$nameMS_taql3-c'+str(c)+'-'+d.name+'.log', commandType='general')
+        MSs.updateColumns({'SUBTRACTED_DATA': 'SUBTRACTED_DATA - MODEL_DATA'})
 
     ###########################################################
     # Facet imaging
@@ -358,7 +358,7 @@ for c in range(3):
                  log='$nameMS_corrupt2-c'+str(c)+'-'+d.name+'.log', commandType='DP3')
 
         logger.info('Patch '+d.name+': add...')
-        MSs.run('taql "update $pathMS set CORRECTED_DATA = SUBTRACTED_DATA + MODEL_DATA"', log='$nameMS_taql4-c'+str(c)+'-'+d.name+'.log', commandType='general')
+        MSs.updateColumns({'CORRECTED_DATA': 'SUBTRACTED_DATA + MODEL_DATA'})
 
         # DD-correct - ms:CORRECTED_DATA -> ms:CORRECTED_DATA
         logger.info('Patch '+d.name+': correct...')
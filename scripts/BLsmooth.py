@@ -17,19 +17,21 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-# Usage: BLsmooth.py vis.MS [--options]
-# Load a MS, smooth visibilities according to the baseline length,
-# i.e. shorter BLs are averaged more, and write a new column to the MS
+# Usage: BLsmooth.py vis.MS [vis2.MS ...] [--options]
+# Load one or more MSs, smooth visibilities according to the baseline length,
+# i.e. shorter BLs are averaged more, and write a new column to each MS
 
-import os, sys
+import os, sys, mmap
+import multiprocessing
 import optparse
 import logging
 import numpy as np
 from scipy.ndimage import gaussian_filter1d as gfilter
+from scipy.signal import fftconvolve
 
 import casacore.tables as pt
 
-from LiLF.lib_multiproc import multiprocManager
+from LiLF import lib_ms
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s: %(message)s')
 logging.info('BL-based smoother - Francesco de Gasperin, Henrik Edler')
@@ -37,35 +39,70 @@ logging.info('BL-based smoother - Francesco de Gasperin, Henrik Edler')
 
 def addcol(ms, incol, outcol):
     """ Add a new column to a MS. """
+    # virtual columns cannot be written, nor the columns they reference
+    lib_ms.MS.materialiseWritten(ms, [outcol], overwritten=[outcol] if outcol != incol else [])
     if outcol not in ms.colnames():
         logging.info('Adding column: '+outcol)
-        coldmi = ms.getdminfo(incol)
-        coldmi['NAME'] = outcol
-        ms.addcols(pt.makecoldesc(outcol, ms.getcoldesc(incol)), coldmi)
+        lib_ms.MS.addColumnLike(ms, outcol, incol)
     if (outcol != incol):
         # copy columns val
         logging.info('Set '+outcol+'='+incol)
-        pt.taql("UPDATE $ms SET "+outcol+"="+incol)
+        stats = lib_ms.copyColumn(ms, incol, outcol)
+        logging.info('Copied %.0f MB (%.0f MB/s)' % (stats['bytes']/1e6, stats['bytes']/1e6/stats['time']))
 
 
-def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
+def quantise(std, step):
     """
-    Smooth one baseline.
+    Round sigmas on a logarithmic grid of relative step "step", so that similar kernels become the same
+    """
+    if step == 0:
+        return std
+    return np.exp(np.round(np.log(std) / np.log1p(step)) * np.log1p(step))
+
+
+def use_fft(sigma, n):
+    """
+    Return True if a kernel of sigma samples is applied as an FFT convolution on an axis of n samples (see: gsmooth())
+    """
+    return options.fftsigma != 0 and sigma >= options.fftsigma and n >= 128
+
+
+def gsmooth(a, sigma, axis):
+    """
+    Gaussian filter of a along axis, as gaussian_filter1d(truncate=3) with its 'reflect' boundaries.
+    The direct convolution costs O(sigma) per sample, for large sigma (see: --fftsigma) on long enough axes
+    the same kernel is applied as an FFT convolution instead, whose cost does not grow with sigma.
+    """
+    if not use_fft(sigma, a.shape[axis]):
+        return gfilter(a, sigma, axis=axis, truncate=3)
+    radius = int(3 * sigma + 0.5)
+    kernel = np.exp(-0.5 * (np.arange(-radius, radius+1) / sigma)**2)
+    kernel /= kernel.sum()
+    pad = [(0, 0)] * a.ndim
+    pad[axis] = (radius, radius)
+    shape = [1] * a.ndim
+    shape[axis] = len(kernel)
+    return fftconvolve(np.pad(a, pad, mode='symmetric'), kernel.reshape(shape).astype(a.dtype), mode='valid', axes=axis)
+
+
+def smooth_block(data, weights, std_t, std_f):
+    """
+    Smooth a block of baselines with the same kernel.
     Multiply every element of the data by the weights, convolve both the
     scaled data and the weights, and then divide the convolved data by the
     convolved weights (translating flagged data into weight=0).
     That's basically the equivalent of a running weighted average with a
     Gaussian window function.
+    Real part, imaginary part (or amplitude) and weights are stacked and
+    filtered together, one call per axis for the whole block.
     see also: https://stackoverflow.com/questions/51728224/gaussian-filtering-image-with-a-cut-off-value-in-python
 
     Parameters
     ----------
-    in_bl: boolean ndarray
-        Mask for everything not in this baseline.
     data: ndarray
-        Data for one baseline that is to be smoothed.
+        Data of the baselines to smooth, shape (baseline, time, freq, pol).
     weights: ndarray
-        Weight input.
+        Weight input, same shape of data.
     std_t: float
         Standard deviation in samples to use for time-smoothing.
     std_f: float
@@ -73,48 +110,235 @@ def smooth_baseline(in_bl, data, weights, std_t, std_f, outQueue=None):
 
     Returns
     -------
-    in_bl: boolean ndarray
-        Mask for everything not in this baseline.
     data: ndarray.
-        Smoothed ata for one baseline.
+        Smoothed data.
     weights: ndarray
         Weight output.
     """
+    npol = data.shape[-1]
     data = np.nan_to_num(data * weights) # set bad data to 0 so nans don't propagate
-    if np.isnan(data).all():
-        return in_bl, data, weights # flagged ants
     # smear weighted data and weights
     if options.onlyamp: # smooth only amplitudes
-        dataAMP, dataPH = np.abs(data), np.angle(data)
-        if not options.notime:
-            dataAMP = gfilter(dataAMP, std_t, axis=0, truncate=3)
-        if not options.nofreq:
-            dataAMP = gfilter(dataAMP, std_f, axis=1, truncate=3)
-        data = dataAMP * (np.cos(dataPH) + 1j * np.sin(dataPH)) # recreate data
+        stack = np.concatenate([np.abs(data), weights], axis=-1)
     else:
-        dataR, dataI = np.real(data), np.imag(data)
-        if not options.notime:
-            dataR = gfilter(dataR, std_t, axis=0, truncate=3)
-            dataI = gfilter(dataI, std_t, axis=0, truncate=3)
-        if not options.nofreq:
-            dataR = gfilter(dataR, std_f, axis=1, truncate=3)
-            dataI = gfilter(dataI, std_f, axis=1, truncate=3)
-        data = dataR + 1j*dataI # recreate data
+        stack = np.concatenate([data.real, data.imag, weights], axis=-1)
     if not options.notime:
-        weights = gfilter(weights, std_t, axis=0, truncate=3)
+        stack = gsmooth(stack, std_t, axis=1)
     if not options.nofreq:
-        weights = gfilter(weights, std_f, axis=1, truncate=3)
+        stack = gsmooth(stack, std_f, axis=2)
+    # FFT convolutions leave round-off noise (also negative) where the direct one gives 0, e.g. in long flagged
+    # stretches: dividing by it would blow up the data, so clip it and set weights and data there to 0
+    if (not options.notime and use_fft(std_t, stack.shape[1])) or (not options.nofreq and use_fft(std_f, stack.shape[2])):
+        weights = stack[..., -npol:]
+        weights[weights < 10 * np.finfo(stack.dtype).eps * weights.max()] = 0
+        stack[..., :-npol][np.tile(weights == 0, (1, 1, 1, stack.shape[-1] // npol - 1))] = 0
+    if options.onlyamp:
+        dataPH = np.angle(data)
+        data = stack[..., :npol] * (np.cos(dataPH) + 1j * np.sin(dataPH)) # recreate data
+    else:
+        data = stack[..., :npol] + 1j*stack[..., npol:2*npol] # recreate data
+    weights = stack[..., -npol:]
     data[(weights != 0)] /= weights[(weights != 0)]  # avoid divbyzero
+    return data, weights
+
+
+def shared_array(nbytes):
+    """
+    Return a byte array in anonymous shared memory: worker processes forked after its creation see it and write in it
+    """
+    buf = mmap.mmap(-1, max(1, int(nbytes)))
+    return np.frombuffer(buf, dtype=np.uint8)
+
+
+def chunk_array(buf, nrows, shape, dtype):
+    """
+    View of the first nrows rows of cells of shape and dtype in the byte buffer buf
+    """
+    nbytes = nrows * int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return buf[:nbytes].view(dtype).reshape((nrows,) + tuple(shape))
+
+
+def by_baseline(col, n_t, nbl):
+    """
+    View of the rows of a chunk of nbl baselines, ordered (time, baseline), with shape (baseline, time, ...)
+    """
+    return col[:n_t*nbl].reshape((n_t, nbl) + col.shape[1:]).swapaxes(0, 1)
+
+
+def smooth_group(job):
+    """
+    Smooth in place, in the shared chunk buffers, baselines that share the same kernel (see: smooth_block())
+    job: (buffer slot, timestamps, number of baselines in the chunk, cell shape, data dtype,
+          indexes of the baselines to smooth, std_t, std_f)
+    """
+    slot, n_t, nbl, shape, dtype, bls, std_t, std_f = job
+    data = by_baseline(chunk_array(shared['data'][slot], n_t*nbl, shape, dtype), n_t, nbl)
+    weights = by_baseline(chunk_array(shared['weights'][slot], n_t*nbl, shape, np.float32), n_t, nbl)
+    data[bls], weights[bls] = smooth_block(data[bls], weights[bls], std_t, std_f)
 
-    # print( np.count_nonzero(data[~flags[in_bl]]), np.count_nonzero(data[flags[in_bl]]), 100*np.count_nonzero(data[flags[in_bl]])/np.count_nonzero(data))
-    # print( "NANs in flagged data: ", np.count_nonzero(np.isnan(data[flags[in_bl]])))
-    # print( "NANs in unflagged data: ", np.count_nonzero(np.isnan(data[~flags[in_bl]])))
-    # print( "NANs in weights: ", np.count_nonzero(np.isnan(weights)))
-    outQueue.put([in_bl, data, weights])
 
+class SmoothMS(object):
+    """
+    Baselines, kernels and chunks of a MS to smooth.
+    Rows are selected by index, so the MS does not need to be time-sorted.
+    """
+    def __init__(self, msfile):
+        self.msfile = msfile
+        self.name = os.path.basename(msfile.rstrip('/'))
+        self.ms = pt.table(msfile, readonly=False, ack=False)
+
+        with pt.table(msfile + '::SPECTRAL_WINDOW', ack=False) as freqtab:
+            freq = freqtab.getcol('REF_FREQUENCY')[0]
+            self.freqpersample = np.mean(freqtab.getcol('RESOLUTION'))
+            self.timepersample = self.ms.getcell('INTERVAL',0)
+
+        # get info on all baselines
+        ms = self.ms
+        with pt.taql("SELECT ANTENNA1,ANTENNA2,sqrt(sumsqr(UVW)),GCOUNT() FROM $ms GROUPBY ANTENNA1,ANTENNA2") as BL:
+            self.ants1, self.ants2 = BL.getcol('ANTENNA1'), BL.getcol('ANTENNA2')
+            self.dists = BL.getcol('Col_3')/1e3 # baseleline length in km
+            self.n_t = BL.getcol('Col_4')[0] # number of timesteps
+            self.n_bl = len(self.ants1)
+
+        # kernel of each baseline
+        with np.errstate(divide='ignore'):
+            std_t = options.ionfactor * (25.e3 / self.dists) ** options.bscalefactor * (freq / 60.e6)  # in sec
+            self.std_t = std_t / self.timepersample  # in samples
+            # TODO: for freq this is hardcoded, it should be thought better
+            # However, the limitation is probably smearing here
+            std_f = 1e6 / self.dists  # Hz
+            self.std_f = std_f / self.freqpersample  # in samples
+        # skip autocorrelations, missing antennas and very small smoothing (and flagged ants)
+        self.to_smooth = (self.ants1 != self.ants2) & ~np.isnan(self.dists) & (self.std_t >= 0.5)
+
+        self.chunks = [idx for idx in np.array_split(np.arange(self.n_bl), options.chunks) if len(idx) > 0]
+        cell = self.ms.getcell(options.incol, 0)
+        self.shape, self.dtype = cell.shape, cell.dtype
+        self.row_bl = self.row_time = None
+
+    def chunk_bytes(self):
+        """
+        Return the bytes of the data and weights of the largest chunk
+        """
+        nrows = self.n_t * max([len(idx) for idx in self.chunks])
+        return nrows * int(np.prod(self.shape)) * self.dtype.itemsize, nrows * int(np.prod(self.shape)) * 4
+
+    def prepare(self):
+        """
+        Index the rows by baseline and timestamp and create the output columns
+        """
+        logging.info('Smoothing %s.' % self.msfile)
+        # baseline and timestamp of each row, to select the rows of a chunk of baselines
+        bl_lookup = np.full((max(self.ants1.max(), self.ants2.max())+1,)*2, -1)
+        bl_lookup[self.ants1, self.ants2] = np.arange(self.n_bl)
+        self.row_bl = bl_lookup[self.ms.getcol('ANTENNA1'), self.ms.getcol('ANTENNA2')]
+        self.row_time = np.unique(self.ms.getcol('TIME_CENTROID'), return_inverse=True)[1]
+
+        # create column to smooth
+        addcol(self.ms, options.incol, options.outcol)
+        # restore WEIGHT_SPECTRUM
+        if 'WEIGHT_SPECTRUM_ORIG' in self.ms.colnames() and options.restore:
+            addcol(self.ms, 'WEIGHT_SPECTRUM_ORIG', 'WEIGHT_SPECTRUM')
+        # backup WEIGHT_SPECTRUM
+        elif options.weight and not options.nobackup:
+            addcol(self.ms, 'WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_ORIG')
+
+    def close(self):
+        self.ms.close()
+        self.row_bl = self.row_time = None
+
+    def chunk_rows(self, idx):
+        """
+        Return the rows of the baselines idx (a range of baseline indexes) ordered by (time, baseline)
+        """
+        rows = np.flatnonzero((self.row_bl >= idx[0]) & (self.row_bl <= idx[-1]))
+        return rows[np.lexsort((self.row_bl[rows], self.row_time[rows]))]
+
+    def buffers(self, slot, nrows):
+        """
+        Return the data and weights of nrows rows in the buffer slot
+        """
+        return chunk_array(shared['data'][slot], nrows, self.shape, self.dtype), \
+               chunk_array(shared['weights'][slot], nrows, self.shape, np.float32)
+
+    def read_chunk(self, c, slot):
+        """
+        Read data and weights of chunk c in the buffer slot, setting to 0 the weights of flagged and NaN data
+        Return the table of the chunk rows.
+        """
+        logging.debug('### Fetching chunk {}/{}'.format(c+1, len(self.chunks)))
+        chunk = self.ms.selectrows(self.chunk_rows(self.chunks[c]))
+        if chunk.nrows() != self.n_t * len(self.chunks[c]):
+            logging.critical('This code cannot handle MS with baselines missing in some timestamps.')
+            sys.exit(1)
+        data, weights = self.buffers(slot, chunk.nrows())
+        chunk.getcolnp(options.incol, data)
+        chunk.getcolnp('WEIGHT_SPECTRUM', weights)
+        # flag NaNs and set weights to zero
+        flags = chunk.getcol('FLAG')
+        flags[np.isnan(data)] = True
+        weights[flags] = 0
+        return chunk
+
+    def write_chunk(self, c, slot, chunk):
+        """
+        Write the smoothed buffers of chunk c, baselines not smoothed keep the input data
+        """
+        logging.info('Writing %s column (chunk %i/%i).' % (options.outcol, c+1, len(self.chunks)))
+        data, weights = self.buffers(slot, chunk.nrows())
+        chunk.putcol(options.outcol, data)
+        if options.weight:
+            # baselines not smoothed get weight 0
+            by_baseline(weights, self.n_t, len(self.chunks[c]))[~self.to_smooth[self.chunks[c]]] = 0
+            logging.warning('Writing WEIGHT_SPECTRUM column.')
+            chunk.putcol('WEIGHT_SPECTRUM', weights)
+        chunk.close()
 
+    def chunk_jobs(self, c, slot):
+        """
+        Return the jobs to smooth chunk c: baselines with the same kernel are grouped,
+        large groups are split to share them among the workers
+        """
+        idx = self.chunks[c]
+        groups = {}
+        for i_chunk, i_bl in enumerate(idx):
+            if not self.to_smooth[i_bl]:
+                continue
+            key = (quantise(self.std_t[i_bl], options.kernelstep), quantise(self.std_f[i_bl], options.kernelstep))
+            groups.setdefault(key, []).append(i_chunk)
+        jobs = []
+        job_size = int(np.ceil(len(idx) / (4 * options.ncpu)))
+        for (std_t_group, std_f_group), bls in groups.items():
+            logging.debug("{} baselines (dist = {:.2f}-{:.2f}km) -Time: sig={:.1f} samples ({:.1f}s) -Freq: sig={:.1f} samples ({:.2f}MHz)".format(
+                len(bls), self.dists[idx[bls]].min(), self.dists[idx[bls]].max(), std_t_group, self.timepersample * std_t_group,
+                std_f_group, self.freqpersample * std_f_group / 1e6))
+            jobs += [(slot, self.n_t, len(idx), self.shape, self.dtype, bls[i:i+job_size], std_t_group, std_f_group)
+                     for i in range(0, len(bls), job_size)]
+        jobs.sort(key=lambda job: len(job[5]), reverse=True)
+        return jobs
 
-opt = optparse.OptionParser(usage="%prog [options] MS", version="%prog 3.0")
+
+def read(i):
+    """
+    Read the i-th chunk of the sequence of all MSs in its buffer slot, preparing its MS before the first one
+    """
+    ms, c = chunks[i]
+    if c == 0:
+        ms.prepare()
+    return ms.read_chunk(c, i % 3)
+
+
+def write(i, chunk):
+    """
+    Write the i-th chunk of the sequence of all MSs, closing its MS after the last one
+    """
+    ms, c = chunks[i]
+    ms.write_chunk(c, i % 3, chunk)
+    if c == len(ms.chunks)-1:
+        ms.close()
+
+
+opt = optparse.OptionParser(usage="%prog [options] MS [MS ...]", version="%prog 3.0")
 opt.add_option('-f', '--ionfactor', help='Gives an indication on how strong is the ionosphere [default: 0.01]', type='float', default=0.01)
 opt.add_option('-s', '--bscalefactor', help='Gives an indication on how the smoothing varies with BL-lenght [default: 1.0]', type='float', default=1.0)
 opt.add_option('-i', '--incol', help='Column name to smooth [default: DATA]', type='string', default='DATA')
@@ -125,104 +349,42 @@ opt.add_option('-b', '--nobackup', help='Do not backup the old WEIGHT_SPECTRUM i
 opt.add_option('-a', '--onlyamp', help='Smooth only amplitudes [default: smooth real/imag]', action="store_true", default=False)
 opt.add_option('-t', '--notime', help='Do not do smoothing in time [default: False]', action="store_true", default=False)
 opt.add_option('-q', '--nofreq', help='Do not do smoothing in frequency [default: False]', action="store_true", default=False)
-opt.add_option('-c', '--chunks', help='Split the I/O in n chunks. If you run out of memory, set this to a value > 2.', default=8, type='int')
-opt.add_option('-n', '--ncpu', help='Number of cores', default=4, type='int')
-(options, msfile) = opt.parse_args()
+opt.add_option('-k', '--kernelstep', help='Baselines with sigmas within this relative step are smoothed together with the same kernel, 0 to use the exact kernel of each baseline [default: 0]', default=0, type='float')
+opt.add_option('-g', '--fftsigma', help='Use FFT convolutions for kernels with sigma above this number of samples, 0 to never use them (e.g. 5) [default: 0]', default=0, type='float')
+opt.add_option('-c', '--chunks', help='Split the I/O of each MS in n chunks. If you run out of memory, set this to a value > 2.', default=8, type='int')
+opt.add_option('-n', '--ncpu', help='Number of cores, shared by all MSs', default=4, type='int')
+(options, msfiles) = opt.parse_args()
 
-if msfile == []:
+if msfiles == []:
     opt.print_help()
     sys.exit(0)
-msfile = msfile[0]
-if not os.path.exists(msfile):
-    logging.error("Cannot find MS file {}.".format(msfile))
-    sys.exit(1)
-# open input/output MS
-ms = pt.table(msfile, readonly=False, ack=False)
-
-with pt.table(msfile + '::SPECTRAL_WINDOW', ack=False) as freqtab:
-    freq = freqtab.getcol('REF_FREQUENCY')[0]
-    freqpersample = np.mean(freqtab.getcol('RESOLUTION'))
-    timepersample = ms.getcell('INTERVAL',0)
-
-# get info on all baselines
-with pt.taql("SELECT ANTENNA1,ANTENNA2,sqrt(sumsqr(UVW)),GCOUNT() FROM $ms GROUPBY ANTENNA1,ANTENNA2") as BL:
-    ants1, ants2 = BL.getcol('ANTENNA1'), BL.getcol('ANTENNA2')
-    dists = BL.getcol('Col_3')/1e3 # baseleline length in km
-    n_t = BL.getcol('Col_4')[0] # number of timesteps
-    n_bl = len(ants1)
-
-# check if ms is time-ordered
-times = ms.getcol('TIME_CENTROID')
-if not all(np.diff(times) >= 0):
-    logging.critical('This code cannot handle MS that are not time-sorted.')
-    sys.exit(1)
-del times
-
-# create column to smooth
-addcol(ms, options.incol, options.outcol)
-# restore WEIGHT_SPECTRUM
-if 'WEIGHT_SPECTRUM_ORIG' in ms.colnames() and options.restore:
-    addcol(ms, 'WEIGHT_SPECTRUM_ORIG', 'WEIGHT_SPECTRUM')
-# backup WEIGHT_SPECTRUM
-elif options.weight and not options.nobackup:
-    addcol(ms, 'WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_ORIG')
-
-# Iterate over chunks of baselines
-for c, idx in enumerate(np.array_split(np.arange(n_bl), options.chunks)):
-    logging.debug('### Fetching chunk {}/{}'.format(c+1,options.chunks))
-
-    # get input data for this chunk
-    ants1_chunk, ants2_chunk = ants1[idx], ants2[idx]
-    chunk = pt.taql("SELECT FROM $ms WHERE any(ANTENNA1== $ants1_chunk && ANTENNA2==$ants2_chunk)")
-    data_chunk = chunk.getcol(options.incol)
-    weights_chunk = chunk.getcol('WEIGHT_SPECTRUM')
-    # flag NaNs and set weights to zero
-    flags = chunk.getcol('FLAG')
-    flags[np.isnan(data_chunk)] = True
-    weights_chunk[flags] = 0
-    del flags
-    # prepare output cols
-    smoothed_data = data_chunk.copy()
-    if options.weight:
-        new_weights = np.zeros_like(weights_chunk)
-
-    # Iterate on each baseline in this chunk
-    mpm = multiprocManager(options.ncpu, smooth_baseline)
-    for i_chunk, (ant1, ant2, dist) in enumerate(zip(ants1_chunk, ants2_chunk, dists[idx])):
-        if ant1 == ant2:
-            continue  # skip autocorrelations
-        elif np.isnan(dist):
-            continue  # fix for missing antennas
-        logging.debug('Working on baseline: {} - {} (dist = {:.2f}km)'.format(ant1, ant2, dist))
-
-        in_bl = slice(i_chunk, -1, len(ants1_chunk))  # All times for 1 BL
-        data, weights= data_chunk[in_bl], weights_chunk[in_bl]
-
-        std_t = options.ionfactor * (25.e3 / dist) ** options.bscalefactor * (freq / 60.e6)  # in sec
-        std_t = std_t / timepersample  # in samples
-        # TODO: for freq this is hardcoded, it should be thought better
-        # However, the limitation is probably smearing here
-        std_f = 1e6 / dist  # Hz
-        std_f = std_f / freqpersample  # in samples
-        logging.debug("-Time: sig={:.1f} samples ({:.1f}s) -Freq: sig={:.1f} samples ({:.2f}MHz)".format(
-            std_t, timepersample * std_t, std_f, freqpersample * std_f / 1e6))
-        if std_t < 0.5: continue  # avoid very small smoothing and flagged ants
-        # fill queue
-        mpm.put([in_bl, data, weights, std_t, std_f])
-
-    mpm.wait() # run queue
-    # reconstruct chunk column
-    for in_bl, data, weights in mpm.get():
-        smoothed_data[in_bl] = data
-        if options.weight:
-            new_weights[in_bl] = weights
-    # write to ms
-    logging.info('Writing %s column.' % options.outcol)
-    chunk.putcol(options.outcol, smoothed_data)
-    if options.weight:
-        logging.warning('Writing WEIGHT_SPECTRUM column.')
-        chunk.putcol('WEIGHT_SPECTRUM', new_weights)
-    chunk.close()
-
-ms.close()
+for msfile in msfiles:
+    if not os.path.exists(msfile):
+        logging.error("Cannot find MS file {}.".format(msfile))
+        sys.exit(1)
+mss = [SmoothMS(msfile) for msfile in msfiles]
+
+# Iterate over the chunks of baselines of all MSs: while the workers smooth a chunk, the previous one is written and
+# the next one read. The chunks cycle over three buffers in shared memory, sized for the largest chunk of all MSs,
+# filled by the main process and smoothed in place by the workers, a single pool for all MSs.
+chunks = [(ms, c) for ms in mss for c in range(len(ms.chunks))]
+shared = {}
+data_bytes, weights_bytes = np.max([ms.chunk_bytes() for ms in mss], axis=0)
+shared['data'] = [shared_array(data_bytes) for slot in range(min(3, len(chunks)))]
+shared['weights'] = [shared_array(weights_bytes) for slot in range(min(3, len(chunks)))]
+pool = multiprocessing.get_context('fork').Pool(options.ncpu)
+
+
+tables = {0: read(0)}
+for i, (ms, c) in enumerate(chunks):
+    smoothing = pool.map_async(smooth_group, ms.chunk_jobs(c, i % 3), chunksize=1)
+    if i > 0:
+        write(i-1, tables.pop(i-1))
+    if i < len(chunks)-1:
+        tables[i+1] = read(i+1)
+    smoothing.get()
+write(len(chunks)-1, tables.pop(len(chunks)-1))
+
+pool.close()
+pool.join()
 logging.info("Done.")
@@ -27,6 +27,8 @@ import casacore.tables as pt
 import numpy
 import logging
 
+from LiLF import lib_ms
+
 logging.basicConfig(level=logging.DEBUG)
 
 def main(options):
@@ -43,39 +45,25 @@ def main(options):
         if col not in t.colnames():
             logging.info('Adding the output column '+col+' to '+ms+'.')
             if incol == '':
-                # prepare col metadata
-                cd = t.getcoldesc('DATA')
-                coldmi = t.getdminfo('DATA')
-                if options.dysco:
-                    cd['dataManagerType'] = 'DyscoStMan'
-                    cd['dataManagerGroup'] = 'DyscoData'
-                    coldmi = {'NAME': col,'SEQNR': 3,'SPEC': {'dataBitCount': 10,'distribution': 'TruncatedGaussian','distributionTruncation': 2.5,'normalization': 'AF','studentTNu': 0.0,'weightBitCount': 12},'TYPE': 'DyscoStMan'}
-                # not as performing as standard DATA
-                else:
-                    coldmi["NAME"] = col
-                #    cd['dataManagerType'] = 'StandardStMan'
-                #    cd['dataManagerGroup'] = 'SSMVar'
-                #    coldmi = {'NAME': col,'SEQNR': 0,'SPEC': {'ActualCacheSize': 2,'BUCKETSIZE': 32768,'IndexLength': 799832,'PERSCACHESIZE': 2},'TYPE': 'StandardStMan'}
-
-                cd['comment'] = 'Added by addcol2ms'
-                t.addcols(pt.makecoldesc(col, cd), coldmi)
+                # storage of DATA, or from options/lilf.config (see: lib_ms.MS.addColumnLike())
+                lib_ms.MS.addColumnLike(t, col, 'DATA', usedysco=True if options.dysco else 'auto')
 
                 # if non dysco is done by default
-                if options.dysco:
+                if t.getdminfo(col)['TYPE'] == 'DyscoStMan':
                     logging.warning('Setting '+col+' = 0')
                     pt.taql("update $t set "+col+"=0")
 
-            else:
-                # prepare col metadata
-                coldmi = t.getdminfo(incol)
-                coldmi['NAME'] = col
-                cd = t.getcoldesc(incol)
+            elif options.virtual:
+                # read-only reference to incol, LiLF makes it a real column before writing it
+                logging.warning('Setting '+col+' = '+incol+' (virtual)')
+                lib_ms.MS.addVirtualColumn(t, col, incol)
 
-                cd['comment'] = 'Added by addcol2ms'
-                t.addcols(pt.makecoldesc(col, cd), coldmi)
+            else:
+                lib_ms.MS.addColumnLike(t, col, incol, usedysco=True if options.dysco else 'auto')
 
                 logging.warning('Setting '+col+' = '+incol)
-                pt.taql("update $t set "+col+"="+incol)
+                stats = lib_ms.copyColumn(t, incol, col)
+                logging.info('Copied %.0f MB (%.0f MB/s)' % (stats['bytes']/1e6, stats['bytes']/1e6/stats['time']))
 
         else:
             logging.warning('Column '+col+' already exists.')
@@ -86,7 +74,8 @@ opt = optparse.OptionParser()
 opt.add_option('-m','--ms',help='Input MS [no default].',default='')
 opt.add_option('-c','--cols',help='Output column, comma separated if more than one [no default].',default='')
 opt.add_option('-i','--incol',help='Input column to copy in the output column, otherwise it will be set to 0 [default set to 0].',default='')
-opt.add_option('-d','--dysco',help='Enable dysco dataManager for new columns (copied columns always get the same dataManager of the original)',action="store_true",default=False)
+opt.add_option('-d','--dysco',help='Enable dysco dataManager for new columns (default: the storage set in lilf.config for the column role, or the same dataManager of the input column/DATA)',action="store_true",default=False)
+opt.add_option('-v','--virtual',help='New columns are virtual references to the input column, no data are copied until they are written through LiLF (lib_ms)',action="store_true",default=False)
 options, arguments = opt.parse_args()
 main(options)
 
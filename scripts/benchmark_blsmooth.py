@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: benchmark_blsmooth.py [--options]
+# Run BLsmooth.py on a synthetic MS (or a copy of a real one) with direct Gaussian convolutions only (the default)
+# and with FFT convolutions for large kernels (-g 5), for increasing ionfactors (i.e. kernel sizes),
+# and compare runtime and output (data and weights), also with a long block of flagged timestamps.
+
+import os, sys, time, shutil, argparse, subprocess, tempfile
+import numpy as np
+import casacore.tables as pt
+
+from synthetic_ms import make_ms
+
+blsmooth = os.path.dirname(os.path.abspath(__file__)) + '/BLsmooth.py'
+
+
+def run(pathMS, options):
+    """
+    Run BLsmooth on pathMS, return the runtime, the smoothed data and the smoothed weights
+    """
+    start = time.time()
+    subprocess.run([sys.executable, blsmooth, '-w'] + options + [pathMS], check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    runtime = time.time() - start
+    with pt.table(pathMS, ack=False) as t:
+        return runtime, t.getcol('SMOOTHED_DATA'), t.getcol('WEIGHT_SPECTRUM')
+
+
+def flag_block(pathMS, nflag):
+    """
+    Flag nflag consecutive timestamps in the middle of pathMS
+    """
+    with pt.table(pathMS, readonly=False, ack=False) as t:
+        times = t.getcol('TIME')
+        utimes = np.unique(times)
+        first = max(0, (len(utimes) - nflag) // 2)
+        flags = t.getcol('FLAG')
+        flags[(times >= utimes[first]) & (times <= utimes[min(len(utimes), first+nflag)-1])] = True
+        t.putcol('FLAG', flags)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark direct and FFT Gaussian smoothing in BLsmooth.py.')
+    parser.add_argument('ms', nargs='?', default=None, help='MS to copy and use, default: create a synthetic MS')
+    parser.add_argument('-f', '--ionfactors', nargs='+', default=[0.002, 0.01, 0.05], type=float,
+                        help='BLsmooth ionfactors to test [default: 0.002 0.01 0.05]')
+    parser.add_argument('-a', '--nant', default=40, type=int, help='Antennas of the synthetic MS [default: 40]')
+    parser.add_argument('-t', '--ntimes', default=600, type=int, help='Timestamps of the synthetic MS [default: 600]')
+    parser.add_argument('-c', '--nchan', default=8, type=int, help='Channels of the synthetic MS [default: 8]')
+    parser.add_argument('-n', '--ncpu', default=1, type=int, help='BLsmooth workers [default: 1]')
+    parser.add_argument('-b', '--flagblock', default=200, type=int, help='Flagged timestamps of the flagged case [default: 200]')
+    parser.add_argument('-d', '--dir', default=None, help='Scratch directory [default: system temp]')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='benchmark_blsmooth_', dir=args.dir)
+    try:
+        pathMS = workdir + '/input.MS'
+        if args.ms is not None:
+            shutil.copytree(args.ms, pathMS)
+        else:
+            make_ms(pathMS, nant=args.nant, ntimes=args.ntimes, nchan=args.nchan, columns=[])
+        with pt.table(pathMS, ack=False) as t:
+            timepersample = t.getcell('INTERVAL', 0)
+            mindist = np.min(np.sqrt(np.sum(t.getcol('UVW')**2, axis=1))[t.getcol('ANTENNA1') != t.getcol('ANTENNA2')])
+        with pt.table(pathMS + '/SPECTRAL_WINDOW', ack=False) as t:
+            freq = t.getcol('REF_FREQUENCY')[0]
+
+        pathFlagged = workdir + '/flagged.MS'
+        shutil.copytree(pathMS, pathFlagged)
+        flag_block(pathFlagged, args.flagblock)
+
+        # accuracy on all samples: data and weights, also next to and inside the flagged block
+        print('%-8s %-10s %10s %11s %11s %8s %12s %12s %10s' % ('case', 'ionfactor', 'max sig_t', 'direct [s]', 'fft [s]',
+              'speedup', 'max rel diff', 'w rel diff', 'w<0 (fft)'))
+        for case, pathCase in [('clean', pathMS), ('flagged', pathFlagged)]:
+            for ionfactor in args.ionfactors:
+                # largest time kernel, on the shortest baseline, as computed by BLsmooth
+                max_sigma = ionfactor * (25.e3 / (mindist/1e3)) * (freq / 60.e6) / timepersample
+                results = {}
+                for name, options in [('direct', []), ('fft', ['-g', '5'])]:
+                    pathRun = '%s/%s.MS' % (workdir, name)
+                    shutil.copytree(pathCase, pathRun)
+                    results[name] = run(pathRun, ['-f', str(ionfactor), '-n', str(args.ncpu)] + options)
+                    shutil.rmtree(pathRun)
+                diff = np.nanmax(np.abs(results['fft'][1] - results['direct'][1])) / np.nanmax(np.abs(results['direct'][1]))
+                wdiff = np.max(np.abs(results['fft'][2] - results['direct'][2])) / np.max(np.abs(results['direct'][2]))
+                print('%-8s %-10g %10.1f %11.2f %11.2f %8.1f %12.1e %12.1e %10i' % (case, ionfactor, max_sigma,
+                      results['direct'][0], results['fft'][0], results['direct'][0]/results['fft'][0], diff, wdiff,
+                      np.sum(results['fft'][2] < 0)))
+    finally:
+        shutil.rmtree(workdir)
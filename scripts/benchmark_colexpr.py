@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: benchmark_colexpr.py [--options]
+# Compare column updates done as in the pipelines with 'taql "update ..."' commands run by the scheduler,
+# with the in-process engine AllMSs.updateColumns(), on synthetic MSs (or copies of real ones).
+
+import os, sys, time, shutil, argparse, tempfile
+import numpy as np
+import casacore.tables as pt
+
+from LiLF import lib_ms, lib_util
+from synthetic_ms import make_ms
+
+phdiff_taql = 'taql "UPDATE $pathMS SET \
+ CIRC_PHASEDIFF_DATA[,0]=0.5*EXP(1.0i*(PHASE(CIRC_PHASEDIFF_DATA[,0])-PHASE(CIRC_PHASEDIFF_DATA[,3]))), \
+ CIRC_PHASEDIFF_DATA[,3]=CIRC_PHASEDIFF_DATA[,0], CIRC_PHASEDIFF_DATA[,1]=0+0i, CIRC_PHASEDIFF_DATA[,2]=0+0i"'
+frmodel_taql = 'taql "UPDATE $pathMS SET FR_MODEL_DATA[,0]=0.5+0i, FR_MODEL_DATA[,1]=0.0+0i, \
+ FR_MODEL_DATA[,2]=0.0+0i, FR_MODEL_DATA[,3]=0.5+0i"'
+
+
+def run_taql(MSs, commands):
+    """
+    As in the pipelines: one taql process per MS and command
+    """
+    start = time.time()
+    for command in commands:
+        MSs.run(command, log='$nameMS_taql.log', commandType='general')
+    return time.time() - start
+
+
+def run_engine(MSs, updates, inputs=None):
+    start = time.time()
+    MSs.updateColumns(updates, inputs=inputs)
+    return time.time() - start
+
+
+def compare(pathsMS, col, ref):
+    """
+    Return the max abs difference between two columns in all MSs
+    """
+    diff = 0.
+    for pathMS in pathsMS:
+        with pt.table(pathMS, ack=False) as t:
+            diff = max(diff, np.nanmax(np.abs(t.getcol(col) - t.getcol(ref))))
+    return diff
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark TaQL updates against lib_ms column updates.')
+    parser.add_argument('ms', nargs='*', help='MSs to copy and use, default: create synthetic MSs')
+    parser.add_argument('-n', '--nms', default=4, type=int, help='Number of synthetic MSs [default: 4]')
+    parser.add_argument('-a', '--nant', default=40, type=int, help='Antennas of the synthetic MSs [default: 40]')
+    parser.add_argument('-t', '--ntimes', default=300, type=int, help='Timestamps of the synthetic MSs [default: 300]')
+    parser.add_argument('-c', '--nchan', default=16, type=int, help='Channels of the synthetic MSs [default: 16]')
+    parser.add_argument('-j', '--procs', default=None, type=int, help='MSs processed at the same time [default: all cpus]')
+    parser.add_argument('-d', '--dir', default=None, help='Scratch directory [default: system temp]')
+    args = parser.parse_args()
+
+    if shutil.which('taql') is None:
+        print('The taql executable is needed for the comparison.')
+        sys.exit(1)
+
+    lib_util.logger.disabled = True
+    workdir = tempfile.mkdtemp(prefix='benchmark_colexpr_', dir=args.dir)
+    try:
+        if len(args.ms) > 0:
+            pathsMS = []
+            for i, pathMS in enumerate(args.ms):
+                pathsMS.append('%s/ms%03i.MS' % (workdir, i))
+                shutil.copytree(pathMS, pathsMS[-1])
+        else:
+            pathsMS = [make_ms('%s/ms%03i.MS' % (workdir, i), nant=args.nant, ntimes=args.ntimes, nchan=args.nchan,
+                               columns=['MODEL_DATA', 'CORRECTED_DATA'], seed=i) for i in range(args.nms)]
+
+        os.makedirs(workdir+'/logs')
+        s = lib_util.Scheduler(max_processors=args.procs, log_dir=workdir+'/logs')
+        MSs = lib_ms.AllMSs(pathsMS, s, check_flags=False)
+        for ms in MSs.getListObj():
+            with pt.table(ms.pathMS, readonly=False, ack=False) as t:
+                for col in ['CIRC_PHASEDIFF_DATA', 'FR_MODEL_DATA', 'REF_DATA']:
+                    if col not in t.colnames(): lib_ms.MS.addColumnLike(t, col, 'DATA')
+                pt.taql('UPDATE $t SET CIRC_PHASEDIFF_DATA=DATA')
+        size = sum([os.path.getsize(ms+'/'+f) for ms in pathsMS for f in os.listdir(ms) if os.path.isfile(ms+'/'+f)])
+        print('%i MSs, %.0f MB, %i parallel jobs' % (len(pathsMS), size/1e6, s.max_processors))
+
+        # 1: CORRECTED_DATA = DATA - MODEL_DATA
+        t_taql = run_taql(MSs, ['taql "update $pathMS set REF_DATA = DATA - MODEL_DATA"'])
+        t_engine = run_engine(MSs, {'CORRECTED_DATA': 'DATA - MODEL_DATA'})
+        print('CORRECTED_DATA = DATA - MODEL_DATA: taql %.2f s - updateColumns %.2f s (x%.1f) - max diff %.2g' %
+              (t_taql, t_engine, t_taql/t_engine, compare(pathsMS, 'CORRECTED_DATA', 'REF_DATA')))
+
+        # 2: phase difference and FR model, two taql commands vs one pass
+        t_taql = run_taql(MSs, [phdiff_taql, frmodel_taql])
+        for ms in pathsMS:
+            with pt.table(ms, readonly=False, ack=False) as t:
+                pt.taql('UPDATE $t SET REF_DATA=CIRC_PHASEDIFF_DATA, CIRC_PHASEDIFF_DATA=DATA')
+        t_engine = run_engine(MSs, [('CIRC_PHASEDIFF_DATA', lambda cols: lib_ms.circPhaseDiff(cols['DATA'])),
+                                    ('FR_MODEL_DATA', 'np.array([0.5+0j, 0, 0, 0.5])')], inputs=['DATA'])
+        print('Phase difference + FR_MODEL_DATA: taql %.2f s - updateColumns (fused) %.2f s (x%.1f) - max diff %.2g' %
+              (t_taql, t_engine, t_taql/t_engine, compare(pathsMS, 'CIRC_PHASEDIFF_DATA', 'REF_DATA')))
+    finally:
+        shutil.rmtree(workdir)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: benchmark_storage.py [--options]
+# Compare the storage options of intermediate columns ([columns] section of lilf.config):
+# size on disk, write and read throughput and precision of a copy of DATA, on a synthetic MS (or a copy of a real one).
+# The page cache of the column is dropped before reading, so reads come from disk.
+
+import os, time, shutil, argparse, tempfile
+import numpy as np
+import casacore.tables as pt
+
+from LiLF import lib_ms, lib_util
+from synthetic_ms import make_ms
+
+
+def drop_cache(t, col):
+    """
+    Write to disk and drop from the page cache the files of the data manager of col
+    """
+    t.flush()
+    os.sync()
+    prefix = 'table.f%i' % t.getdminfo(col)['SEQNR']
+    for f in os.listdir(t.name()):
+        if f == prefix or f == prefix + 'i' or f.startswith(prefix + '_'):
+            fd = os.open(t.name() + '/' + f, os.O_RDONLY)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            os.close(fd)
+
+
+def benchmark(t, storage, col='BENCH_DATA', chunkRows=10000):
+    """
+    Return size, write and read time and relative rms error of a copy of DATA stored as storage
+    """
+    if col in t.colnames(): t.removecols(col)
+    lib_ms.MS.addColumnLike(t, col, 'DATA', usedysco=storage)
+
+    start = time.time()
+    lib_ms.copyColumn(t, 'DATA', col)
+    t.flush()
+    t_write = time.time() - start
+    size = lib_ms.MS.getColumnBytes(t)[col]
+
+    drop_cache(t, col)
+    t_read = 0.; err2 = 0.; ref2 = 0.
+    for startrow in range(0, t.nrows(), chunkRows):
+        nrow = min(chunkRows, t.nrows() - startrow)
+        start = time.time()
+        data = t.getcol(col, startrow, nrow)
+        t_read += time.time() - start
+        ref = t.getcol('DATA', startrow, nrow)
+        err2 += np.sum(np.abs(data - ref)**2)
+        ref2 += np.sum(np.abs(ref)**2)
+
+    t.removecols(col)
+    return size, t_write, t_read, np.sqrt(err2/ref2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark storage managers for intermediate columns.')
+    parser.add_argument('ms', nargs='?', default=None, help='MS to copy and use, default: create a synthetic MS')
+    parser.add_argument('-s', '--storage', nargs='+', default=['tiled', 'dysco:6,12', 'dysco:8,12', 'dysco:10,12',
+                        'dysco:12,12', 'dysco:16,12'], help='Storage options to test [default: tiled and dysco 6 to 16 bits]')
+    parser.add_argument('-a', '--nant', default=40, type=int, help='Antennas of the synthetic MS [default: 40]')
+    parser.add_argument('-t', '--ntimes', default=300, type=int, help='Timestamps of the synthetic MS [default: 300]')
+    parser.add_argument('-c', '--nchan', default=32, type=int, help='Channels of the synthetic MS [default: 32]')
+    parser.add_argument('-d', '--dir', default=None, help='Scratch directory [default: system temp]')
+    args = parser.parse_args()
+
+    lib_util.logger.disabled = True
+    workdir = tempfile.mkdtemp(prefix='benchmark_storage_', dir=args.dir)
+    try:
+        pathMS = workdir + '/bench.MS'
+        if args.ms is not None:
+            shutil.copytree(args.ms, pathMS)
+        else:
+            make_ms(pathMS, nant=args.nant, ntimes=args.ntimes, nchan=args.nchan, columns=[])
+
+        with pt.table(pathMS, readonly=False, ack=False) as t:
+            nbytes = t.nrows() * np.prod(t.getcell('DATA', 0).shape) * 8 # as complex64 in memory
+            data_size = lib_ms.MS.getColumnBytes(t)['DATA']
+            print('DATA: %s, %.0f MB on disk, %.0f MB in memory' % (t.getdminfo('DATA')['TYPE'], data_size/1e6, nbytes/1e6))
+            print('%-12s %10s %8s %12s %12s %10s' % ('storage', 'size [MB]', 'vs DATA', 'write [MB/s]', 'read [MB/s]', 'rel. rms'))
+            for storage in args.storage:
+                try:
+                    size, t_write, t_read, err = benchmark(t, storage)
+                except RuntimeError as e:
+                    print('%-12s not available: %s' % (storage, str(e).splitlines()[0]))
+                    if 'BENCH_DATA' in t.colnames(): t.removecols('BENCH_DATA')
+                    continue
+                print('%-12s %10.1f %8.2f %12.0f %12.0f %10.2g' % (storage, size/1e6, size/data_size,
+                      nbytes/1e6/t_write, nbytes/1e6/t_read, err))
+    finally:
+        shutil.rmtree(workdir)
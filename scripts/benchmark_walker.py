@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: benchmark_walker.py [--options]
+# Micro-benchmark of lib_util.Walker: emulate a resumed pipeline (e.g. LOFAR_self) where the
+# first steps are skipped, then time python code executed after the skipped steps.
+# The old Walker left a global trace function installed after the first skip, which
+# slowed down every following python call.
+
+import os, sys, time, argparse, tempfile
+
+from LiLF import lib_util
+
+
+def work(n):
+    """
+    Python-heavy code, similar to the bookkeeping done by the pipelines between commands
+    """
+    def f(x): return x+1
+    tot = 0
+    for i in range(n):
+        tot = f(tot)
+    return tot
+
+
+def timeit(n, repeat):
+    return min(_time(n) for _ in range(repeat))
+
+
+def _time(n):
+    start = time.perf_counter()
+    work(n)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the step skipping of lib_util.Walker.')
+    parser.add_argument('-s', '--steps', default=60, type=int, help='Number of completed steps to skip [default: 60]')
+    parser.add_argument('-n', '--niter', default=1000000, type=int, help='Function calls in the timed loop [default: 1e6]')
+    parser.add_argument('-r', '--repeat', default=5, type=int, help='Repetitions, the best is kept [default: 5]')
+    args = parser.parse_args()
+
+    lib_util.logger.disabled = True
+    walker_file = tempfile.mktemp(suffix='.walker')
+    with open(walker_file, 'w') as f:
+        for i in range(args.steps): f.write('step%03i\n' % i)
+
+    before = timeit(args.niter, args.repeat)
+
+    # resumed run: all steps are already done
+    w = lib_util.Walker(walker_file)
+    start = time.perf_counter()
+    for i in range(args.steps):
+        with w.if_todo('step%03i' % i):
+            raise RuntimeError('This step should have been skipped.')
+    skip_time = time.perf_counter() - start
+    after = timeit(args.niter, args.repeat)
+    trace_left = sys.gettrace() is not None
+
+    # what the old Walker left behind after the first skip
+    sys.settrace(lambda *args, **keys: None)
+    legacy = timeit(args.niter, args.repeat)
+    sys.settrace(None)
+    os.remove(walker_file)
+
+    print('Skipped %i steps in %.2f ms (%.1f us/step)' % (args.steps, 1e3*skip_time, 1e6*skip_time/args.steps))
+    print('Global trace installed after skipping: %s' % trace_left)
+    print('Timed loop (%i calls):' % args.niter)
+    print('  before any skip:          %.3f s' % before)
+    print('  after skipping:           %.3f s (%+.1f%%)' % (after, 100*(after-before)/before))
+    print('  with old global trace:    %.3f s (%+.1f%%)' % (legacy, 100*(legacy-before)/before))
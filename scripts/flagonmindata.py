@@ -20,54 +20,105 @@
 import os, sys, logging, time
 import numpy as np
 from casacore.tables import taql, table
-import matplotlib as mpl
-mpl.use("Agg")
-import matplotlib.pyplot as plt
+
+from LiLF import lib_multiproc
 
 class MShandler():
-    def __init__(self, ms_file):
+    def __init__(self, ms_files, ncpu=1):
         """
-        ms_file: a MeasurementSet file
+        ms_files: a list of MeasurementSet files (e.g. split in time or frequency)
+        ncpu: number of MSs processed in parallel
         """
-        logging.info('Reading: %s' % ms_file)
-        self.ms_file = ms_file
-        self.ms = table(ms_files[0], readonly=False, ack=False)
+        logging.info('Reading: %s' % ','.join(ms_files))
+        self.ms_files = ms_files
+        self.ncpu = ncpu
+
+        # timestamps and channels shared by all MSs
+        times = []
+        for ms_file in ms_files:
+            with table(ms_file, ack=False) as ms:
+                times.append(np.unique(ms.getcol('TIME')))
+        self.times = np.unique(np.concatenate(times))
+        freqs = [taql('SELECT CHAN_FREQ FROM %s/SPECTRAL_WINDOW' % ms_file)[0]['CHAN_FREQ'] for ms_file in ms_files]
+        self.freqs = np.unique(np.concatenate(freqs))
+        # channels of each MS in self.freqs
+        self.chans = [np.searchsorted(self.freqs, f) for f in freqs]
 
-    def get_flags_aggr(self):
+    def run(self, func, args, merge=None):
         """
+        Call func(*arg) for each arg in args (e.g. one per MS) in a pool of self.ncpu processes.
+        Return the list of results or, if merge is given, the results merged with merge(result1, result2) as they come.
         """
-        ms = self.ms_file
-        return taql('select NTRUES(GAGGR(FLAG), [0, 2]) as FLAG, SHAPE(GAGGR(FLAG)) as N from $ms where ANTENNA1 != ANTENNA2 groupby TIME')
+        return lib_multiproc.poolRun(func, args, self.ncpu, merge)
 
-    def get_flags(self):
+    def iter_chunks(self, i, ntimes):
         """
+        Iterator over the cross-correlations of the i-th MS in chunks of ntimes timestamps
+        It returns the timestamp of each row (in self.times) and the table of the rows.
         """
-        ms = self.ms_file
-        return taql('select FLAG from $ms where ANTENNA1 != ANTENNA2')
-
-
-def flagonmindata(MSh, mode, fract):
-    t = MSh.get_flags_aggr()
-    f = t.getcol('FLAG').astype(float) # shape: time/chan
-    n = t.getcol('N')
-    ntime = len(n)
-    nbl = n[0,0]
-    nchan = n[0,1]
-    npol = n[0,2]
-    ff = f/(nbl*npol) # fraction of flagged data per timestep and chan
+        ms = table(self.ms_files[i], readonly=False, ack=False)
+        row_time = np.searchsorted(self.times, ms.getcol('TIME'))
+        order = np.flatnonzero(ms.getcol('ANTENNA1') != ms.getcol('ANTENNA2'))
+        order = order[np.argsort(row_time[order], kind='stable')]
+        times = np.unique(row_time[order])
+        for t0 in range(0, len(times), ntimes):
+            t1 = min(t0 + ntimes, len(times))
+            start, end = np.searchsorted(row_time[order], [times[t0], times[t1-1]+1])
+            rows = order[start:end]
+            yield row_time[rows], ms.selectrows(rows)
+        ms.close()
+
+
+def count_flags(MSh, i, chunktimes):
+    """
+    Number of flagged and of all data of the i-th MS per timestamp and channel of the MSs (over baselines and pols)
+    """
+    nflag, ntot = np.zeros((len(MSh.times), len(MSh.freqs))), np.zeros((len(MSh.times), len(MSh.freqs)))
+    for t_row, chunk in MSh.iter_chunks(i, chunktimes):
+        f = chunk.getcol('FLAG')
+        chunk.close()
+        times, t_row = np.unique(t_row, return_inverse=True)
+        index = np.ix_(times, MSh.chans[i])
+        for c in range(f.shape[1]):
+            nflag[times, MSh.chans[i][c]] += np.bincount(t_row, weights=np.sum(f[:, c], axis=1), minlength=len(times))
+        ntot[index] += np.bincount(t_row, minlength=len(times))[:, np.newaxis] * f.shape[2]
+    return nflag, ntot
+
+
+def apply_flags(MSh, i, chunktimes, toflag):
+    """
+    Flag all cross-correlations of the i-th MS at the timestamps/channels where toflag is True
+    Return the number of flags before and after.
+    """
+    before, after = 0, 0
+    for t_row, chunk in MSh.iter_chunks(i, chunktimes):
+        f = chunk.getcol('FLAG')
+        before += np.count_nonzero(f)
+        f |= toflag[t_row][:, MSh.chans[i], np.newaxis]
+        after += np.count_nonzero(f)
+        chunk.putcol('FLAG', f)
+        chunk.close()
+    return before, after
+
+
+def flagonmindata(MSh, mode, fract, chunktimes=50):
+    nms = len(MSh.ms_files)
+    # fraction of flagged data per timestep and chan, over all MSs
+    nflag, ntot = MSh.run(count_flags, [(MSh, i, chunktimes) for i in range(nms)],
+                          merge=lambda a, b: (a[0]+b[0], a[1]+b[1]))
+    present = ntot > 0
+    ff = nflag[present]/ntot[present]
     fffullyflag = np.array(ff == 1.)
     ff = np.array(ff > fract, dtype=bool)
     logging.info( "Fully flagged timestep/chan: %i (%f%%) -> %i (%f%%)" % \
-            ( np.sum(fffullyflag), 100*np.sum(fffullyflag)/float(np.size(fffullyflag)), np.sum(ff), 100*np.sum(ff)/float(np.size(ff)) ) ) 
-    ff = np.repeat(ff, nbl, axis=0) # repeat time axis for nbl times
-    ff = np.expand_dims(ff, axis=2) # add pol axis
-    ff = np.repeat(ff, npol, axis=2) # repeat new pol axis for npol times
-    msflag = MSh.get_flags()
-    print("count before:", np.count_nonzero(msflag.getcol('FLAG')))
-    ff = np.array(ff | msflag.getcol('FLAG'), dtype=bool)
-    print("count after:", np.count_nonzero(ff))
-    msflag.putcol('FLAG', ff)
-    msflag.flush()
+            ( np.sum(fffullyflag), 100*np.sum(fffullyflag)/float(np.size(fffullyflag)), np.sum(ff), 100*np.sum(ff)/float(np.size(ff)) ) )
+    toflag = np.zeros(ntot.shape, dtype=bool)
+    toflag[present] = ff
+
+    counts = MSh.run(apply_flags, [(MSh, i, chunktimes, toflag) for i in range(nms)])
+    for ms_file, (before, after) in zip(MSh.ms_files, counts):
+        logging.info("%s: flags %i -> %i" % (ms_file, before, after))
+    logging.info("All MSs: flags %i -> %i" % (np.sum([c[0] for c in counts]), np.sum([c[1] for c in counts])))
 
 
 def readArguments():
@@ -76,6 +127,8 @@ def readArguments():
     parser.add_argument("-v", "--verbose", help="Be verbose. Default is False", required=False, action="store_true")
     parser.add_argument("-m", "--mode", type=str, help="Mode can be: NO MODE IMPLEMENTED", required=False, default=None)
     parser.add_argument("-f", "--fractbad", type=float, help="Fraction of bad data allowed, if higher flagging is triggered (default 0.5) ", required=False, default=0.5)
+    parser.add_argument("-c", "--chunktimes", type=int, help="Timestamps read at once from each MS, lower it to save memory (default 50)", required=False, default=50)
+    parser.add_argument("-n", "--ncpu", type=int, help="Number of MSs processed in parallel (default 4)", required=False, default=4)
     parser.add_argument("ms_files", type=str, help="MeasurementSet name(s).", nargs="+")
     args=parser.parse_args()
     return vars(args)
@@ -97,9 +150,9 @@ if __name__=="__main__":
     else: logging.basicConfig(level=logging.INFO)
 
     logging.info('Reading MSs...')
-    MSh = MShandler(ms_files)
+    MSh = MShandler(ms_files, args["ncpu"])
 
     logging.info('Extend flags (fraction: %f)...' % fract)
-    flagonmindata(MSh, mode, fract)
+    flagonmindata(MSh, mode, fract, args["chunktimes"])
 
     logging.debug('Running time %.0f s' % (time.time()-start_time))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: ledger_summary.py logs/scheduler-ledger.jsonl [--options]
+# Rank the pipeline steps by the resources their commands used,
+# reading the accounting ledger written by lib_util.Scheduler
+
+import sys, json, argparse
+
+
+def load(ledgers):
+    """
+    Return the list of records in the ledger files
+    """
+    records = []
+    for ledger in ledgers:
+        with open(ledger) as f:
+            for line in f:
+                line = line.strip()
+                if line == '': continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print('Skip corrupted line in %s' % ledger, file=sys.stderr)
+    return records
+
+
+def summarise(records, by=('step',)):
+    """
+    Aggregate the records grouping them by the given keys
+    Return a dict: key tuple -> dict of summed quantities
+    """
+    groups = {}
+    for r in records:
+        key = tuple(str(r.get(k)) for k in by)
+        g = groups.setdefault(key, {'n': 0, 'failed': 0, 'wall': 0., 'cpu': 0., 'maxrss': 0.,
+                                    'read_bytes': 0, 'write_bytes': 0})
+        g['n'] += 1
+        if r.get('returncode', 0) != 0: g['failed'] += 1
+        # quantities not measured (e.g. commands run through SLURM) are null
+        g['wall'] += r['wall']
+        g['cpu'] += (r['utime'] or 0) + (r['stime'] or 0)
+        g['maxrss'] = max(g['maxrss'], r['maxrss'] or 0)
+        g['read_bytes'] += r['read_bytes'] or 0
+        g['write_bytes'] += r['write_bytes'] or 0
+    return groups
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rank pipeline steps by cost using the Scheduler accounting ledger.')
+    parser.add_argument('ledgers', nargs='+', help='Ledger file(s), e.g. logs/scheduler-ledger.jsonl')
+    parser.add_argument('-b', '--by', default='step', help='Comma separated keys to group by: step, ms, commandType [default: step]')
+    parser.add_argument('-s', '--sort', default='cpu', choices=['cpu', 'wall', 'maxrss', 'read_bytes', 'write_bytes', 'n'],
+                        help='Quantity used to rank the groups [default: cpu]')
+    parser.add_argument('-n', '--top', default=0, type=int, help='Show only the first n groups [default: all]')
+    args = parser.parse_args()
+
+    by = args.by.split(',')
+    groups = summarise(load(args.ledgers), by)
+    ranked = sorted(groups.items(), key=lambda kv: kv[1][args.sort], reverse=True)
+    if args.top > 0: ranked = ranked[:args.top]
+
+    tot_cpu = sum(g['cpu'] for g in groups.values())
+    print('%-40s %6s %6s %10s %10s %6s %10s %10s %10s' % ('/'.join(by), 'n', 'fail', 'wall[s]', 'cpu[s]', 'cpu%',
+                                                         'maxrss[MB]', 'read[GB]', 'write[GB]'))
+    for key, g in ranked:
+        print('%-40s %6i %6i %10.1f %10.1f %6.1f %10.0f %10.2f %10.2f' % ('/'.join(key)[:40], g['n'], g['failed'],
+              g['wall'], g['cpu'], 100*g['cpu']/tot_cpu if tot_cpu > 0 else 0, g['maxrss'],
+              g['read_bytes']/1024.**3, g['write_bytes']/1024.**3))
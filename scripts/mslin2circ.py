@@ -23,6 +23,8 @@ import sys
 import casacore.tables as pt
 from casacore.quanta import quantity
 
+from LiLF import lib_ms
+
 def checkfile(inms):
   if inms == '':
      print('Error: give an input MS')
@@ -53,16 +55,15 @@ def setupiofiles(inms, outms, incolumn, outcolumn):
      t.close()
      print("Finished copy.")
 
-  # create output column if doesn't exist
+  # virtual columns cannot be written, nor the columns they reference
   to = pt.table(outms, readonly=False)
+  written = [outcolumn, 'FLAG'] + (['WEIGHT_SPECTRUM'] if options.weights else [])
+  lib_ms.MS.materialiseWritten(to, written)
+  # create output column if doesn't exist (stored like the column that a virtual incolumn references)
   if not outcolumn in to.colnames():
       print("Add column %s" % outcolumn)
-      ti = pt.table(inms)
-      coldmi = ti.getdminfo(incolumn)
-      coldmi['NAME'] = outcolumn
-      to.addcols(pt.makecoldesc(outcolumn, ti.getcoldesc(incolumn)), coldmi)
+      lib_ms.MS.addColumnLike(to, outcolumn, incolumn)
       pt.taql("update $to set "+outcolumn+"="+incolumn)
-      ti.close()
   to.close()
   return outms
 
@@ -25,7 +25,10 @@
 
 import os, sys, logging, time
 import numpy as np
+from scipy.sparse import csr_matrix
 from casacore.tables import taql, table
+
+from LiLF import lib_multiproc
 import matplotlib as mpl
 mpl.use("Agg")
 import matplotlib.pyplot as plt
@@ -47,21 +50,22 @@ class Timer(object):
     def __enter__(self):
         self.log.debug("--> Starting \'" + self.step + "\'.")
         self.start = time.time()
-        self.startcpu = time.clock()
+        self.startcpu = time.process_time()
 
     def __exit__(self, exit_type, value, tb):
 
         # if not an error
         if exit_type is None:
-            self.log.debug("<-- Time for %s step: %i s (cpu: %i s)." % ( self.step, ( time.time() - self.start), (time.clock() - self.startcpu) ))
+            self.log.debug("<-- Time for %s step: %i s (cpu: %i s)." % ( self.step, ( time.time() - self.start), (time.process_time() - self.startcpu) ))
 
 
 class MShandler():
-    def __init__(self, ms_files, wcolname, dcolname):
+    def __init__(self, ms_files, wcolname, dcolname, ncpu=1):
         """
-        ms_files: a list of MeasurementSet files
+        ms_files: a list of MeasurementSet files, of the same antennas (e.g. split in time or frequency)
         wcolname: name of the weight column
         dcolname: name of the residual column
+        ncpu: number of MSs processed in parallel
         """
         logging.info('Reading: %s', ','.join(ms_files))
         logging.info('Weight column: %s', wcolname)
@@ -69,151 +73,420 @@ class MShandler():
         self.ms_files = ms_files
         self.wcolname = wcolname
         self.dcolname = dcolname
-
-        # if more than one MS, virtualconcat
-        #if len(ms_files) > 1:
-        #    self.ms = taql('select TIME, FLAG, ANTENNA1, ANTENNA2, %s, %s from %s' % ( wcolname, dcolname, ','.join(ms_files) ))
-        #else:
-        #    self.ms = taql('select TIME, FLAG, ANTENNA1, ANTENNA2, %s, %s from %s' % ( wcolname, dcolname, ms_files[0] ))
-        self.ms = table(ms_files[0], readonly=False, ack=False)
+        self.ncpu = ncpu
+
+        # antennas, timestamps, channels and baselines shared by all MSs
+        self.antennas = np.array(self.get_antennas())
+        nant = len(self.antennas)
+        times, baselines = [], []
+        for ms_file in ms_files:
+            if len(taql('select NAME from %s/ANTENNA' % ms_file)) != nant:
+                logging.error('%s has different antennas than %s.' % (ms_file, ms_files[0]))
+                sys.exit(1)
+            with table(ms_file, ack=False) as ms:
+                times.append(np.unique(ms.getcol('TIME')))
+                baselines.append(np.unique(ms.getcol('ANTENNA1')*nant + ms.getcol('ANTENNA2')))
+        self.times = np.unique(np.concatenate(times))
+        self.baselines = np.unique(np.concatenate(baselines)) # as ANTENNA1*nant + ANTENNA2
+        self.freqs = np.unique(self.get_freqs())
+        # channels of each MS in self.freqs
+        self.chans = [np.searchsorted(self.freqs, self.get_freqs(ms_file)) for ms_file in ms_files]
 
     def get_antennas(self):
         return taql('select NAME from %s/ANTENNA' % (self.ms_files[0]) ).getcol('NAME')
 
-    def get_freqs(self):
-        # TODO: check if there is a smarter way to do it with concat.MS
+    def get_freqs(self, ms_file=None):
+        """
+        Frequencies of all MSs, or of ms_file, in MHz
+        """
         freqs = []
-        for ms_file in self.ms_files:
+        for ms_file in (self.ms_files if ms_file is None else [ms_file]):
             freqs += list( taql('SELECT CHAN_FREQ FROM %s/SPECTRAL_WINDOW' % ms_file)[0]['CHAN_FREQ'] * 1e-6 ) # in MHz
         return freqs
 
     def get_time(self):
-        # TODO: fix if multiple time MSs passed
-        ms_avgbl = taql('SELECT TIME FROM %s GROUPBY TIME' %(self.ms_files[0]))
-        return ms_avgbl.getcol('TIME')
+        return self.times.copy()
 
     def get_elev(self):
-        # TODO: fix if multiple time MSs passed
-        ms_avgbl = taql('SELECT TIME, MEANS(GAGGR(MSCAL.AZEL1()[1]), 0) AS ELEV FROM %s GROUPBY TIME' %(self.ms_files[0]))
-        return ms_avgbl.getcol('ELEV')
+        elev = np.zeros(len(self.times))
+        for ms_file in self.ms_files:
+            ms_avgbl = taql('SELECT TIME, MEANS(GAGGR(MSCAL.AZEL1()[1]), 0) AS ELEV FROM %s GROUPBY TIME' % ms_file)
+            elev[np.searchsorted(self.times, ms_avgbl.getcol('TIME'))] = ms_avgbl.getcol('ELEV')
+        return elev
 
-    def iter_antenna(self, antennas=None):
+    def open(self, i):
         """
-        Iterator to get all visibilities of each antenna
-        For GFLAG, GDATA and GWEIGHTS it returns arrays of Ntimes x Nbl x Nfreqs x Npol
+        Open the i-th MS, return the table and the timestamp of each row (in self.times)
         """
-        ms = self.ms # to use the "$" in taql
-
-        for ant_id, ant_name in enumerate(self.get_antennas()):
-            if antennas is not None and ant_name not in antennas: continue
-            logging.info('Workign on antenna: %s', ant_name)
-            yield ant_id, ant_name, taql('select TIME, GAGGR(FLAG) as GFLAG, ANTENNA1, ANTENNA2, GAGGR(%s) as GDATA, GAGGR(%s) as GWEIGHT \
-                                          from $ms \
-                                          where (ANTENNA1=%i or ANTENNA2=%i) and (ANTENNA1 != ANTENNA2) \
-                                          groupby TIME' \
-                    % (self.dcolname, self.wcolname, ant_id, ant_id) )
-
-
-def reweight(MSh, mode):
-
-    # get data per antenna
-    var_antenna = {}
-    med_antenna = {}
-    for ant_id, ant_name, ms_ant in MSh.iter_antenna():
-
-        with Timer('Get data'):
-            data = ms_ant.getcol('GDATA') # axes: time, ant, freq, pol
-            flags = ms_ant.getcol('GFLAG') # axes: time, ant, freq, pol
-
-            # put flagged data to NaNs
-            data[flags] = np.nan
-
-            # if completely flagged set variance to 1 and continue
-            if np.all(flags):
-                var_antenna[ant_id] = None
-                med_antenna[ant_id] = None
-                continue
-
-        with Timer('Prepare data'):
-
-            # data column is updated subtracting adjacent channels
-            if mode == 'subchan':
-                data_shifted_l = np.roll(data, -1, axis=2)
-                data_shifted_r = np.roll(data, +1, axis=2)
-                # if only 2 freq it's aleady ok, subtracting one from the other
-                if data.shape[2] > 2:
-                    data_shifted_l[:,:,-1,:] = data_shifted_l[:,:,-3,:] # last chan uses the one but last
-                    data_shifted_r[:,:,0,:] = data_shifted_r[:,:,2,:] # first chan uses third
-                # get the "best" shift, either on the right or left. This is to avoid propagating bad channels (e.g. with RFI)
-                ratio_l = np.nanvar(data_shifted_l, axis=(0,1,3))/np.nanmean(data_shifted_l, axis=(0,1,3))
-                ratio_l[ np.isnan(ratio_l) ] = np.inf
-                ratio_r = np.nanvar(data_shifted_r, axis=(0,1,3))/np.nanmean(data_shifted_r, axis=(0,1,3))
-                ratio_r[ np.isnan(ratio_r) ] = np.inf
-                data = np.where( ( ratio_l < ratio_r )[np.newaxis,np.newaxis,:,np.newaxis], data - data_shifted_l, data - data_shifted_r)
-
-            # data column is updated subtracting adjacent times
-            if mode == 'subtime':
-                data_shifted_l = np.roll(data, -1, axis=0)
-                data_shifted_r = np.roll(data, +1, axis=0)
-                # if only 2 freq it's aleady ok, subtracting one from the other
-                if data.shape[0] > 2:
-                    data_shifted_l[-1,:,:,:] = data_shifted_l[-3,:,:,:] # last timeslot uses the one but last
-                    data_shifted_r[0,:,:,:] = data_shifted_r[2,:,:,:] # first timeslot uses third
-                # get the "best" shift, either on the right or left. This is to avoid propagating bad channels (e.g. with RFI)
-                ratio_l = np.nanvar(data_shifted_l, axis=(1,2,3))/np.nanmean(data_shifted_l, axis=(1,2,3))
-                ratio_l[ np.isnan(ratio_l) ] = np.inf
-                ratio_r = np.nanvar(data_shifted_r, axis=(1,2,3))/np.nanmean(data_shifted_r, axis=(1,2,3))
-                ratio_r[ np.isnan(ratio_r) ] = np.inf
-                data = np.where( ( ratio_l < ratio_r )[:,np.newaxis,np.newaxis,np.newaxis], data - data_shifted_l, data - data_shifted_r)
-
-            # use residual data, nothing to do here
-            elif mode == 'residual':
-                pass
-
-        with Timer('Calc variances'):
-            # find mean/variance per time/freq for each antenna
-
-            med_freqs = np.abs( np.nanmean( data, axis=(1,2) )**2 ) # time x pol
-            med_times = np.abs( np.nanmean( data, axis=(0,1) )**2 ) # freq x pol
-            med_antenna[ant_id] = med_freqs[:, np.newaxis]+med_times # sum of the time/freq mean - axes: time,freq,pol
-
-            var_freqs = np.nanvar( data, axis=(1,2) ) # time x pol
-            var_times = np.nanvar( data, axis=(0,1) ) # freq x pol
-            var_antenna[ant_id] = var_freqs[:, np.newaxis]+var_times # sum of the time/freq variances - axes: time,freq,pol
+        ms = table(self.ms_files[i], readonly=False, ack=False)
+        return ms, np.searchsorted(self.times, ms.getcol('TIME'))
 
-    # reconstruct BL weights from antenna variance
-    for ms_bl in MSh.ms.iter(["ANTENNA1","ANTENNA2"]):
-        ant_id1 = ms_bl.getcol('ANTENNA1')[0]
-        ant_id2 = ms_bl.getcol('ANTENNA2')[0]
+    def run(self, func, args, merge=None):
+        """
+        Call func(*arg) for each arg in args (e.g. one per MS) in a pool of self.ncpu processes.
+        Return the list of results or, if merge is given, the results merged with merge(result1, result2) as they come.
+        """
+        return lib_multiproc.poolRun(func, args, self.ncpu, merge)
 
-        if var_antenna[ant_id1] is None or var_antenna[ant_id2] is None: continue
+    def iter_chunks(self, ms, row_time, ntimes, halo=0, select=None):
+        """
+        Iterator over a MS in chunks of ntimes of its timestamps, rows ordered by time
+        It returns the timestamps of the chunk (in self.times), the row numbers and the table of the rows,
+        which also include "halo" timestamps before and after the chunk
+        select: if given, only the rows where it is True
+        """
+        order = np.argsort(row_time, kind='stable')
+        if select is not None:
+            order = order[select[order]]
+        times = np.unique(row_time)
+        row_local = np.searchsorted(times, row_time[order]) # timestamp of each row in the MS, as the rows in order
+        for t0 in range(0, len(times), ntimes):
+            t1 = min(t0 + ntimes, len(times))
+            start, end = np.searchsorted(row_local, [max(0, t0-halo), min(len(times), t1+halo)])
+            rows = order[start:end]
+            yield times[t0:t1], rows, ms.selectrows(rows)
+
+
+def incidence(groups, ngroups):
+    """
+    Sparse matrix (ngroups x rows) that sums the rows of each group
+    """
+    return csr_matrix((np.ones(len(groups)), (groups, np.arange(len(groups)))), shape=(ngroups, len(groups)))
 
-#        print '### BL: %i - %i' % (ant_id1, ant_id2)
-#        print var_antenna[ant_id1]*med_antenna[ant_id2]
-#        print ''
-#        print var_antenna[ant_id2]*med_antenna[ant_id1]
-#        print ''
-#        print var_antenna[ant_id1]*var_antenna[ant_id2]
-        w = 1./( var_antenna[ant_id1]*med_antenna[ant_id2] + var_antenna[ant_id2]*med_antenna[ant_id1] \
-               + var_antenna[ant_id1]*var_antenna[ant_id2] )
 
-        w -= np.nanmedian(w) # TEST: REMOVE MEDIAN?
+def combine(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """
+    Count, mean and sum of squared deviations (M2) of two sets of samples together (Welford/Chan update)
+    """
+    n = n_a + n_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = mean_b - mean_a
+        mean = np.where(n > 0, mean_a + delta * n_b / n, 0)
+        m2 = np.where(n > 0, m2_a + m2_b + np.abs(delta)**2 * n_a * n_b / n, 0)
+    return n, mean, m2
+
+
+def shift_index(n):
+    """
+    Neighbours subtracted in the 'subchan'/'subtime' modes along an axis of n samples:
+    the next sample (the one but last for the last one) and the previous one (the third for the first one)
+    """
+    left = np.roll(np.arange(n), -1)
+    right = np.roll(np.arange(n), +1)
+    # if only 2 samples it's aleady ok, subtracting one from the other
+    if n > 2:
+        left[-1] = n-2
+        right[0] = 1
+    return left, right
+
+
+def shift_choice(ratio, index):
+    """
+    Get the "best" shift, either on the right or left, for each antenna and channel/timestamp of a MS.
+    This is to avoid propagating bad channels (e.g. with RFI).
+    ratio: variance/mean of each antenna per channel/timestamp of all MSs (see: AntennaStats.ratio())
+    index: channels/timestamps of the MS in ratio
+    Return True where the next channel/timestamp has to be subtracted, False for the previous one.
+    """
+    left, right = shift_index(len(index))
+    ratio_l, ratio_r = ratio[:, index[left]], ratio[:, index[right]]
+    ratio_l[ np.isnan(ratio_l) ] = np.inf
+    ratio_r[ np.isnan(ratio_r) ] = np.inf
+    return ratio_l < ratio_r
+
+
+class AntennaStats():
+    def __init__(self, nant, ntimes, nfreqs, npol):
+        """
+        Count, mean and sum of squared deviations (M2) of the visibilities of each antenna, for each pol:
+        per time (over baselines and channels) and per channel (over times and baselines)
+        """
+        self.n_t, self.m2_t = np.zeros((nant, ntimes, npol)), np.zeros((nant, ntimes, npol))
+        self.mean_t = np.zeros((nant, ntimes, npol), dtype=complex)
+        self.n_f, self.m2_f = np.zeros((nant, nfreqs, npol)), np.zeros((nant, nfreqs, npol))
+        self.mean_f = np.zeros((nant, nfreqs, npol), dtype=complex)
+
+    def add(self, t_row, chans, ant1, ant2, data1, data2):
+        """
+        Add a chunk of rows of cross-correlations, NaNs are ignored
+        t_row: timestamp of each row
+        chans: channels of the rows
+        ant1, ant2: antennas of each row
+        data1, data2: visibilities of each row (rows x freq x pol) that count for ant1 and for ant2
+        """
+        nant = self.n_t.shape[0]
+        times, t_row = np.unique(t_row, return_inverse=True)
+        ntimes, nrows = len(times), len(t_row)
+        valid1, valid2 = ~np.isnan(data1), ~np.isnan(data2)
+        data1, data2 = np.where(valid1, data1, 0), np.where(valid2, data2, 0)
+
+        # per time
+        groups1, groups2 = ant1*ntimes + t_row, ant2*ntimes + t_row
+        G1, G2 = incidence(groups1, nant*ntimes), incidence(groups2, nant*ntimes)
+        n = G1 @ valid1.sum(axis=1) + G2 @ valid2.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(n > 0, (G1 @ data1.sum(axis=1) + G2 @ data2.sum(axis=1)) / n, 0)
+        m2 = G1 @ np.sum(valid1 * np.abs(data1 - mean[groups1][:,np.newaxis])**2, axis=1) \
+           + G2 @ np.sum(valid2 * np.abs(data2 - mean[groups2][:,np.newaxis])**2, axis=1)
+        shape = (nant, ntimes, -1)
+        self.n_t[:, times], self.mean_t[:, times], self.m2_t[:, times] = combine(
+            self.n_t[:, times], self.mean_t[:, times], self.m2_t[:, times], n.reshape(shape), mean.reshape(shape), m2.reshape(shape))
+
+        # per channel
+        G1, G2 = incidence(ant1, nant), incidence(ant2, nant)
+        valid1, valid2 = valid1.reshape(nrows, -1), valid2.reshape(nrows, -1)
+        data1, data2 = data1.reshape(nrows, -1), data2.reshape(nrows, -1)
+        n = G1 @ valid1 + G2 @ valid2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(n > 0, (G1 @ data1 + G2 @ data2) / n, 0)
+        m2 = G1 @ (valid1 * np.abs(data1 - mean[ant1])**2) + G2 @ (valid2 * np.abs(data2 - mean[ant2])**2)
+        shape = (nant, len(chans), -1)
+        self.n_f[:, chans], self.mean_f[:, chans], self.m2_f[:, chans] = combine(
+            self.n_f[:, chans], self.mean_f[:, chans], self.m2_f[:, chans], n.reshape(shape), mean.reshape(shape), m2.reshape(shape))
+
+    def merge(self, other):
+        """
+        Add the statistics of other (e.g. of another MS)
+        """
+        self.n_t, self.mean_t, self.m2_t = combine(self.n_t, self.mean_t, self.m2_t, other.n_t, other.mean_t, other.m2_t)
+        self.n_f, self.mean_f, self.m2_f = combine(self.n_f, self.mean_f, self.m2_f, other.n_f, other.mean_f, other.m2_f)
+        return self
+
+    def flagged(self):
+        """
+        Return which antennas have no valid data
+        """
+        return np.sum(self.n_f, axis=(1,2)) == 0
+
+    def ratio(self, axis):
+        """
+        Variance over mean of each antenna, over all pols, per time (axis='time') or per channel (axis='freq')
+        """
+        n, mean, m2 = (self.n_t, self.mean_t, self.m2_t) if axis == 'time' else (self.n_f, self.mean_f, self.m2_f)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_all = np.sum(n * mean, axis=2) / np.sum(n, axis=2)
+            m2_all = np.sum(m2, axis=2) + np.sum(n * np.abs(mean - mean_all[..., np.newaxis])**2, axis=2)
+            return m2_all / np.sum(n, axis=2) / mean_all
+
+    def per_freq(self, a, ant, chans):
+        """
+        Values of a per channel of an antenna (chans x pol) or of arrays of antennas (rows x chans x pol)
+        """
+        if chans is None:
+            chans = np.arange(a.shape[1])
+        if np.ndim(ant) == 0:
+            return a[ant, chans]
+        return a[ant[:, np.newaxis], chans]
+
+    def var(self, ant, times=slice(None), chans=None):
+        """
+        Sum of the time and freq variances of an antenna at all times and channels - axes: time,freq,pol
+        or of arrays of antennas and times (e.g. of MS rows) at chans - axes: row,freq,pol
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (self.m2_t[ant, times] / self.n_t[ant, times])[:, np.newaxis] \
+                 + self.per_freq(self.m2_f, ant, chans) / self.per_freq(self.n_f, ant, chans)
+
+    def med(self, ant, times=slice(None), chans=None):
+        """
+        Sum of the squared time and freq means, as var()
+        """
+        mean_t = np.where(self.n_t[ant, times] > 0, self.mean_t[ant, times], np.nan)
+        mean_f = np.where(self.per_freq(self.n_f, ant, chans) > 0, self.per_freq(self.mean_f, ant, chans), np.nan)
+        return np.abs(mean_t**2)[:, np.newaxis] + np.abs(mean_f**2)
+
+    def weights(self, ant1, ant2, times=slice(None), chans=None):
+        """
+        Weights of the baseline ant1-ant2 from the antenna variances, as var()
+        """
+        var1, var2 = self.var(ant1, times, chans), self.var(ant2, times, chans)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 1./( var1*self.med(ant2, times, chans) + var2*self.med(ant1, times, chans) + var1*var2 )
+
+
+def accumulate(MSh, i, chunktimes, mode='residual', ratio=None):
+    """
+    Read the i-th MS once, in chunks of timestamps, and return the AntennaStats of its data.
+    In 'subchan'/'subtime' mode the neighbour channel/timestamp of the MS is subtracted first, for each antenna
+    on the side chosen from ratio (see: shift_choice()).
+    """
+    nant, chans = len(MSh.antennas), MSh.chans[i]
+    ms, row_time = MSh.open(i)
+    stats = AntennaStats(nant, len(MSh.times), len(MSh.freqs), ms.getcell(MSh.dcolname, 0).shape[1])
+    if mode == 'subchan':
+        left, right = shift_index(len(chans))
+        choice = shift_choice(ratio, chans)
+    elif mode == 'subtime':
+        times = np.unique(row_time)
+        left, right = shift_index(len(times))
+        choice = shift_choice(ratio, times)
+
+    for chunk_times, rows, chunk in MSh.iter_chunks(ms, row_time, chunktimes, halo=(1 if mode == 'subtime' else 0)):
+        ant1, ant2, t_row = chunk.getcol('ANTENNA1'), chunk.getcol('ANTENNA2'), row_time[rows]
+        data = chunk.getcol(MSh.dcolname)
+        # put flagged data to NaNs
+        data[chunk.getcol('FLAG')] = np.nan
+        chunk.close()
+        # only cross-correlations of the chunk timestamps (not the halo)
+        select = np.flatnonzero((ant1 != ant2) & (t_row >= chunk_times[0]) & (t_row <= chunk_times[-1]))
+
+        # data column is updated subtracting adjacent channels
+        if mode == 'subchan':
+            data, ant1, ant2, t_row = data[select], ant1[select], ant2[select], t_row[select]
+            data_l, data_r = data - data[:, left], data - data[:, right]
+            data1 = np.where(choice[ant1][..., np.newaxis], data_l, data_r)
+            data2 = np.where(choice[ant2][..., np.newaxis], data_l, data_r)
+
+        # data column is updated subtracting adjacent times of the same baseline, also from the halo
+        elif mode == 'subtime':
+            t_row = np.searchsorted(times, t_row) # timestamps of the MS
+            t_first = t_row.min()
+            row_lookup = np.full((t_row.max()+1 - t_first, nant*nant), len(rows)) # missing rows point to NaNs
+            row_lookup[t_row - t_first, ant1*nant + ant2] = np.arange(len(rows))
+            data = np.concatenate([data, np.full((1,) + data.shape[1:], np.nan, dtype=data.dtype)])
+            ant1, ant2, t_row = ant1[select], ant2[select], t_row[select]
+            data_l = data[select] - data[row_lookup[left[t_row] - t_first, ant1*nant + ant2]]
+            data_r = data[select] - data[row_lookup[right[t_row] - t_first, ant1*nant + ant2]]
+            data1 = np.where(choice[ant1, t_row][:, np.newaxis, np.newaxis], data_l, data_r)
+            data2 = np.where(choice[ant2, t_row][:, np.newaxis, np.newaxis], data_l, data_r)
+            t_row = times[t_row]
+
+        # use residual data, nothing to do here
+        else:
+            ant1, ant2, t_row = ant1[select], ant2[select], t_row[select]
+            data1 = data2 = data[select]
+
+        stats.add(t_row, chans, ant1, ant2, data1, data2)
+
+    ms.close()
+    return stats
+
+
+def baseline_medians(stats, baselines, nant):
+    """
+    Median of the weights of each baseline (as ANTENNA1*nant + ANTENNA2), over all times and channels
+    """
+    return [np.nanmedian(stats.weights(bl // nant, bl % nant)) for bl in baselines]
+
+
+def write_weights(MSh, i, chunktimes, stats, median):
+    """
+    Write the weights of the i-th MS, flagging NaNs, return the number of new flags
+    median: median weight of each baseline (as ANTENNA1*nant + ANTENNA2) to subtract
+    """
+    nant, flagged = len(MSh.antennas), stats.flagged()
+    ms, row_time = MSh.open(i)
+    ants1, ants2 = ms.getcol('ANTENNA1'), ms.getcol('ANTENNA2')
+    # if completely flagged do not change weights
+    update = ~flagged[ants1] & ~flagged[ants2]
+
+    ntoflag_all = 0
+    for chunk_times, rows, chunk in MSh.iter_chunks(ms, row_time, chunktimes, select=update):
+        ant1, ant2 = ants1[rows], ants2[rows]
+        w = stats.weights(ant1, ant2, row_time[rows], MSh.chans[i])
+        w -= median[ant1*nant + ant2][:, np.newaxis, np.newaxis] # TEST: REMOVE MEDIAN?
 
-        f = ms_bl.getcol('FLAG')
-        # find how many unflagged weights are nans
-        ntoflag = np.count_nonzero(np.isnan(w[~f]))
-        logging.debug( 'BL: %i - %i: created %i new flags (%f%%)' % ( ant_id1, ant_id2, ntoflag, (100.*ntoflag)/np.size(w) ) )
-        ms_bl.putcol(MSh.wcolname, w)
-        ms_bl.flush()
         # flag weights that are nans
-        taql('update $ms_bl set FLAG[isnan(WEIGHT_SPECTRUM)]=True, WEIGHT_SPECTRUM[isnan(WEIGHT_SPECTRUM)]=0')
-        ms_bl.flush()
+        f = chunk.getcol('FLAG')
+        nans = np.isnan(w)
+        # find how many unflagged weights are nans
+        ntoflag = np.count_nonzero(nans & ~f)
+        ntoflag_all += ntoflag
+        logging.debug( '%s - times %i-%i: created %i new flags (%f%%)' % ( MSh.ms_files[i], chunk_times[0], chunk_times[-1],
+                       ntoflag, (100.*ntoflag)/np.size(w) ) )
+        f[nans] = True
+        w[nans] = 0
+        chunk.putcol(MSh.wcolname, w)
+        chunk.putcol('FLAG', f)
+        chunk.close()
+    ms.close()
+    return ntoflag_all
+
+
+def reweight(MSh, mode, chunktimes):
+
+    nms = len(MSh.ms_files)
+    with Timer('Calc variances'):
+        # find mean/variance per time/freq for each antenna, reading the MSs in chunks of timestamps
+        stats = MSh.run(accumulate, [(MSh, i, chunktimes) for i in range(nms)], merge=AntennaStats.merge)
+
+        # choose the neighbour channel/timestamp to subtract from the stats of all MSs, then get the stats of the subtracted data
+        if mode == 'subchan' or mode == 'subtime':
+            ratio = stats.ratio('freq' if mode == 'subchan' else 'time')
+            stats = MSh.run(accumulate, [(MSh, i, chunktimes, mode, ratio) for i in range(nms)], merge=AntennaStats.merge)
 
-def plot(MSh, antennas):
+    # reconstruct BL weights from antenna variance
+    with Timer('Calc weights'):
+        nant, flagged = len(MSh.antennas), stats.flagged()
+        baselines = MSh.baselines[~flagged[MSh.baselines // nant] & ~flagged[MSh.baselines % nant]]
+        # median of the weights of each baseline, over all times and channels of all MSs
+        median = np.zeros(nant*nant)
+        jobs = [(stats, bls, nant) for bls in np.array_split(baselines, MSh.ncpu) if len(bls) > 0]
+        median[baselines] = np.concatenate([[]] + MSh.run(baseline_medians, jobs))
+
+    with Timer('Write weights'):
+        ntoflag = MSh.run(write_weights, [(MSh, i, chunktimes, stats, median) for i in range(nms)])
+        for ms_file, n in zip(MSh.ms_files, ntoflag):
+            logging.info('%s: created %i new flags.' % (ms_file, n))
+        logging.info('Created %i new flags in total.' % np.sum(ntoflag))
+
+
+def antenna_weights(MSh, i, ants, chunktimes):
+    """
+    Sum and number of the unflagged weights of the baselines of the antennas ants in the i-th MS
+    Return two arrays of ants x time x freq x pol, for all timestamps and channels of the MSs
+    """
+    nant, chans = len(MSh.antennas), MSh.chans[i]
+    ms, row_time = MSh.open(i)
+    ants1, ants2 = ms.getcol('ANTENNA1'), ms.getcol('ANTENNA2')
+    ant_index = np.full(nant, -1)
+    ant_index[ants] = np.arange(len(ants))
+    shape = (len(ants), len(MSh.times), len(MSh.freqs), ms.getcell(MSh.wcolname, 0).shape[1])
+    w_sum, w_n = np.zeros(shape), np.zeros(shape)
+
+    select = (ants1 != ants2) & ((ant_index[ants1] >= 0) | (ant_index[ants2] >= 0))
+    for chunk_times, rows, chunk in MSh.iter_chunks(ms, row_time, chunktimes, select=select):
+        w = np.abs(chunk.getcol(MSh.wcolname))
+        valid = ~chunk.getcol('FLAG') & ~np.isnan(w)
+        w[~valid] = 0
+        chunk.close()
+        t_row = np.searchsorted(chunk_times, row_time[rows])
+        index = np.ix_(np.arange(len(ants)), chunk_times, chans)
+        # each baseline counts for both its antennas
+        for ant in (ants1[rows], ants2[rows]):
+            keep = ant_index[ant] >= 0
+            G = incidence(ant_index[ant[keep]]*len(chunk_times) + t_row[keep], len(ants)*len(chunk_times))
+            w_sum[index] += (G @ w[keep].reshape(np.sum(keep), -1)).reshape(len(ants), len(chunk_times), len(chans), -1)
+            w_n[index] += (G @ valid[keep].reshape(np.sum(keep), -1)).reshape(len(ants), len(chunk_times), len(chans), -1)
+    ms.close()
+    return w_sum, w_n
+
+
+def iter_antenna_weights(MSh, antennas, chunktimes, maxbytes=2e8):
+    """
+    Iterator over the antennas (names, all if None) returning the mean weights of their baselines (time x freq x pol)
+    and where they are fully flagged, over all MSs.
+    The MSs are read once per batch of antennas, with results of at most maxbytes.
+    """
+    ant_ids = [ant_id for ant_id, ant_name in enumerate(MSh.antennas) if antennas is None or ant_name in antennas]
+    cell_bytes = 8 * len(MSh.times) * len(MSh.freqs) * 4 # of one antenna, for 4 pols
+    batch = max(1, int(maxbytes // cell_bytes))
+    for b in range(0, len(ant_ids), batch):
+        ants = ant_ids[b:b+batch]
+        logging.info('Workign on antennas: %s', ','.join(MSh.antennas[ants]))
+        w_sum, w_n = MSh.run(antenna_weights, [(MSh, i, ants, chunktimes) for i in range(len(MSh.ms_files))],
+                             merge=lambda a, b: (a[0]+b[0], a[1]+b[1]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w = w_sum / w_n
+        for k, ant_id in enumerate(ants):
+            yield ant_id, MSh.antennas[ant_id], w[k], w_n[k] == 0
+
+
+def plot(MSh, antennas, chunktimes):
 
     if antennas is not None:
         for antenna in antennas:
-            if antenna not in MSh.get_antennas():
+            if antenna not in MSh.antennas:
                 logging.error('Missing antenna %s' % antenna)
                 sys.exit(1)
 
@@ -226,7 +499,7 @@ def plot(MSh, antennas):
 
     fig = plt.figure(figsize=(15,15))
 
-    for ant_id, ant_name, ms_ant in MSh.iter_antenna(antennas):
+    for ant_id, ant_name, w, flag in iter_antenna_weights(MSh, antennas, chunktimes):
         
         fig.suptitle(ant_name, fontweight='bold')
         fig.subplots_adjust(wspace=0)
@@ -241,12 +514,6 @@ def plot(MSh, antennas):
         #axfv = plt.subplot2grid((6, 2), (5, 0), colspan=2)
         ###
 
-        w = np.abs(ms_ant.getcol('GWEIGHT')) # time,freq,pol
-        flag = ms_ant.getcol('GFLAG') # time,freq,pol
-        w[flag] = np.nan
-        w = np.nanmean(w, axis=1)
-        flag = np.all(flag, axis=1)
-
         ### TEST
         ## subchan
         #w = np.abs(w)
@@ -393,7 +660,7 @@ def plot(MSh, antennas):
 
         imagename = ant_name+'.png'
         logging.info('Save file: %s' % (imagename))
-        fig.savefig(imagename, bbox_inches='tight', additional_artists=leg, dpi=250)
+        fig.savefig(imagename, bbox_inches='tight', bbox_extra_artists=[leg], dpi=250)
         fig.clf()
 
 def readArguments():
@@ -405,6 +672,8 @@ def readArguments():
     parser.add_argument("-d", "--dcolname", type=str, help="Name of the data column. Default: DATA.", required=False, default='DATA')
     parser.add_argument("-w", "--wcolname", type=str, help="Name of the weights column. Default: WEIGHT_SPECTRUM.", required=False, default="WEIGHT_SPECTRUM")
     parser.add_argument("-a", "--antennas", type=str, help="List of antennas to plot (comma separated). Default: all antennas", required=False, default=None)
+    parser.add_argument("-c", "--chunktimes", type=int, help="Timestamps read at once from each MS, lower it to save memory. Default: 50.", required=False, default=50)
+    parser.add_argument("-n", "--ncpu", type=int, help="Number of MSs processed in parallel. Default: 4.", required=False, default=4)
     parser.add_argument("ms_files", type=str, help="MeasurementSet name(s).", nargs="+")
     args=parser.parse_args()
     return vars(args)
@@ -423,10 +692,6 @@ if __name__=="__main__":
     if verbose: logging.basicConfig(level=logging.DEBUG)
     else: logging.basicConfig(level=logging.INFO)
 
-    if len(ms_files) > 1:
-        logging.error('More than 1 MS not implemented.')
-        sys.exit()
-
     if args["antennas"] is not None:
         antennas = args["antennas"].replace(' ','').split(',')
     else: antennas = None
@@ -438,14 +703,14 @@ if __name__=="__main__":
         logging.info('Mode: %s' % mode)
 
     logging.info('Reading MSs...')
-    MSh = MShandler(ms_files, wcolname, dcolname)
+    MSh = MShandler(ms_files, wcolname, dcolname, args["ncpu"])
 
     if mode is not None:
         logging.info('Computing weights...')
-        reweight(MSh, mode)
+        reweight(MSh, mode, args["chunktimes"])
 
     if do_plot:
         logging.info('Plotting...')
-        plot(MSh, antennas)
+        plot(MSh, antennas, args["chunktimes"])
 
     logging.debug('Running time %.0f s' % (time.time()-start_time))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: slurm_standin.py sbatch|squeue|scancel [options]
+# Minimal local stand-in for the SLURM commands used by lib_util.SlurmBackend,
+# job arrays are run on this machine. To use it:
+# lib_util.Scheduler(backend=lib_util.SlurmBackend(sbatch='slurm_standin.py sbatch',
+#                    squeue='slurm_standin.py squeue', scancel='slurm_standin.py scancel'))
+
+import os, sys, re, time, signal, argparse, subprocess
+
+state_dir = os.environ.get('SLURM_STANDIN_DIR', '/tmp/slurm_standin-%i' % os.getuid())
+
+
+def sbatch(argv):
+    """
+    Start the job array in background and print its id
+    """
+    parser = argparse.ArgumentParser(prog='sbatch')
+    parser.add_argument('--array', default='0-0')
+    parser.add_argument('--output', default='slurm-%A_%a.out')
+    parser.add_argument('--parsable', action='store_true')
+    parser.add_argument('script')
+    args, _ = parser.parse_known_args(argv)
+
+    first, last, limit = re.match(r'(\d+)-(\d+)(?:%(\d+))?', args.array).groups()
+    if not os.path.exists(state_dir): os.makedirs(state_dir)
+    jobid = str(int(time.time()*1000) % 10**9)
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), 'runjob', jobid, first, last, limit or '0',
+                      args.output, args.script], start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    print(jobid if args.parsable else 'Submitted batch job %s' % jobid)
+
+
+def runjob(jobid, first, last, limit, output, script):
+    """
+    Run the array tasks, at most limit at the same time
+    """
+    pidfile = '%s/%s.pid' % (state_dir, jobid)
+    with open(pidfile, 'w') as f: f.write(str(os.getpid()))
+    tasks = list(range(int(first), int(last)+1))
+    limit = int(limit) if int(limit) > 0 else len(tasks)
+    running = []
+    while len(tasks) > 0 or len(running) > 0:
+        running = [p for p in running if p.poll() is None]
+        while len(tasks) > 0 and len(running) < limit:
+            t = tasks.pop(0)
+            env = dict(os.environ, SLURM_JOB_ID=jobid, SLURM_ARRAY_JOB_ID=jobid, SLURM_ARRAY_TASK_ID=str(t))
+            with open(output.replace('%A', jobid).replace('%a', str(t)), 'w') as out:
+                running.append(subprocess.Popen(['bash', script], env=env, stdout=out, stderr=subprocess.STDOUT))
+        time.sleep(0.1)
+    os.remove(pidfile)
+
+
+def squeue(argv):
+    """
+    Print the ids of the jobs still running
+    """
+    parser = argparse.ArgumentParser(prog='squeue')
+    parser.add_argument('--jobs', default='')
+    args, _ = parser.parse_known_args(argv)
+    for jobid in args.jobs.split(','):
+        if os.path.exists('%s/%s.pid' % (state_dir, jobid)): print(jobid)
+
+
+def scancel(argv):
+    """
+    Kill a job array and all its tasks
+    """
+    for jobid in argv:
+        pidfile = '%s/%s.pid' % (state_dir, jobid)
+        if not os.path.exists(pidfile): continue
+        with open(pidfile) as f: pid = int(f.read())
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        os.remove(pidfile)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ['sbatch', 'squeue', 'scancel', 'runjob']:
+        print('Usage: slurm_standin.py sbatch|squeue|scancel [options]')
+        sys.exit(1)
+    if sys.argv[1] == 'runjob': runjob(*sys.argv[2:])
+    else: globals()[sys.argv[1]](sys.argv[2:])
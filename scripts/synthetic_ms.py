@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+# Usage: synthetic_ms.py out.MS [--options]
+# Create a small LOFAR-like MS with random visibilities, time ordered (TIME, ANTENNA1, ANTENNA2),
+# used by the benchmark_*.py scripts.
+
+import argparse
+import numpy as np
+import casacore.tables as pt
+
+from LiLF import lib_util
+
+
+def tiled_dminfo(name, nchan, tilerows=64):
+    return {'TYPE': 'TiledColumnStMan', 'NAME': name,
+            'SPEC': {'DEFAULTTILESHAPE': np.array([4, nchan, tilerows], dtype=np.int32)}}
+
+
+def make_ms(pathMS, nant=20, ntimes=100, nchan=16, timeint=4., freq=50e6, chanwidth=195312.5,
+            columns=('MODEL_DATA',), seed=0):
+    """
+    Create the MS
+    columns: visibility columns to add besides DATA, filled with random values as DATA
+    """
+    rng = np.random.default_rng(seed)
+    lib_util.check_rm(pathMS)
+    ant1, ant2 = np.triu_indices(nant)
+    nbl = len(ant1)
+    nrows = nbl * ntimes
+    # core stations within few km and a remote one
+    pos = rng.normal(size=(nant, 3)) * 2e3
+    pos[-1] *= 20
+
+    with pt.default_ms(pathMS) as t:
+        t.addrows(nrows)
+        times = 4.9e9 + timeint * np.repeat(np.arange(ntimes), nbl)
+        t.putcol('TIME', times)
+        t.putcol('TIME_CENTROID', times)
+        t.putcol('INTERVAL', np.full(nrows, timeint))
+        t.putcol('EXPOSURE', np.full(nrows, timeint))
+        t.putcol('ANTENNA1', np.tile(ant1, ntimes))
+        t.putcol('ANTENNA2', np.tile(ant2, ntimes))
+        # rotate the baselines with time to mimic earth rotation
+        ha = np.repeat(np.linspace(0, np.pi/4, ntimes), nbl)
+        bl = pos[np.tile(ant2, ntimes)] - pos[np.tile(ant1, ntimes)]
+        t.putcol('UVW', np.stack([bl[:,0]*np.cos(ha) - bl[:,1]*np.sin(ha),
+                                  bl[:,0]*np.sin(ha) + bl[:,1]*np.cos(ha), bl[:,2]], axis=1))
+
+        for col in ('DATA',) + tuple(columns):
+            t.addcols(pt.makearrcoldesc(col, 0j, ndim=2, shape=[nchan, 4], valuetype='complex'),
+                      tiled_dminfo('Tiled'+col, nchan))
+            t.putcol(col, (rng.normal(size=(nrows, nchan, 4)) + 1j*rng.normal(size=(nrows, nchan, 4))).astype(np.complex64))
+        t.addcols(pt.makearrcoldesc('WEIGHT_SPECTRUM', 0., ndim=2, shape=[nchan, 4], valuetype='float'),
+                  tiled_dminfo('TiledWEIGHT_SPECTRUM', nchan))
+        t.putcol('WEIGHT_SPECTRUM', np.ones((nrows, nchan, 4), dtype=np.float32))
+        t.putcol('FLAG', np.zeros((nrows, nchan, 4), dtype=bool))
+
+    freqs = freq + chanwidth * np.arange(nchan)
+    with pt.table(pathMS+'/SPECTRAL_WINDOW', readonly=False, ack=False) as t:
+        t.addrows(1)
+        t.putcell('CHAN_FREQ', 0, freqs)
+        t.putcell('NUM_CHAN', 0, nchan)
+        for col in ['CHAN_WIDTH', 'EFFECTIVE_BW', 'RESOLUTION']:
+            t.putcell(col, 0, np.full(nchan, chanwidth))
+        t.putcell('REF_FREQUENCY', 0, freqs.mean())
+    with pt.table(pathMS+'/FIELD', readonly=False, ack=False) as t:
+        t.addrows(1)
+        for col in ['PHASE_DIR', 'DELAY_DIR', 'REFERENCE_DIR']:
+            t.putcell(col, 0, np.array([[2.0, 0.9]]))
+        t.putcell('NAME', 0, 'synthetic')
+    with pt.table(pathMS+'/OBSERVATION', readonly=False, ack=False) as t:
+        t.addcols(pt.makescacoldesc('LOFAR_ANTENNA_SET', ''))
+        t.addcols(pt.makescacoldesc('LOFAR_OBSERVATION_ID', ''))
+        t.addrows(1)
+        t.putcell('TELESCOPE_NAME', 0, 'LOFAR')
+        t.putcell('LOFAR_ANTENNA_SET', 0, 'LBA_OUTER')
+        t.putcell('LOFAR_OBSERVATION_ID', 0, '0')
+    with pt.table(pathMS+'/ANTENNA', readonly=False, ack=False) as t:
+        t.addrows(nant)
+        t.putcol('POSITION', pos + np.array([3826577., 461022., 5064892.]))
+        t.putcol('NAME', ['CS%03i' % a for a in range(nant)])
+
+    return pathMS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create a synthetic LOFAR-like MS.')
+    parser.add_argument('ms', help='Output MS')
+    parser.add_argument('-a', '--nant', default=20, type=int, help='Number of antennas [default: 20]')
+    parser.add_argument('-t', '--ntimes', default=100, type=int, help='Number of timestamps [default: 100]')
+    parser.add_argument('-c', '--nchan', default=16, type=int, help='Number of channels [default: 16]')
+    parser.add_argument('--columns', default='MODEL_DATA', help='Visibility columns besides DATA, comma separated [default: MODEL_DATA]')
+    args = parser.parse_args()
+
+    make_ms(args.ms, nant=args.nant, ntimes=args.ntimes, nchan=args.nchan,
+            columns=[c for c in args.columns.split(',') if c != ''])